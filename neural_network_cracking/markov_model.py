@@ -6,6 +6,7 @@ import sys
 
 import numpy as np
 import pwd_guess as pg
+import pwd_guess_file
 import logging
 import subprocess
 import sys
@@ -189,6 +190,9 @@ class MarkovModelBuilder(object):
             return cls(self.config, smoothing=self.smoothing, order=self.order)
 
 class MarkovGuessingFunction(object):
+    def prefetch_input(self):
+        return False
+
     def conditional_probs_many(self, astring_list):
         answer = np.zeros((len(astring_list), 1, self.ctable.vocab_size),
                           dtype=np.float64)
@@ -315,7 +319,7 @@ def main(args):
                 # take args.ofile, sort it and return top 5 passwords
                 # sort: sort -gr -k2 -t$'\t' markov_ofile.txt -o sorted_markov_ofile.txt
                 # subprocess.run(["ls", "-l"])
-                subprocess.call(["sort", "-gr", "-k2", "-t", "\t" , args.ofile, "-o", f"sorted_{args.ofile}"])
+                pwd_guess_file.sort_guess_file(args.ofile, f"sorted_{args.ofile}")
                 print("sorted.")
                 # subprocess.run(f"sort -gr -k2 -t$'\t' {args.ofile} -o sorted_{args.ofile}".split(" "))
                 # subprocess.run(f"sort -gr -k2 -t'\\t' {args.ofile} -o sorted_{args.ofile}".split(" "))
@@ -381,32 +385,13 @@ def test_markov_model(args):
                         start_time = 0
                         is_prediction_correct = False
                         context_chars = prefix
-                        try:
-                            # guess the next chars
-                            guesser.ostream = open(args.ofile, 'w') # empty file
-                            guesser.generated = 0
-                            
-                            start = time.process_time()
-                            guesser.complete_guessing(context_chars)
-                            
-
-                        except Exception as e:
-                            print(f"Unable to predict pwd: {pwd}")
-                            incorrect_predictions += 1
-                            break
-
-                        # sort the passwords by probability (descending)
-                        subprocess.call(["sort", "-gr", "-k2", "-t", "\t" , args.ofile, "-o", f"sorted_{args.ofile}"])
-
-                        # read the first 10 most likely guesses
+                        start = time.process_time()
+                        # get the 10 most likely next chars directly from the model
                         K_MOST_LIKELY = 10
-                        with open(f"sorted_{args.ofile}") as myfile:
-                            # most_likely_pwds_for_prefix = [next(myfile).strip().split('\t')[0] for x in range(K_MOST_LIKELY)]
-                            # most_likely_pwds_for_prefix = [next(myfile).split("\t")[0].strip() for x in range(K_MOST_LIKELY)]
-                            most_likely_pwds_for_prefix = [line.split("\t")[0].strip() for index, line in enumerate(myfile) if index < 10]
-                        # print(most_likely_pwds_for_prefix)
-
-                        most_likely_next_chars = set([p[len(context_chars)] for p in most_likely_pwds_for_prefix])
+                        most_likely_next_chars = set(
+                            char for char, prob in guesser.top_k_next_chars(
+                                [context_chars], K_MOST_LIKELY,
+                                include_end=False)[0] if prob > 0)
                         next_char_prediction_time[len(prefix)].append(time.process_time() - start)
 
                         # print(f"most_likely_next_chars set: {most_likely_next_chars}")
@@ -487,35 +472,12 @@ def test_markov_model_prefix(args):
                     prefix = tokens[0]
                     all_possible_next_chars_ground_truth = tokens[1]
 
-                    context_chars = prefix
-                    try:
-                        # guess the next chars
-                        guesser.ostream = open(args.ofile, 'w') # empty file
-                        guesser.generated = 0
-                        
-                        guesser.complete_guessing(context_chars)
-                    except Exception as e:
-                        pass
-                        # print(e)
-                        # print(f"no predictions for: {pwd}. Prefix: {prefix}")
-                        # incorrect_predictions += 1
-                        # print(f"Pwd {testing_pwd} tested. Incorrect predictions: {incorrect_predictions} / {test_pwd_count+1}")
-                        # print("Progress: {0:.0%}".format((test_pwd_count+1)/PASSWORDS_TO_TEST))
-                        # continue
-
-
-                    # sort the passwords by probability (descending)
-                    subprocess.call(["sort", "-gr", "-k2", "-t", "\t" , args.ofile, "-o", f"sorted_{args.ofile}"])
-
-                    # read the first 10 most likely guesses
+                    # get the most likely next chars directly from the model
                     K_MOST_LIKELY = 10
-                    most_likely_10_next_chars_set = set()
-                    with open(f"sorted_{args.ofile}") as myfile:
-                        for line in myfile:
-                            if len(most_likely_10_next_chars_set) < K_MOST_LIKELY:
-                                p = line
-                                # get the next char and add to set
-                                most_likely_10_next_chars_set.add(p.split("\t")[0].strip()[len(context_chars)])
+                    most_likely_10_next_chars_set = set(
+                        char for char, prob in guesser.top_k_next_chars(
+                            [prefix], K_MOST_LIKELY, include_end=False)[0]
+                        if prob > 0)
 
                     # if no predictions available, incorrect_predictions += 1 then continue to next prefix
                     if len(most_likely_10_next_chars_set) == 0:
@@ -115,6 +115,22 @@ class MarkovGuesserTest(unittest.TestCase):
                 0, 0, 0, 0, 0, 0, 1, 0
             ]]], dtype=np.float64))
 
+    def test_top_k_next_chars(self):
+        config = pg.ModelDefaults(char_bag = pg.PASSWORD_END + 'aehnpst',
+                                  guesser_class = 'markov_model')
+        pg.GuesserBuilder.other_class_builders[
+            'markov_model'] = mm.MarkovGuesser
+        model = mm.MarkovModel(config, smoothing='none', order=2)
+        model.train([('pass', 1), ('past', 1), ('ashen', 1)])
+        guesser_builder = pg.GuesserBuilder(config)
+        guesser_builder.add_model(model)
+        guesser_builder.add_stream(io.StringIO())
+        guesser = guesser_builder.build()
+        answer = guesser.top_k_next_chars(['pa', 'ashe', 'pas'], 4)
+        self.assertEqual([row[0][0] for row in answer[:2]], ['s', 'n'])
+        np.testing.assert_array_almost_equal(
+            [prob for _, prob in answer[2]], [1/3, 1/3, 1/3, 0])
+
 
 class AdditiveSmoothingTest(unittest.TestCase):
     def test_predict(self):
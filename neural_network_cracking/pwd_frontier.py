@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""Compact storage for the nodes of the guessing tree.
+
+A node is a prefix and its probability. Instead of a python string for every
+node, NodeArena stores the index of the parent node, the index of the last
+character in the character table and the probability in flat numpy arrays,
+about 15 bytes per node. The prefix strings are only rebuilt for a batch of
+nodes when the batch is sent to the model or to the serializer.
+
+When even that is too large, FrontierSpiller moves open nodes to run files on
+disk so that they can be expanded later.
+"""
+import heapq
+import json
+import math
+import os
+import tempfile
+
+import numpy as np
+
+BUCKET_WIDTH = 0.05
+
+class NodeArena():
+    """Guessing tree nodes stored as parent pointers.
+
+    Root nodes have no parent and stand for a whole prefix string. Their
+    parent entry is -1 - i, where i is the index of the string in roots.
+    """
+    def __init__(self, chars, capacity=1024):
+        if len(chars) > 256:
+            raise ValueError('NodeArena supports at most 256 characters')
+        self.code_points = np.array([ord(c) for c in chars], dtype=np.uint32)
+        self.roots = []
+        self.size = 0
+        self.parents = np.zeros(capacity, dtype=np.int32)
+        self.chars = np.zeros(capacity, dtype=np.uint8)
+        self.probs = np.zeros(capacity, dtype=np.float64)
+        self.depths = np.zeros(capacity, dtype=np.uint16)
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def nbytes(self):
+        return (self.parents.nbytes + self.chars.nbytes + self.probs.nbytes +
+                self.depths.nbytes)
+
+    def _reserve(self, amount):
+        needed = self.size + amount
+        if needed <= len(self.parents):
+            return
+        capacity = max(needed, 2 * len(self.parents))
+        for name in ['parents', 'chars', 'probs', 'depths']:
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def _append(self, parents, chars, probs, depths):
+        amount = len(parents)
+        self._reserve(amount)
+        start, end = self.size, self.size + amount
+        self.parents[start:end] = parents
+        self.chars[start:end] = chars
+        self.probs[start:end] = probs
+        self.depths[start:end] = depths
+        self.size = end
+        return np.arange(start, end)
+
+    def add_roots(self, nodes):
+        """Adds (prefix, probability) nodes. Returns their ids."""
+        first_root = len(self.roots)
+        self.roots += [astring for astring, _ in nodes]
+        return self._append(
+            -1 - np.arange(first_root, len(self.roots)), 0,
+            [prob for _, prob in nodes], 0)
+
+    def add_children(self, parents, char_indices, probs):
+        """Adds one child for every parent id. Returns the ids of the children.
+        """
+        parents = np.asarray(parents, dtype=np.int32)
+        return self._append(parents, char_indices, probs,
+                            self.depths[parents] + 1)
+
+    def truncate(self, size):
+        self.size = min(self.size, size)
+
+    def strings(self, ids):
+        """Rebuilds the prefix strings of the given node ids."""
+        ids = np.asarray(ids, dtype=np.int64)
+        depths = self.depths[ids].astype(np.int64)
+        max_depth = int(depths.max()) if len(ids) > 0 else 0
+        codes = np.zeros((len(ids), max(max_depth, 1)), dtype=np.uint32)
+        cur = ids.copy()
+        for position in range(max_depth - 1, -1, -1):
+            rows = np.flatnonzero(depths > position)
+            codes[rows, position] = self.code_points[self.chars[cur[rows]]]
+            cur[rows] = self.parents[cur[rows]]
+        suffixes = codes.view('<U%d' % codes.shape[1]).ravel().tolist()
+        root_indices = -1 - self.parents[cur]
+        if len(self.roots) == 1 and self.roots[0] == '':
+            return suffixes
+        return [self.roots[root] + suffix
+                for root, suffix in zip(root_indices.tolist(), suffixes)]
+
+    def compact(self, live_ids):
+        """Drops every node that is not in live_ids or an ancestor of one.
+
+        Returns an array that maps old ids to new ids, or to -1 for nodes that
+        were dropped.
+        """
+        live = np.zeros(self.size, dtype=bool)
+        cur = np.unique(np.asarray(live_ids, dtype=np.int64))
+        while len(cur) > 0:
+            cur = cur[~live[cur]]
+            live[cur] = True
+            cur = self.parents[cur]
+            cur = np.unique(cur[cur >= 0])
+        kept = np.flatnonzero(live)
+        mapping = np.full(self.size + 1, -1, dtype=np.int64)
+        mapping[kept] = np.arange(len(kept))
+        parents = self.parents[kept]
+        is_root = parents < 0
+        root_indices = -1 - parents[is_root]
+        self.roots = [self.roots[i] for i in root_indices.tolist()]
+        parents[is_root] = -1 - np.arange(len(self.roots))
+        parents[~is_root] = mapping[parents[~is_root]]
+        self.parents[:len(kept)] = parents
+        for array in [self.chars, self.probs, self.depths]:
+            array[:len(kept)] = array[kept]
+        self.size = len(kept)
+        return mapping[:-1]
+
+class ProbabilityBuckets():
+    """Priority queue of node ids for best first search.
+
+    Nodes are grouped into buckets by the log of their probability. The
+    buckets are popped in order, but the nodes inside one bucket are not
+    sorted. upper_bound is never less than the probability of any node
+    still in the queue.
+    """
+    def __init__(self, width=BUCKET_WIDTH):
+        self.width = width
+        self.buckets = {}
+        self.keys = []
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def push(self, ids, probs):
+        if len(ids) == 0:
+            return
+        probs = np.maximum(probs, np.finfo(np.float64).tiny)
+        keys = np.floor(-np.log(probs) / self.width).astype(np.int64)
+        order = np.argsort(keys, kind='stable')
+        keys, ids = keys[order], np.asarray(ids)[order]
+        unique_keys, starts = np.unique(keys, return_index=True)
+        for key, bucket_ids in zip(unique_keys.tolist(),
+                                   np.split(ids, starts[1:])):
+            if key not in self.buckets:
+                self.buckets[key] = []
+                heapq.heappush(self.keys, key)
+            self.buckets[key].append(bucket_ids)
+        self.count += len(ids)
+
+    def pop(self, amount):
+        """Removes and returns up to amount ids from the most probable buckets.
+        """
+        answer = []
+        while amount > 0 and len(self.keys) > 0:
+            bucket = self.buckets[self.keys[0]]
+            ids = bucket.pop()
+            if len(ids) > amount:
+                bucket.append(ids[amount:])
+                ids = ids[:amount]
+            if len(bucket) == 0:
+                del self.buckets[heapq.heappop(self.keys)]
+            answer.append(ids)
+            amount -= len(ids)
+        answer = (np.concatenate(answer) if len(answer) > 0
+                  else np.zeros(0, dtype=np.int64))
+        self.count -= len(answer)
+        return answer
+
+    def pop_least_probable(self, amount):
+        """Removes and returns up to amount ids from the least probable buckets.
+        """
+        answer = []
+        while amount > 0 and len(self.keys) > 0:
+            key = max(self.keys)
+            bucket = self.buckets[key]
+            ids = bucket.pop()
+            if len(ids) > amount:
+                bucket.append(ids[:-amount])
+                ids = ids[-amount:]
+            if len(bucket) == 0:
+                del self.buckets[key]
+                self.keys.remove(key)
+                heapq.heapify(self.keys)
+            answer.append(ids)
+            amount -= len(ids)
+        answer = (np.concatenate(answer) if len(answer) > 0
+                  else np.zeros(0, dtype=np.int64))
+        self.count -= len(answer)
+        return answer
+
+    def upper_bound(self):
+        if len(self.keys) == 0:
+            return 0
+        # Allow for rounding in the log when the bucket was picked
+        return math.exp(-self.keys[0] * self.width) * (1 + 1e-9)
+
+    def ids(self):
+        return np.concatenate(
+            [ids for bucket in self.buckets.values() for ids in bucket] +
+            [np.zeros(0, dtype=np.int64)])
+
+    def remap(self, mapping):
+        for bucket in self.buckets.values():
+            for i, ids in enumerate(bucket):
+                bucket[i] = mapping[ids]
+
+def write_run(fname, astrings, probs):
+    """Writes nodes to a binary run file.
+
+    The file holds two arrays in npy format: the probabilities and the utf-8
+    bytes of the prefixes joined with newlines, which never occur in a prefix.
+    """
+    with open(fname, 'wb') as run:
+        np.save(run, np.asarray(probs, dtype=np.float64))
+        np.save(run, np.frombuffer(
+            '\n'.join(astrings).encode('utf-8'), dtype=np.uint8))
+
+def read_run(fname):
+    """Returns the (prefix, probability) nodes in a run file."""
+    with open(fname, 'rb') as run:
+        probs = np.load(run)
+        astrings = np.load(run).tobytes().decode('utf-8').split('\n')
+    return list(zip(astrings, probs.tolist()))
+
+class FrontierSpiller():
+    """Keeps open nodes in run files in a directory.
+
+    Runs are handed back most probable first, as judged by the most probable
+    node of the run. The run files are deleted as they are read, unless
+    keep_consumed is true. Then they are kept until remove_consumed is called,
+    so that a checkpoint that still lists them stays valid.
+    """
+    def __init__(self, directory, keep_consumed=False, runs=None):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.keep_consumed = keep_consumed
+        self.consumed = []
+        self.runs = [tuple(run) for run in runs] if runs is not None else []
+        heapq.heapify(self.runs)
+        self.spilled_nodes = 0
+
+    def __len__(self):
+        return len(self.runs)
+
+    def spill(self, astrings, probs):
+        if len(astrings) == 0:
+            return
+        handle, fname = tempfile.mkstemp(
+            dir=self.directory, prefix='frontier_run_', suffix='.bin')
+        os.close(handle)
+        write_run(fname, astrings, probs)
+        heapq.heappush(self.runs, (-float(np.max(probs)), fname))
+        self.spilled_nodes += len(astrings)
+
+    def max_prob(self):
+        return -self.runs[0][0] if len(self.runs) > 0 else 0
+
+    def load(self):
+        _, fname = heapq.heappop(self.runs)
+        nodes = read_run(fname)
+        if self.keep_consumed:
+            self.consumed.append(fname)
+        else:
+            os.remove(fname)
+        return nodes
+
+    def remove_consumed(self):
+        for fname in self.consumed:
+            os.remove(fname)
+        self.consumed = []
+
+    def cleanup(self):
+        self.remove_consumed()
+        while len(self.runs) > 0:
+            os.remove(heapq.heappop(self.runs)[1])
+
+def save_checkpoint(fname, arena, stack, state):
+    """Saves a depth first search to fname.
+
+    stack is the list of (start, end) chunks of node ids still to be expanded
+    and state is any other json serializable information. The file is
+    written next to fname first and then renamed, so an interrupted save
+    leaves the previous checkpoint in place.
+    """
+    state = dict(state, roots=arena.roots)
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'wb') as checkpoint:
+        np.savez(
+            checkpoint,
+            parents=arena.parents[:arena.size], chars=arena.chars[:arena.size],
+            probs=arena.probs[:arena.size], depths=arena.depths[:arena.size],
+            stack=np.array(stack, dtype=np.int64).reshape((-1, 2)),
+            state=np.frombuffer(json.dumps(state).encode('utf-8'),
+                                dtype=np.uint8))
+    os.replace(tmp_fname, fname)
+
+def load_checkpoint(fname, chars):
+    """Returns the (arena, stack, state) saved by save_checkpoint."""
+    with np.load(fname) as checkpoint:
+        state = json.loads(checkpoint['state'].tobytes().decode('utf-8'))
+        arena = NodeArena(chars, capacity=max(len(checkpoint['probs']), 1))
+        arena.roots = state.pop('roots')
+        arena._append(checkpoint['parents'], checkpoint['chars'],
+                      checkpoint['probs'], checkpoint['depths'])
+        stack = [tuple(chunk) for chunk in checkpoint['stack'].tolist()]
+    return arena, stack, state
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import pwd_frontier
+
+class NodeArenaTest(unittest.TestCase):
+    def make_tree(self):
+        arena = pwd_frontier.NodeArena('\nabc', capacity=2)
+        roots = arena.add_roots([('', 1)])
+        children = arena.add_children([0, 0], [1, 3], [.5, .25])
+        grandchildren = arena.add_children([1, 2, 2], [2, 1, 2], [.4, .2, .1])
+        return arena, roots, children, grandchildren
+
+    def test_strings(self):
+        arena, roots, children, grandchildren = self.make_tree()
+        self.assertEqual(len(arena), 6)
+        self.assertEqual(arena.strings(roots), [''])
+        self.assertEqual(arena.strings(children), ['a', 'c'])
+        self.assertEqual(arena.strings(grandchildren), ['ab', 'ca', 'cb'])
+        self.assertEqual(arena.strings([5, 1, 0]), ['cb', 'a', ''])
+        self.assertEqual(arena.strings([]), [])
+        np.testing.assert_array_equal(arena.probs[grandchildren], [.4, .2, .1])
+
+    def test_roots(self):
+        arena = pwd_frontier.NodeArena('\nabc')
+        roots = arena.add_roots([('ab', .5), ('c', .2)])
+        children = arena.add_children(roots, [3, 1], [.1, .1])
+        self.assertEqual(arena.strings(children), ['abc', 'ca'])
+        self.assertEqual(arena.strings(roots), ['ab', 'c'])
+
+    def test_truncate(self):
+        arena, _, _, _ = self.make_tree()
+        arena.truncate(3)
+        arena.add_children([2], [3], [.3])
+        self.assertEqual(arena.strings([3]), ['cc'])
+
+    def test_compact(self):
+        arena, _, _, _ = self.make_tree()
+        mapping = arena.compact([5])
+        self.assertEqual(len(arena), 3)
+        self.assertEqual(list(mapping), [0, -1, 1, -1, -1, 2])
+        self.assertEqual(arena.strings([2]), ['cb'])
+        self.assertAlmostEqual(arena.probs[2], .1)
+
+    def test_compact_roots(self):
+        arena = pwd_frontier.NodeArena('\nabc')
+        roots = arena.add_roots([('ab', .5), ('c', .2), ('bb', .1)])
+        arena.add_children(roots, [1, 2, 3], [.1, .1, .1])
+        arena.compact([4, 5])
+        self.assertEqual(arena.roots, ['c', 'bb'])
+        self.assertEqual(arena.strings(np.arange(len(arena))),
+                         ['c', 'bb', 'cb', 'bbc'])
+
+    def test_too_many_chars(self):
+        with self.assertRaises(ValueError):
+            pwd_frontier.NodeArena([chr(i) for i in range(300)])
+
+    def test_checkpoint(self):
+        arena, _, _, _ = self.make_tree()
+        with tempfile.TemporaryDirectory() as directory:
+            fname = os.path.join(directory, 'checkpoint')
+            pwd_frontier.save_checkpoint(
+                fname, arena, [(1, 3), (3, 6)], {'generated' : 4})
+            loaded, stack, state = pwd_frontier.load_checkpoint(fname, '\nabc')
+        self.assertEqual(stack, [(1, 3), (3, 6)])
+        self.assertEqual(state, {'generated' : 4})
+        self.assertEqual(loaded.strings(np.arange(6)),
+                         arena.strings(np.arange(6)))
+        np.testing.assert_array_equal(loaded.probs[:6], arena.probs[:6])
+
+class ProbabilityBucketsTest(unittest.TestCase):
+    def test_pop_order(self):
+        buckets = pwd_frontier.ProbabilityBuckets()
+        buckets.push(np.arange(4), np.array([.01, .5, .1, .3]))
+        buckets.push(np.array([4]), np.array([.9]))
+        self.assertEqual(len(buckets), 5)
+        self.assertGreaterEqual(buckets.upper_bound(), .9)
+        self.assertEqual(list(buckets.pop(2)), [4, 1])
+        self.assertGreaterEqual(buckets.upper_bound(), .3)
+        self.assertLess(buckets.upper_bound(), .5)
+        self.assertEqual(list(buckets.pop(10)), [3, 2, 0])
+        self.assertEqual(len(buckets), 0)
+        self.assertEqual(buckets.upper_bound(), 0)
+        self.assertEqual(len(buckets.pop(1)), 0)
+
+    def test_pop_least_probable(self):
+        buckets = pwd_frontier.ProbabilityBuckets()
+        buckets.push(np.arange(4), np.array([.01, .5, .1, .3]))
+        self.assertEqual(list(buckets.pop_least_probable(2)), [0, 2])
+        self.assertEqual(len(buckets), 2)
+        self.assertEqual(list(buckets.pop(2)), [1, 3])
+
+    def test_remap(self):
+        buckets = pwd_frontier.ProbabilityBuckets()
+        buckets.push(np.array([3, 5]), np.array([.5, .1]))
+        buckets.remap(np.array([-1, -1, -1, 0, -1, 1]))
+        self.assertEqual(sorted(buckets.ids()), [0, 1])
+        self.assertEqual(list(buckets.pop(2)), [0, 1])
+
+class FrontierSpillerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_run_file(self):
+        fname = os.path.join(self.directory, 'run')
+        pwd_frontier.write_run(fname, ['', 'ab', 'é'], [.5, .25, .125])
+        self.assertEqual(pwd_frontier.read_run(fname),
+                         [('', .5), ('ab', .25), ('é', .125)])
+
+    def test_load_order(self):
+        spiller = pwd_frontier.FrontierSpiller(
+            os.path.join(self.directory, 'spill'))
+        spiller.spill(['a', 'b'], [.1, .2])
+        spiller.spill(['c'], [.3])
+        spiller.spill([], [])
+        self.assertEqual(len(spiller), 2)
+        self.assertEqual(spiller.max_prob(), .3)
+        self.assertEqual(spiller.load(), [('c', .3)])
+        self.assertEqual(spiller.load(), [('a', .1), ('b', .2)])
+        self.assertEqual(spiller.max_prob(), 0)
+        self.assertEqual(os.listdir(spiller.directory), [])
+
+    def test_cleanup(self):
+        spiller = pwd_frontier.FrontierSpiller(self.directory)
+        spiller.spill(['a'], [.1])
+        spiller.cleanup()
+        self.assertEqual(os.listdir(self.directory), [])
+
+if __name__ == '__main__':
+    unittest.main()
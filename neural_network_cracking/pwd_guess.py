@@ -6,48 +6,35 @@ import argparse
 import bisect
 import cProfile
 import collections
+import concurrent.futures
+import contextlib
 import csv
+import functools
 import gzip
+import heapq
 import itertools
 import json
 import logging
 import math
+import multiprocessing
 import os
 import os.path
+import queue
 import random
 import re
 import string
 import subprocess as subp
 import sys
 import tempfile
+import threading
 import time
 
-
-# This is a hack to support multiple versions of the keras library.
-# It would be better to use a solution like virtualenv.
-if 'KERAS_PATH' in os.environ:
-    sys.path.insert(0, os.environ['KERAS_PATH'])
-import keras
-try:
-    sys.stderr.write('Using keras version %s\n' % (keras.__version__))
-except AttributeError:
-    pass
-
-from keras.models import Sequential, model_from_json
-from keras.layers.core import Activation, Dense, Dropout
-from keras.layers import TimeDistributed, Flatten, Conv1D, recurrent, Embedding
-import keras.utils
-from keras.callbacks import TensorBoard
-
-from sklearn.utils import shuffle
 import numpy as np
-import tensorflow as tf
 from enum import IntEnum
 
-import pylru
-
-
-import generator
+import pwd_frontier
+import pwd_guess_file
+import pwd_inference
 
 PASSWORD_END = '\n'
 PASSWORD_START = '\t'
@@ -55,8 +42,102 @@ SYMBOLS = '~!@#$%^&*(),.<>/?\'"{}[]\\|-_=+;: `'
 FNAME_PREFIX_SUBPROCESS_CONFIG = 'child_process.'
 FNAME_PREFIX_PROCESS_LOG = 'log.child_process.'
 FNAME_PREFIX_PROCESS_OUT = 'out.child_process.'
+FNAME_PARENT_PROCESS_OUT = 'out.parent_process'
+FNAME_SUBPROCESS_ARCH = 'child_process.arch'
+FNAME_SUBPROCESS_WEIGHT = 'child_process.weight'
+# Number of tasks to create per process when parallel guessing. More tasks
+# means smaller subtrees per task and better load balancing.
+PARALLEL_TASKS_PER_CPU = 4
 
 MEMORY_ONLY = ':memory:'
+# Environment variables read by the BLAS libraries when they are loaded
+BLAS_THREAD_VARIABLES = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                         'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+                         'NUMEXPR_NUM_THREADS']
+
+# Threads that BLAS and tensorflow may use, set by limit_cpu_threads
+_cpu_threads = None
+
+def import_keras():
+    """Imports and returns keras.
+
+    keras, tensorflow and sklearn take seconds to import, so they are only
+    imported when a neural network model is built or loaded, not when this
+    module is imported.
+    """
+    if 'keras' not in sys.modules:
+        # This is a hack to support multiple versions of the keras library.
+        # It would be better to use a solution like virtualenv.
+        if 'KERAS_PATH' in os.environ:
+            sys.path.insert(0, os.environ['KERAS_PATH'])
+        import keras
+        try:
+            sys.stderr.write('Using keras version %s\n' % (keras.__version__))
+        except AttributeError:
+            pass
+        if _cpu_threads is not None:
+            limit_tensorflow_threads(keras, _cpu_threads)
+    import keras
+    import keras.utils
+    return keras
+
+def limit_tensorflow_threads(keras, threads):
+    if keras.backend.backend() != 'tensorflow':
+        return
+    import tensorflow as tf
+    # Ops in the password models depend on each other, so one inter op
+    # thread loses little and keeps the total at the limit
+    if hasattr(tf, 'ConfigProto'):
+        session_config = tf.ConfigProto(
+            intra_op_parallelism_threads=threads,
+            inter_op_parallelism_threads=1)
+        keras.backend.set_session(tf.Session(config=session_config))
+    else:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+    logging.info('Tensorflow limited to %d intra op threads and 1 inter op '
+                 'thread', threads)
+
+def limit_cpu_threads(threads):
+    """Limits the threads used by BLAS and tensorflow to threads.
+
+    numpy has already loaded BLAS, which only reads the thread variables when
+    it is loaded, so the running process is limited with threadpoolctl.
+    Processes started later inherit the limit through the environment.
+    tensorflow is limited when keras is imported.
+    """
+    # pylint: disable=global-statement
+    global _cpu_threads
+    _cpu_threads = threads
+    for name in BLAS_THREAD_VARIABLES:
+        os.environ[name] = str(threads)
+    try:
+        import threadpoolctl
+    except ImportError:
+        logging.warning('threadpoolctl is not installed, so BLAS threads are '
+                        'only limited in processes started from now on')
+    else:
+        threadpoolctl.threadpool_limits(threads)
+        for pool in threadpoolctl.threadpool_info():
+            logging.info('%s %s limited to %d threads', pool['user_api'],
+                         pool['internal_api'], pool['num_threads'])
+    if 'keras' in sys.modules:
+        limit_tensorflow_threads(sys.modules['keras'], threads)
+
+@contextlib.contextmanager
+def blas_thread_environment(threads):
+    """Sets the BLAS thread variables for processes started in the block."""
+    old_environ = {name : os.environ.get(name)
+                   for name in BLAS_THREAD_VARIABLES}
+    os.environ.update({name : str(threads) for name in BLAS_THREAD_VARIABLES})
+    try:
+        yield
+    finally:
+        for name, value in old_environ.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
 
 class Sequence(IntEnum):
     MANY_TO_ONE = 0
@@ -76,7 +157,7 @@ def grouper(iterable, num, fillvalue=None):
 
 class CharacterTable():
     def __init__(self, chars, maxlen, embedding=False, padding_character=False,
-                 sequence_model=Sequence.MANY_TO_ONE):
+                 sequence_model=Sequence.MANY_TO_ONE, index_inputs=False):
         self.chars = sorted(set(chars))
         self.char_indices = dict((c, i) for i, c in enumerate(self.chars))
         self.indices_char = dict((i, c) for i, c in enumerate(self.chars))
@@ -86,6 +167,9 @@ class CharacterTable():
         self.padding_character = padding_character
         self.embedding = embedding
         self.sequence_model = sequence_model
+        self.index_inputs = index_inputs
+        self._lookup = None
+        self._buffer = None
 
     def pad_to_len(self, astring, maxlen=None):
         maxlen = maxlen if maxlen else self.maxlen
@@ -95,18 +179,77 @@ class CharacterTable():
             return astring + (PASSWORD_END * (maxlen - len(astring)))
         return astring
 
-    def encode_many(self, string_list, maxlen=None, y_vec=False):
+    def index_lookup(self):
+        # Maps code points to character indices, or to -1 for characters that
+        # are not in the table. This is built on first use because
+        # OptimizingCharacterTable adds to char_indices after the constructor.
+        if self._lookup is None:
+            lookup = np.full(
+                max(ord(c) for c in self.char_indices) + 2, -1, dtype=np.int16)
+            for char, index in self.char_indices.items():
+                lookup[ord(char)] = index
+            self._lookup = lookup
+        return self._lookup
+
+    def encode_indices(self, string_list, maxlen=None):
+        """Returns the character indices of the padded strings.
+
+        The answer is a (len(string_list), maxlen) matrix of indices and a
+        mask of the positions that hold a character.
+        """
         maxlen = maxlen if maxlen else self.maxlen
-        x_str_list = map(lambda x: self.pad_to_len(x, maxlen), string_list)
-        if self.embedding and not y_vec:
+        # Fixed width unicode arrays are utf-32, so viewing them as integers
+        # gives the code points without a loop over characters
+        codes = np.array(
+            [astring[-maxlen:] for astring in string_list],
+            dtype='<U%d' % maxlen).view(np.uint32).reshape(
+                (len(string_list), maxlen))
+        lengths = np.fromiter(map(len, string_list), dtype=np.int64,
+                              count=len(string_list))
+        mask = np.arange(maxlen) < lengths[:, np.newaxis]
+        if self.padding_character:
+            codes[~mask] = ord(PASSWORD_END)
+            mask.fill(True)
+        lookup = self.index_lookup()
+        indices = lookup[np.minimum(codes, len(lookup) - 1)]
+        unknown = mask & (indices < 0)
+        if unknown.any():
+            row, col = np.argwhere(unknown)[0]
+            raise KeyError(chr(codes[row, col]))
+        return indices, mask
+
+    def encode_many(self, string_list, maxlen=None, y_vec=False, out=None):
+        maxlen = maxlen if maxlen else self.maxlen
+        if out is not None:
+            x_vec = out
+        elif (self.embedding or self.index_inputs) and not y_vec:
             x_vec = np.zeros(shape=(len(string_list), maxlen), dtype=np.int8)
         else:
             x_vec = np.zeros((len(string_list), maxlen, self.vocab_size),
                          dtype=np.bool)
-        for i, xstr in enumerate(x_str_list):
-            self.encode_into(x_vec[i], xstr)
+        indices, mask = self.encode_indices(string_list, maxlen)
+        if x_vec.ndim == 2:
+            # Index inputs save 0 for positions without a character
+            if self.index_inputs:
+                indices = indices + 1
+            np.multiply(indices, mask, out=x_vec, casting='unsafe')
+        else:
+            if out is not None:
+                x_vec.fill(0)
+            rows, cols = np.nonzero(mask)
+            x_vec[rows, cols, indices[rows, cols]] = 1
         return x_vec
 
+    def encode_batch(self, string_list):
+        """Same as encode_many, but encodes into a buffer that is reused.
+
+        The answer is only valid until the next call.
+        """
+        if self._buffer is None or len(self._buffer) < len(string_list):
+            self._buffer = self.encode_many([''] * len(string_list))
+        return self.encode_many(
+            string_list, out=self._buffer[:len(string_list)])
+
     def encode_many_chunks(self, string_list, max_input_str_len, maxlen=None, y_vec=False):
         maxlen = maxlen if maxlen else self.maxlen
         chunks_str_list = []
@@ -162,16 +305,18 @@ class CharacterTable():
                 config.get_intermediate_info('rare_character_bag'),
                 config.uppercase_character_optimization,
                 padding_character=config.padding_character,
-                embedding=config.embedding_layer)
+                embedding=config.embedding_layer,
+                index_inputs=config.index_inputs)
 
         return CharacterTable(config.char_bag, config.context_length,
                               padding_character=config.padding_character,
                               embedding=config.embedding_layer,
-                              sequence_model=config.sequence_model)
+                              sequence_model=config.sequence_model,
+                              index_inputs=config.index_inputs)
 
 class OptimizingCharacterTable(CharacterTable):
     def __init__(self, chars, maxlen, rare_characters, uppercase,
-                 embedding=False, padding_character=None):
+                 embedding=False, padding_character=None, index_inputs=False):
         # pylint: disable=too-many-branches
         if uppercase:
             self.rare_characters = ''.join(
@@ -203,7 +348,8 @@ class OptimizingCharacterTable(CharacterTable):
                         "expected %s to be in %s" % (c.lower(), chars))
 
                 self.rare_character_preimage[c.lower()] = [c, c.lower()]
-        super().__init__(char_bag, maxlen, embedding, padding_character)
+        super().__init__(char_bag, maxlen, embedding, padding_character,
+                         index_inputs=index_inputs)
         for key in self.rare_dict:
             self.char_indices[key] = self.char_indices[self.rare_dict[key]]
         translate_table = {}
@@ -226,6 +372,41 @@ class OptimizingCharacterTable(CharacterTable):
         return astring.translate(self.translate_table)
 
 
+def one_hot_weights(vocab_size):
+    """Returns embedding weights that turn index inputs into one-hot vectors.
+
+    Row 0 is for positions without a character and is all zeros, like in the
+    one-hot encoding. Row i + 1 is the one-hot vector of character index i.
+    """
+    return np.vstack([np.zeros((1, vocab_size)), np.eye(vocab_size)])
+
+def one_hot_input_layer(vocab_size, context_length, **kwargs):
+    import_keras()
+    from keras.layers import Embedding
+    return Embedding(vocab_size + 1, vocab_size,
+                     weights=[one_hot_weights(vocab_size)], trainable=False,
+                     input_length=context_length, **kwargs)
+
+def index_input_model(model, vocab_size):
+    """Wraps a model that takes one-hot input so that it takes index input.
+
+    Models that already take index input are returned unchanged.
+    """
+    if isinstance(model, pwd_inference.NumpyModel):
+        if isinstance(model.layers[0], pwd_inference.EmbeddingLayer):
+            return model
+        return pwd_inference.NumpyModel(
+            [('Embedding', {}, [one_hot_weights(vocab_size)])] +
+            model.layer_specs, model.dtype)
+    if len(model.input_shape) == 2:
+        return model
+    keras = import_keras()
+    logging.info('Wrapping one-hot model to take index input')
+    wrapper = keras.models.Sequential()
+    wrapper.add(one_hot_input_layer(vocab_size, model.input_shape[1]))
+    wrapper.add(model)
+    return wrapper
+
 class ModelSerializer():
     def __init__(self,
                  archfile=None,
@@ -234,7 +415,7 @@ class ModelSerializer():
                  multi_gpu=1):
         self.archfile = archfile
         self.weightfile = weightfile
-        self.model_creator_from_json = model_from_json
+        self.model_creator_from_json = None
         self.versioned = versioned
         self.saved_counter = 0
         self.multi_gpu = multi_gpu
@@ -256,10 +437,14 @@ class ModelSerializer():
         logging.info('Done saving model')
 
     def load_model(self):
+        keras = import_keras()
+        model_creator_from_json = self.model_creator_from_json
+        if model_creator_from_json is None:
+            model_creator_from_json = keras.models.model_from_json
         logging.info('Loading model architecture')
         with open(self.archfile, 'r') as arch:
             arch_data = arch.read()
-            model = self.model_creator_from_json(arch_data)
+            model = model_creator_from_json(arch_data)
 
         logging.info('Loading model weights')
         model.load_weights(self.weightfile)
@@ -270,6 +455,11 @@ class ModelSerializer():
 
         return model
 
+    def load_numpy_model(self):
+        logging.info('Loading model for numpy inference')
+        return pwd_inference.NumpyModel.fromFiles(
+            self.archfile, self.weightfile)
+
 class ConfigurationException(Exception):
     pass
 
@@ -337,6 +527,8 @@ class ModelDefaults():
     random_walk_seed_num = 1000
     max_gpu_prediction_size = 25000
     cpu_limit = 8
+    parallel_guessing = False
+    fork_length = 2
     random_walk_confidence_bound_z_value = 1.96
     random_walk_confidence_percent = 5
     random_walk_upper_bound = 10
@@ -366,6 +558,46 @@ class ModelDefaults():
     embedding_size = 8
     previous_probability_mapping_file = None
     probability_calculator_cache_size = 0
+    incremental_inference = False
+    incremental_inference_cache_size = 100000
+    best_first_guessing = False
+    best_first_guess_budget = None
+    max_frontier_nodes = 0
+    guesser_checkpoint_file = None
+    guesser_checkpoint_interval = 3600
+    pool_prediction_batches = False
+    inference_backend = 'keras'
+    compiled_prediction = False
+    prefetch_prediction_input = False
+    index_inputs = False
+    prediction_buckets = None
+    async_guess_writer = False
+    guess_writer_batch_size = 8192
+    guess_writer_queue_size = 8
+    compress_guesses = False
+    binary_guess_block_size = pwd_guess_file.DEFAULT_BLOCK_SIZE
+    binary_guess_log_probs = False
+    sort_guesses = False
+    sort_guesses_run_size = pwd_guess_file.DEFAULT_RUN_SIZE
+    histogram_buckets_per_bit = 16
+    target_guess_count = None
+    target_guess_margin = 2.0
+    threshold_pilot_samples = 10000
+    guessing_time_budget = None
+    progress_file = None
+    progress_interval = 60
+    # Types of the options that default to None, used to convert them in
+    # override_from_commandline
+    _optional_types = {
+        'context_length' : int,
+        'guesser_class' : str,
+        'previous_probability_mapping_file' : str,
+        'best_first_guess_budget' : int,
+        'guesser_checkpoint_file' : str,
+        'target_guess_count' : int,
+        'guessing_time_budget' : float,
+        'progress_file' : str,
+    }
 
     def __init__(self, adict=None, **kwargs):
         self.adict = adict if adict is not None else dict()
@@ -472,6 +704,98 @@ class ModelDefaults():
         if self.context_length > self.max_len:
             raise ConfigurationException('Expected context_length <= max_len')
 
+        if self.parallel_guessing:
+            if self.fork_length <= 0:
+                raise ConfigurationException(
+                    'Expected fork_length > 0 when parallel_guessing is true')
+            if self.cpu_limit <= 0:
+                raise ConfigurationException(
+                    'Expected cpu_limit > 0 when parallel_guessing is true')
+
+        if self.best_first_guessing:
+            if self.parallel_guessing:
+                raise ConfigurationException(
+                    'best_first_guessing does not support parallel_guessing')
+            if (self.best_first_guess_budget is not None and
+                    self.best_first_guess_budget <= 0):
+                raise ConfigurationException(
+                    'Expected best_first_guess_budget > 0')
+
+        if self.guesser_checkpoint_file is not None:
+            if self.parallel_guessing or self.best_first_guessing:
+                raise ConfigurationException(
+                    'guesser_checkpoint_file does not support parallel_guessing '
+                    'or best_first_guessing')
+            if (self.compress_guesses or self.sort_guesses or
+                    self.guess_serialization_method == 'binary'):
+                raise ConfigurationException(
+                    'guesser_checkpoint_file does not support compress_guesses, '
+                    'sort_guesses or the binary guess_serialization_method')
+
+        if self.target_guess_count is not None:
+            if self.target_guess_count <= 0:
+                raise ConfigurationException('Expected target_guess_count > 0')
+            if self.target_guess_margin < 1 or self.threshold_pilot_samples <= 0:
+                raise ConfigurationException(
+                    'Expected target_guess_margin >= 1 and '
+                    'threshold_pilot_samples > 0')
+            if (self.rare_character_optimization_guessing or
+                    self.guess_serialization_method in [
+                        'random_walk', 'delamico_random_walk',
+                        'generate_random']):
+                raise ConfigurationException(
+                    'target_guess_count does not support '
+                    'rare_character_optimization_guessing or random walks')
+        if (self.guessing_time_budget is not None and
+                self.guessing_time_budget <= 0):
+            raise ConfigurationException('Expected guessing_time_budget > 0')
+        if self.parallel_guessing and (
+                self.target_guess_count is not None or
+                self.guessing_time_budget is not None):
+            raise ConfigurationException(
+                'parallel_guessing does not support target_guess_count or '
+                'guessing_time_budget')
+
+        if self.progress_file is not None:
+            if self.parallel_guessing:
+                raise ConfigurationException(
+                    'parallel_guessing does not support progress_file')
+            if self.progress_interval < 0:
+                raise ConfigurationException('Expected progress_interval >= 0')
+
+        if (self.guess_serialization_method == 'histogram' and
+                self.histogram_buckets_per_bit <= 0):
+            raise ConfigurationException(
+                'Expected histogram_buckets_per_bit > 0')
+
+        if self.sort_guesses:
+            if self.guess_serialization_method not in ['human', 'binary']:
+                raise ConfigurationException(
+                    "sort_guesses requires the 'human' or 'binary' "
+                    'guess_serialization_method')
+            if self.async_guess_writer:
+                raise ConfigurationException(
+                    'sort_guesses and async_guess_writer cannot both be used')
+            if self.sort_guesses_run_size <= 0:
+                raise ConfigurationException(
+                    'Expected sort_guesses_run_size > 0')
+
+        if self.async_guess_writer:
+            if self.guess_serialization_method != 'human':
+                raise ConfigurationException(
+                    "async_guess_writer requires the 'human' "
+                    'guess_serialization_method')
+            if (self.guess_writer_batch_size <= 0 or
+                    self.guess_writer_queue_size <= 0):
+                raise ConfigurationException(
+                    'Expected guess_writer_batch_size > 0 and '
+                    'guess_writer_queue_size > 0')
+
+        if (self.max_frontier_nodes != 0 and
+                self.max_frontier_nodes < 2 * self.chunk_size_guesser):
+            raise ConfigurationException(
+                'Expected max_frontier_nodes >= 2 * chunk_size_guesser')
+
         if self.training_main_memory_chunksize <= self.training_chunk:
             raise ConfigurationException(
                 'Expected training_main_memory_chunksize > training_chunk')
@@ -487,6 +811,37 @@ class ModelDefaults():
                 "Configuration parameter 'sequence_model' can only be "
                 "'many_to_many' or 'many_to_one'")
 
+        if self.incremental_inference:
+            if self.sequence_model != Sequence.MANY_TO_ONE:
+                raise ConfigurationException(
+                    'incremental_inference requires a many_to_one model')
+            if self.model_type not in ['LSTM', 'GRU']:
+                raise ConfigurationException(
+                    'incremental_inference requires an LSTM or GRU model')
+            if self.train_backwards:
+                raise ConfigurationException(
+                    'incremental_inference does not support train_backwards')
+
+        if self.inference_backend not in ['keras', 'numpy']:
+            raise ConfigurationException(
+                "inference_backend can only be 'keras' or 'numpy'")
+        if self.index_inputs and self.embedding_layer:
+            raise ConfigurationException(
+                'index_inputs cannot be used with embedding_layer')
+        if self.compiled_prediction:
+            if self.sequence_model != Sequence.MANY_TO_ONE:
+                raise ConfigurationException(
+                    'compiled_prediction requires a many_to_one model')
+            if self.incremental_inference:
+                raise ConfigurationException(
+                    'compiled_prediction and incremental_inference cannot '
+                    'both be used')
+        if self.prediction_buckets is not None and (
+                len(self.prediction_buckets) == 0 or
+                min(self.prediction_buckets) <= 0):
+            raise ConfigurationException(
+                'Expected prediction_buckets to be a list of positive sizes')
+
     def as_dict(self):
         answer = dict(vars(ModelDefaults).copy())
         answer.update(self.adict)
@@ -514,7 +869,10 @@ class ModelDefaults():
             if not keyval:
                 continue
             key, _, value = keyval.partition('=')
-            answer[key] = type(getattr(self, key))(value)
+            if key in self._optional_types:
+                answer[key] = self._optional_types[key](value)
+            else:
+                answer[key] = type(getattr(self, key))(value)
         self.adict.update(answer)
 
     def sequence_model_updates(self):
@@ -654,6 +1012,8 @@ class Trainer():
         self.poor_batches_early_stopping = 0
         self.smoothened_loss = collections.deque(maxlen=int(config.chunk_print_interval))
         if config.tensorboard:
+            import_keras()
+            from keras.callbacks import TensorBoard
             self.callback = TensorBoard(config.tensorboard_dir)
             self.train_log_names = []
             self.test_log_names = []
@@ -673,18 +1033,29 @@ class Trainer():
         weight_vec = np.zeros((len(weight_list)))
         for i, weight in enumerate(weight_list):
             weight_vec[i] = weight
+        from sklearn.utils import shuffle
         return shuffle(x_vec, y_vec, weight_vec)
 
     def prepare_x_data(self, x_strs):
         return self.ctable.encode_many(x_strs)
 
     def prepare_y_data(self, y_str_list):
+        if self.config.index_inputs:
+            # Sparse labels for sparse_categorical_crossentropy
+            return self.ctable.encode_indices(y_str_list, 1)[0].astype(np.int8)
         y_vec = np.zeros((len(y_str_list), self.ctable.vocab_size),
                          dtype=np.bool)
         self.ctable.y_encode_into(y_vec, y_str_list)
         return y_vec
 
+    def loss_function(self):
+        if self.config.index_inputs:
+            return 'sparse_categorical_crossentropy'
+        return 'categorical_crossentropy'
+
     def _make_layer(self, **kwargs):
+        import_keras()
+        from keras.layers import Conv1D, recurrent
         recurrent_train_backwards = self.config.train_backwards
         model_type = self.config.model_type
         hidden_size = self.config.hidden_size
@@ -711,6 +1082,10 @@ class Trainer():
         raise ConfigurationException('Unknown model_type: %s' % model_type)
 
     def _return_model(self):
+        import_keras()
+        from keras.models import Sequential
+        from keras.layers.core import Dense, Dropout
+        from keras.layers import Embedding, Flatten
         model = Sequential()
 
         # Add the first input layer. If embedding is enabled, we add a different
@@ -723,6 +1098,10 @@ class Trainer():
                     input_length=self.config.context_length))
 
             self.feature_layers.append(self._make_layer())
+        elif self.config.index_inputs:
+            self.feature_layers.append(one_hot_input_layer(
+                self.ctable.vocab_size, self.config.context_length))
+            self.feature_layers.append(self._make_layer())
         else:
             self.feature_layers.append(
                 self._make_layer(
@@ -760,8 +1139,9 @@ class Trainer():
         return model
 
     def build_model(self, model=None):
-
+        keras = import_keras()
         if self.multi_gpu >= 2:
+            import tensorflow as tf
             with tf.device('/cpu:0'):
                 if model is None:
                     model = self._return_model()
@@ -778,7 +1158,7 @@ class Trainer():
             self.train_log_names = ['train_' + name for name in tensorboard_metrics]
             self.test_log_names = ['test_' + name for name in tensorboard_metrics]
 
-        model.compile(loss='categorical_crossentropy',
+        model.compile(loss=self.loss_function(),
                       optimizer=self.config.model_optimizer,
                       metrics=metrics)
         self.model = model
@@ -787,6 +1167,9 @@ class Trainer():
         assert self.model is not None
         assert len(self.classification_layers) == 0
         assert len(self.feature_layers) == 0
+        import_keras()
+        from keras.layers.core import Activation, Dense
+        from keras.layers import TimeDistributed
         for layer in self.model.layers:
             if isinstance(layer, (TimeDistributed, Activation, Dense)):
                 self.classification_layers.append(layer)
@@ -921,6 +1304,7 @@ class Trainer():
 
     def write_log(self, names, logs, batch_no):
         assert self.callback
+        import tensorflow as tf
         for name, value in zip(names, logs):
             summary = tf.Summary()
             summary_value = summary.value.add()
@@ -930,7 +1314,16 @@ class Trainer():
 
 
 class ManyToManyTrainer(Trainer):
+    def loss_function(self):
+        # Labels stay one-hot because positions without a character have an
+        # all zero label, which a sparse label cannot express
+        return 'categorical_crossentropy'
+
     def _return_model(self):
+        import_keras()
+        from keras.models import Sequential
+        from keras.layers.core import Dense, Dropout
+        from keras.layers import Embedding, TimeDistributed
         model = Sequential()
 
         # Add the first input layer. If embedding is enabled, we add a different
@@ -943,6 +1336,10 @@ class ManyToManyTrainer(Trainer):
                     input_length=self.config.context_length))
 
             self.feature_layers.append(self._make_layer())
+        elif self.config.index_inputs:
+            self.feature_layers.append(one_hot_input_layer(
+                self.ctable.vocab_size, self.config.context_length))
+            self.feature_layers.append(self._make_layer())
         else:
             self.feature_layers.append(
                 self._make_layer(
@@ -982,6 +1379,7 @@ class ManyToManyTrainer(Trainer):
         weight_vec = np.zeros((len(weight_list)))
         for i, weight in enumerate(weight_list):
             weight_vec[i] = weight
+        from sklearn.utils import shuffle
         return shuffle(x_vec, y_vec, weight_vec)
 
     def prepare_y_data(self, y_str_list):
@@ -1166,6 +1564,7 @@ class Filterer():
         self.min_len = config.min_len
         self.uniquify = uniquify
         self.seen = set()
+        self._bag_lookup = None
 
     @staticmethod
     def inc_frequencies(adict, pwd):
@@ -1197,6 +1596,32 @@ class Filterer():
         self.longest_pwd = max(self.longest_pwd, len(pwd))
         return answer
 
+    def pwd_is_valid_many(self, pwds):
+        """Same as pwd_is_valid with quick=True for every password.
+
+        Returns an array of booleans.
+        """
+        if self.uniquify:
+            return np.array([self.pwd_is_valid(pwd, quick=True)
+                             for pwd in pwds], dtype=bool)
+        pwds = [(''.join(pwd) if isinstance(pwd, tuple) else pwd).strip(
+            PASSWORD_END) for pwd in pwds]
+        lengths = np.fromiter(map(len, pwds), dtype=np.int64, count=len(pwds))
+        answer = (lengths <= self.max_len) & (lengths >= self.min_len)
+        width = int(lengths.max()) if len(pwds) > 0 else 0
+        if width == 0:
+            return answer
+        if self._bag_lookup is None:
+            self._bag_lookup = np.zeros(
+                max(map(ord, self.char_bag), default=0) + 2, dtype=bool)
+            self._bag_lookup[[ord(c) for c in self.char_bag]] = True
+        codes = np.array(pwds, dtype='<U%d' % width).view(np.uint32).reshape(
+            (len(pwds), width))
+        in_bag = self._bag_lookup[
+            np.minimum(codes, len(self._bag_lookup) - 1)]
+        in_bag |= np.arange(width) >= lengths[:, np.newaxis]
+        return answer & in_bag.all(axis=1)
+
     def rare_characters(self):
         lowest = list(map(
             lambda x: x[0],
@@ -1273,9 +1698,19 @@ class GuessSerializer():
         self.total_guessed += 1
         self.ostream.write('%s\t%s\n' % (password, prob))
 
+    def serialize_many(self, passwords, probs):
+        for password, prob in zip(passwords, probs):
+            self.serialize(password, prob)
+
     def get_total_guessed(self):
         return self.total_guessed
 
+    def get_state(self):
+        return {'total_guessed' : self.total_guessed}
+
+    def set_state(self, state):
+        self.total_guessed = state['total_guessed']
+
     def collect_answer(self, real_output, istream):
         for line in istream:
             real_output.write(line)
@@ -1287,6 +1722,9 @@ class GuessSerializer():
     def get_stats(self):
         raise NotImplementedError()
 
+    def flush(self):
+        self.ostream.flush()
+
     def finish(self):
         self.ostream.flush()
         # self.ostream.close() # TODO: We need to close this at some later point...
@@ -1301,15 +1739,200 @@ class DelegatingSerializer():
     def collect_answer(self, real_output, istream):
         self.serializer.collect_answer(real_output, istream)
 
+    def serialize_many(self, passwords, probs):
+        for password, prob in zip(passwords, probs):
+            self.serialize(password, prob)
+
     def get_total_guessed(self):
         return self.serializer.get_total_guessed()
 
+    def get_state(self):
+        return self.serializer.get_state()
+
+    def set_state(self, state):
+        self.serializer.set_state(state)
+
     def get_stats(self):
         return self.serializer.get_stats()
 
+    def flush(self):
+        self.serializer.flush()
+
     def finish(self):
         self.serializer.finish()
 
+def nonzero_guesses(passwords, probs):
+    """Drops guesses with probability 0 and joins tuple passwords."""
+    kept = [(''.join(password) if isinstance(password, tuple)
+             else password, prob)
+            for password, prob in zip(passwords, probs) if prob != 0]
+    return [password for password, _ in kept], [prob for _, prob in kept]
+
+class BinaryGuessSerializer(GuessSerializer):
+    """Writes guesses in the binary format of pwd_guess_file."""
+    def __init__(self, ostream, block_size=pwd_guess_file.DEFAULT_BLOCK_SIZE,
+                 log_probs=False):
+        super().__init__(ostream)
+        self.writer = pwd_guess_file.BinaryGuessWriter(
+            getattr(ostream, 'buffer', ostream), block_size, log_probs)
+
+    def serialize(self, password, prob):
+        self.serialize_many([password], [prob])
+
+    def serialize_many(self, passwords, probs):
+        passwords, probs = nonzero_guesses(passwords, probs)
+        self.total_guessed += len(passwords)
+        self.writer.write(passwords, probs)
+
+    def collect_answer(self, real_output, istream):
+        with pwd_guess_file.BinaryGuessReader(istream) as reader:
+            for i in range(reader.num_blocks()):
+                self.writer.write_compressed_block(*reader.compressed_block(i))
+
+    def finish_collecting(self, real_output):
+        self.writer.close()
+        super().finish_collecting(real_output)
+
+    def finish(self):
+        self.writer.close()
+        super().finish()
+
+class SortingGuessSerializer(GuessSerializer):
+    """Writes guesses in descending order of probability when finished.
+
+    Guesses are sorted in runs of run_size and the runs are spilled to
+    directory, so memory use does not depend on the number of guesses. Text
+    output has the guess number as a third column. With binary true the
+    output is in the binary format of pwd_guess_file.
+    """
+    def __init__(self, ostream, directory=None,
+                 run_size=pwd_guess_file.DEFAULT_RUN_SIZE, binary=False,
+                 block_size=pwd_guess_file.DEFAULT_BLOCK_SIZE, log_probs=False):
+        super().__init__(ostream)
+        self.sorter = pwd_guess_file.ExternalGuessSorter(directory, run_size)
+        self.binary = binary
+        self.block_size = block_size
+        self.log_probs = log_probs
+        self.finished = False
+
+    def serialize(self, password, prob):
+        self.serialize_many([password], [prob])
+
+    def serialize_many(self, passwords, probs):
+        passwords, probs = nonzero_guesses(passwords, probs)
+        self.total_guessed += len(passwords)
+        self.sorter.add(passwords, probs)
+
+    def collect_answer(self, real_output, istream):
+        # Output of a child serializer is already sorted
+        self.sorter.add_sorted(pwd_guess_file.read_guesses(istream))
+
+    def finish_collecting(self, real_output):
+        logging.info('Merging sorted child output')
+        self.finish()
+
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        pwd_guess_file.write_sorted(
+            self.sorter, self.ostream, self.binary, self.block_size,
+            self.log_probs)
+
+class AsyncGuessSerializer(GuessSerializer):
+    """Writes guesses in the same format as GuessSerializer, but on a thread.
+
+    Guesses are collected into batches of batch_size and handed to a writer
+    thread, which formats each batch and writes it as one block. At most
+    queue_size batches wait in the queue, after that serialize blocks until
+    the writer catches up, so memory stays bounded when the disk is slow.
+    """
+    def __init__(self, ostream, batch_size=8192, queue_size=8):
+        super().__init__(ostream)
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.passwords = []
+        self.probs = []
+        self.thread = None
+        self.error = None
+
+    def serialize(self, password, prob):
+        if prob == 0:
+            return
+        if isinstance(password, tuple):
+            password = ''.join(password)
+        self.total_guessed += 1
+        self.passwords.append(password)
+        self.probs.append(prob)
+        if len(self.passwords) >= self.batch_size:
+            self.send_batch()
+
+    def send_batch(self):
+        if len(self.passwords) == 0:
+            return
+        self.put((self.passwords, self.probs))
+        self.passwords, self.probs = [], []
+
+    def put(self, item):
+        if self.thread is None:
+            # Started lazily so that no thread is running when workers fork
+            self.thread = threading.Thread(
+                target=self.write_blocks, name='guess-writer', daemon=True)
+            self.thread.start()
+        self.queue.put(item)
+        self.check_error()
+
+    def write_blocks(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                if self.error is not None:
+                    continue
+                if isinstance(item, str):
+                    self.ostream.write(item)
+                else:
+                    passwords, probs = item
+                    self.ostream.write(''.join([
+                        '%s\t%s\n' % pair for pair in zip(passwords, probs)]))
+            except Exception as e: # pylint: disable=broad-except
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def check_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def collect_answer(self, real_output, istream):
+        if real_output is not self.ostream:
+            super().collect_answer(real_output, istream)
+            return
+        block = istream.read(1 << 20)
+        while block:
+            self.put(block)
+            block = istream.read(1 << 20)
+
+    def finish_collecting(self, real_output):
+        self.flush()
+        super().finish_collecting(real_output)
+
+    def flush(self):
+        """Waits until every guess so far is written and flushes the stream."""
+        self.send_batch()
+        if self.thread is not None:
+            self.queue.join()
+        self.check_error()
+        self.ostream.flush()
+
+    def finish(self):
+        self.flush()
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
 class GuessNumberGenerator(GuessSerializer):
     def __init__(self, ostream, pwd_list):
         super().__init__(ostream)
@@ -1327,6 +1950,15 @@ class GuessNumberGenerator(GuessSerializer):
         if idx >= 0:
             self.guess_numbers[idx] += 1
 
+    def get_state(self):
+        answer = super().get_state()
+        answer['guess_numbers'] = self.guess_numbers
+        return answer
+
+    def set_state(self, state):
+        super().set_state(state)
+        self.guess_numbers = state['guess_numbers']
+
     def collect_answer(self, real_output, istream):
         lineOne = istream.readline()
         total_count = int(self.TOTAL_COUNT_RE.match(lineOne).groups(0)[0])
@@ -1338,8 +1970,6 @@ class GuessNumberGenerator(GuessSerializer):
                 assert self.collected_probs[pwd] == prob
             else:
                 self.collected_probs[pwd] = prob
-            if freq_num >= total_count:
-                continue
             self.collected_freqs[pwd] += freq_num
 
     def write_to_file(self, ostream, total_count, get_freq):
@@ -1374,6 +2004,94 @@ class GuessNumberGenerator(GuessSerializer):
     def get_stats(self):
         raise NotImplementedError()
 
+class ProbabilityHistogramSerializer(GuessSerializer):
+    """Counts guesses by probability instead of writing them.
+
+    Guesses are counted in buckets that are 1 / buckets_per_bit wide in log2
+    probability, and exactly for every probability in steps. finish writes a
+    TSV of (label, probability, number of guesses more probable), which is the
+    format read by Guesser.read_guess_number_cache. Bucket rows are labeled
+    with their probability. Step rows are exact, bucket rows may count guesses
+    that are within rounding error of the bucket edge.
+    """
+    def __init__(self, ostream, steps=None, buckets_per_bit=16):
+        super().__init__(ostream)
+        self.buckets_per_bit = buckets_per_bit
+        self.steps = np.sort(np.asarray(
+            steps if steps else [], dtype=np.float64))
+        self.step_counts = np.zeros(len(self.steps), dtype=np.int64)
+        self.bucket_counts = np.zeros(0, dtype=np.int64)
+        self.collected = []
+
+    def serialize(self, password, prob):
+        self.serialize_many([password], [prob])
+
+    def serialize_many(self, passwords, probs):
+        probs = np.asarray(probs, dtype=np.float64)
+        probs = probs[probs != 0]
+        if len(probs) == 0:
+            return
+        self.total_guessed += len(probs)
+        buckets = np.floor(np.maximum(-np.log2(probs), 0) *
+                           self.buckets_per_bit).astype(np.int64)
+        counts = np.bincount(buckets)
+        if len(counts) > len(self.bucket_counts):
+            counts[:len(self.bucket_counts)] += self.bucket_counts
+            self.bucket_counts = counts
+        else:
+            self.bucket_counts[:len(counts)] += counts
+        # Number of steps below each guess
+        below = np.searchsorted(self.steps, probs, side='left')
+        self.step_counts += np.bincount(
+            below, minlength=len(self.steps) + 1)[1:][::-1].cumsum()[::-1]
+
+    def rows(self):
+        """Returns (label, probability, guess number) most probable first."""
+        edges = np.exp2(-np.arange(1, len(self.bucket_counts) + 1) /
+                        self.buckets_per_bit)
+        counts = dict(zip(edges.tolist(),
+                          np.cumsum(self.bucket_counts).tolist()))
+        # Steps are exact, so they replace bucket edges at the same probability
+        counts.update(zip(self.steps.tolist(), self.step_counts.tolist()))
+        return [('%s' % prob, prob, counts[prob])
+                for prob in sorted(counts, reverse=True)]
+
+    def get_state(self):
+        answer = super().get_state()
+        answer['bucket_counts'] = self.bucket_counts.tolist()
+        answer['step_counts'] = self.step_counts.tolist()
+        return answer
+
+    def set_state(self, state):
+        super().set_state(state)
+        self.bucket_counts = np.array(state['bucket_counts'], dtype=np.int64)
+        self.step_counts = np.array(state['step_counts'], dtype=np.int64)
+
+    def collect_answer(self, real_output, istream):
+        self.collected.append(dict(
+            (float(row[1]), int(row[2]))
+            for row in csv.reader(istream, delimiter='\t', quotechar=None)))
+
+    def finish_collecting(self, real_output):
+        # Every child counts at the same bucket edges and steps. A child has
+        # no row for edges less probable than all of its guesses, there its
+        # count is all of its guesses.
+        probs = sorted(set(prob for table in self.collected
+                           for prob in table), reverse=True)
+        totals = [max(table.values(), default=0) for table in self.collected]
+        writer = csv.writer(real_output, delimiter='\t', quotechar=None)
+        for prob in probs:
+            writer.writerow(['%s' % prob, prob, sum(
+                table.get(prob, total)
+                for table, total in zip(self.collected, totals))])
+        super().finish_collecting(real_output)
+
+    def finish(self):
+        logging.info('Counted %s guesses', self.total_guessed)
+        writer = csv.writer(self.ostream, delimiter='\t', quotechar=None)
+        writer.writerows(self.rows())
+        self.ostream.flush()
+
 class ProbabilityCalculator():
     def __init__(self, guesser, prefixes=False, cache_size=0):
         self.guesser = guesser
@@ -1384,6 +2102,7 @@ class ProbabilityCalculator():
         self.prefixes = prefixes
         self._cache_size = cache_size
         if cache_size > 0:
+            import pylru
             self._prob_batch_cache = pylru.lrucache(cache_size)
         else:
             self._prob_batch_cache = None
@@ -1424,7 +2143,7 @@ class ProbabilityCalculator():
             probs = self._cached_batch_prob(x_strings)
             assert len(probs) == len(x_strings)
             for i, y_idx in enumerate(y_indices):
-                prob = np.asscalar(probs[i][0][y_idx])
+                prob = probs[i][0][y_idx].item()
                 yield x_strings[i], y_strings[i], prob
 
             x_strings, y_strings, _ = self.preproc.next_chunk()
@@ -1459,7 +2178,7 @@ class ManyToManyProbabilityCalculator(ProbabilityCalculator):
                 for j, y_idx in enumerate(y_indices[i]):
                     if j == len(x_strings[i]):
                         break
-                    yield x_strings[i], y_strings[i][j], np.asscalar(probs[i][j][y_idx])
+                    yield x_strings[i], y_strings[i][j], probs[i][j][y_idx].item()
             x_strings, y_strings, _ = self.preproc.next_chunk()
 
 class PasswordTemplateSerializer(DelegatingSerializer):
@@ -1716,6 +2435,174 @@ class PasswordPolicyEnforcingSerializer(DelegatingSerializer):
             self.serializer.serialize(pwd, 0)
 
 
+class PredictionBatchStats():
+    """Counts how full the batches sent to the model are.
+
+    Fill is the batch size divided by max_gpu_prediction_size. Batches larger
+    than that are split before prediction and count as several batches.
+    """
+    BUCKETS = 10
+
+    def __init__(self, max_batch_size):
+        self.max_batch_size = max_batch_size
+        self.batches = 0
+        self.rows = 0
+        self.histogram = [0] * self.BUCKETS
+
+    def add(self, size):
+        if size == 0:
+            return
+        full, rest = divmod(size, self.max_batch_size)
+        self.histogram[-1] += full
+        if rest > 0:
+            self.histogram[
+                min(rest * self.BUCKETS // self.max_batch_size,
+                    self.BUCKETS - 1)] += 1
+        self.batches += full + (1 if rest > 0 else 0)
+        self.rows += size
+
+    def mean_fill(self):
+        if self.batches == 0:
+            return 0
+        return self.rows / (self.batches * self.max_batch_size)
+
+    def log(self):
+        logging.info(
+            'Made %s predictions in %s batches, mean batch fill %.3f, '
+            'batches by fill decile %s', self.rows, self.batches,
+            self.mean_fill(), self.histogram)
+
+def make_keras_predict_function(model):
+    """Builds the backend function for the forward pass of model once."""
+    backend = import_keras().backend
+    if getattr(model, 'uses_learning_phase', False):
+        function = backend.function(
+            [model.input, backend.learning_phase()], [model.output])
+        return lambda x_vec: function([x_vec, 0])[0]
+    function = backend.function([model.input], [model.output])
+    return lambda x_vec: function([x_vec])[0]
+
+class BucketedPredictor():
+    """Predicts with a function that only ever sees a few batch sizes.
+
+    Each batch is padded up to the smallest bucket that holds it, and batches
+    larger than the largest bucket are split. Every bucket has an input buffer
+    that is allocated once and reused, and the rows past the end of the batch
+    are ignored.
+    """
+    def __init__(self, predict_fn, ctable, buckets, dtype=None):
+        self.predict_fn = predict_fn
+        self.ctable = ctable
+        self.buckets = sorted(set(buckets))
+        self.buffers = {}
+        for size in self.buckets:
+            buffer = ctable.encode_many([''] * size)
+            if dtype is not None:
+                buffer = buffer.astype(dtype)
+            self.buffers[size] = buffer
+
+    def warmup(self):
+        for size in self.buckets:
+            start = time.time()
+            self.predict_fn(self.buffers[size])
+            logging.info('Warmed up prediction for batch size %d in %.3f '
+                         'seconds', size, time.time() - start)
+
+    def predict(self, astring_list):
+        largest = self.buckets[-1]
+        answers = []
+        for start in range(0, len(astring_list), largest):
+            chunk = astring_list[start:start + largest]
+            buffer = self.buffers[
+                self.buckets[bisect.bisect_left(self.buckets, len(chunk))]]
+            self.ctable.encode_many(chunk, out=buffer[:len(chunk)])
+            answers.append(self.predict_fn(buffer)[:len(chunk)])
+        if len(answers) == 0:
+            return np.zeros((0, self.ctable.vocab_size))
+        if len(answers) == 1:
+            return answers[0]
+        return np.concatenate(answers)
+
+class ProgressReporter():
+    """Writes guessing progress as JSON lines every interval seconds.
+
+    The probability mass of the guessing tree starts in its root. Expanding a
+    node moves its mass to its children, to passwords that end there or, below
+    the threshold, to pruned. The mass still on the frontier is what is left to
+    explore, so the time to finish is estimated from the rate that mass leaves
+    it. Low probability parts of the tree have more nodes per unit of mass, so
+    the estimate is optimistic early on.
+    """
+    def __init__(self, ostream, interval, guesses=0, batches=0):
+        self.ostream = ostream
+        self.interval = interval
+        self.total_mass = 0
+        self.emitted_mass = 0
+        self.pruned_mass = 0
+        self.nodes = 0
+        self.start_time = time.time()
+        self.start_done_mass = 0
+        self.last = (self.start_time, 0, guesses, batches)
+
+    def start(self, mass):
+        self.total_mass = mass
+
+    def get_state(self):
+        return {'total_mass' : self.total_mass,
+                'emitted_mass' : self.emitted_mass,
+                'pruned_mass' : self.pruned_mass,
+                'nodes' : self.nodes}
+
+    def set_state(self, state):
+        self.total_mass = state['total_mass']
+        self.emitted_mass = state['emitted_mass']
+        self.pruned_mass = state['pruned_mass']
+        self.nodes = state['nodes']
+        self.start_done_mass = self.done_mass()
+
+    def expanded(self, nodes, mass, emitted_mass, child_mass):
+        self.nodes += nodes
+        self.emitted_mass += emitted_mass
+        self.pruned_mass += max(0, mass - emitted_mass - child_mass)
+
+    def done_mass(self):
+        return self.emitted_mass + self.pruned_mass
+
+    def frontier_mass(self):
+        return max(0, self.total_mass - self.done_mass())
+
+    def eta(self, now):
+        done = self.done_mass() - self.start_done_mass
+        if done <= 0:
+            return None
+        return (now - self.start_time) * self.frontier_mass() / done
+
+    def report(self, guesses, batches, final=False):
+        now = time.time()
+        last_time, last_nodes, last_guesses, last_batches = self.last
+        if not final and now - last_time < self.interval:
+            return
+        elapsed = max(now - last_time, 1e-9)
+        self.last = (now, self.nodes, guesses, batches)
+        self.ostream.write(json.dumps({
+            'time' : now,
+            'elapsed' : now - self.start_time,
+            'nodes' : self.nodes,
+            'guesses' : guesses,
+            'batches' : batches,
+            'nodes_per_s' : (self.nodes - last_nodes) / elapsed,
+            'guesses_per_s' : (guesses - last_guesses) / elapsed,
+            'batches_per_s' : (batches - last_batches) / elapsed,
+            'emitted_mass' : self.emitted_mass,
+            'pruned_mass' : self.pruned_mass,
+            'frontier_mass' : self.frontier_mass(),
+            'done_fraction' : (min(1, self.done_mass() / self.total_mass)
+                               if self.total_mass > 0 else 1),
+            'eta' : 0 if final else self.eta(now),
+            'final' : final,
+        }) + '\n')
+        self.ostream.flush()
+
 class Guesser():
     def __init__(self, model, config, ostream=None):
         self.model = model
@@ -1727,16 +2614,77 @@ class Guesser():
         self.relevel_not_matching_passwords = (
             config.relevel_not_matching_passwords)
         self.generated = 0
+        self.guess_budget = config.target_guess_count
+        self.deadline = None
         self.ctable = CharacterTable.fromConfig(self.config)
         self.filterer = Filterer(self.config)
         self.chunk_size_guesser = self.config.chunk_size_guesser
         self.ostream = ostream
         self.chars_list = self.ctable.char_list
         self._calc_prob_cache = None
+        self._next_char_expander = None
+        self.last_checkpoint = time.time()
+        self.batch_target = (self.max_gpu_prediction_size
+                             if config.pool_prediction_batches else 0)
+        self.batch_stats = PredictionBatchStats(self.max_gpu_prediction_size)
         self.should_make_guesses_rare_char_optimizer = (
             self._should_make_guesses_rare_char_optimizer())
+        if config.index_inputs:
+            self.model = index_input_model(model, self.ctable.vocab_size)
+        self.incremental_predictor = None
+        if config.incremental_inference:
+            self.incremental_predictor = self.make_incremental_predictor()
+        self.bucketed_predictor = None
+        if config.compiled_prediction:
+            self.bucketed_predictor = self.make_bucketed_predictor()
         self.output_serializer = self.make_serializer()
         self.pwd_end_idx = self.chars_list.index(PASSWORD_END)
+        self.progress = None
+
+    def prediction_buckets(self):
+        if self.config.prediction_buckets is not None:
+            return self.config.prediction_buckets
+        # Halve the largest batch down to a minimum size, so that no batch is
+        # padded to more than twice its size
+        size = max(self.chunk_size_guesser, self.batch_target)
+        buckets = [size]
+        while size // 2 >= 32:
+            size //= 2
+            buckets.append(size)
+        return buckets
+
+    def make_bucketed_predictor(self):
+        if isinstance(self.model, pwd_inference.NumpyModel):
+            predict_fn = self.model.forward
+            dtype = (None if self.config.embedding_layer or
+                     self.config.index_inputs else self.model.dtype)
+        else:
+            predict_fn = make_keras_predict_function(self.model)
+            dtype = import_keras().backend.dtype(self.model.input)
+        buckets = self.prediction_buckets()
+        logging.info('Using compiled prediction with batch sizes %s', buckets)
+        predictor = BucketedPredictor(predict_fn, self.ctable, buckets, dtype)
+        predictor.warmup()
+        return predictor
+
+    def make_incremental_predictor(self):
+        model = self.model
+        if not isinstance(model, pwd_inference.NumpyModel):
+            model = pwd_inference.NumpyModel.fromKerasModel(model)
+        char_indices = self.ctable.char_indices
+        if self.config.index_inputs:
+            char_indices = {char : index + 1
+                            for char, index in char_indices.items()}
+        if self.config.padding_character:
+            pad_index = char_indices[PASSWORD_END]
+        elif self.config.embedding_layer or self.config.index_inputs:
+            pad_index = 0
+        else:
+            pad_index = -1
+        logging.info('Using incremental inference')
+        return pwd_inference.IncrementalPredictor(
+            model, char_indices, self.config.context_length,
+            pad_index, self.config.incremental_inference_cache_size)
 
     def read_test_passwords(self):
         logging.info('Reading password calculator test set...')
@@ -1777,20 +2725,40 @@ class Guesser():
                  self.config.rare_character_optimization) and
                 self.config.rare_character_optimization_guessing)
 
-    def make_serializer(self, method=None, make_rare=None):
+    def make_serializer(self, method=None, make_rare=None, ostream=None):
         if method is None:
             method = self.config.guess_serialization_method
         if make_rare is None:
             make_rare = self.should_make_guesses_rare_char_optimizer
+        if ostream is None:
+            ostream = self.ostream
         serializer_factory = serializer_type_list[method]
-        if method == 'calculator':
+        if self.config.sort_guesses:
+            answer = SortingGuessSerializer(
+                ostream, self.config.guesser_intermediate_directory,
+                self.config.sort_guesses_run_size, method == 'binary',
+                self.config.binary_guess_block_size,
+                self.config.binary_guess_log_probs)
+        elif method == 'calculator':
             answer = serializer_factory(
-                self.ostream, self.calculate_probs_from_file())
+                ostream, self.calculate_probs_from_file())
         elif method == 'delamico_random_walk':
             answer = serializer_factory(
-                self.ostream, self.calculate_probs_from_file(), self.config)
+                ostream, self.calculate_probs_from_file(), self.config)
+        elif method == 'histogram':
+            answer = serializer_factory(
+                ostream, self.config.probability_steps,
+                self.config.histogram_buckets_per_bit)
+        elif method == 'binary':
+            answer = serializer_factory(
+                ostream, self.config.binary_guess_block_size,
+                self.config.binary_guess_log_probs)
+        elif method == 'human' and self.config.async_guess_writer:
+            answer = AsyncGuessSerializer(
+                ostream, self.config.guess_writer_batch_size,
+                self.config.guess_writer_queue_size)
         else:
-            answer = serializer_factory(self.ostream)
+            answer = serializer_factory(ostream)
         if self.config.enforced_policy != 'basic':
             answer = PasswordPolicyEnforcingSerializer(
                 BasePasswordPolicy.fromConfig(self.config), answer)
@@ -1800,47 +2768,69 @@ class Guesser():
 
         return answer
 
+    def relevel_masks(self, str_list):
+        """Returns which strings are valid prefixes and which are at max_len.
+        """
+        valid = self.filterer.pwd_is_valid_many(str_list)
+        lengths = np.fromiter(map(len, str_list), dtype=np.int64,
+                              count=len(str_list))
+        joined_lengths = np.fromiter(
+            (sum(map(len, astring)) if isinstance(astring, tuple)
+             else len(astring) for astring in str_list),
+            dtype=np.int64, count=len(str_list))
+        at_max_len = ((lengths == self.max_len) |
+                      (joined_lengths == self.max_len))
+        return valid, at_max_len
+
+    def relevel_rows(self, preds, valid, at_max_len):
+        """Relevels a (strings, characters) matrix of predictions in place.
+
+        Invalid prefixes cannot end and prefixes at max_len must end. Every
+        row is then normalized to sum to one.
+        """
+        pwd_end_idx = self.ctable.get_char_index(PASSWORD_END)
+        preds[~valid, pwd_end_idx] = 0
+        must_end = valid & at_max_len
+        preds[must_end] = 0
+        preds[must_end, pwd_end_idx] = 1
+        preds /= preds.sum(axis=1, keepdims=True)
+
     def relevel_prediction(self, preds, astring):
-        if isinstance(astring, tuple):
-            astring_joined_len = sum(map(len, astring))
-        else:
-            astring_joined_len = 0
-        if not self.filterer.pwd_is_valid(astring, quick=True):
-            preds[self.ctable.get_char_index(PASSWORD_END)] = 0
-        elif len(astring) == self.max_len or (
-                isinstance(astring, tuple) and
-                astring_joined_len == self.max_len):
-            multiply = np.zeros(len(preds))
-            pwd_end_idx = self.ctable.get_char_index(PASSWORD_END)
-            multiply[pwd_end_idx] = 1
-            preds[pwd_end_idx] = 1
-            preds = np.multiply(preds, multiply, preds)
-
-        sum_per = sum(preds)
-        for i, v in enumerate(preds):
-            preds[i] = v / sum_per
+        valid, at_max_len = self.relevel_masks([astring])
+        self.relevel_rows(preds[np.newaxis], valid, at_max_len)
 
     def relevel_prediction_many(self, pred_list, str_list):
-        if (self.filterer.pwd_is_valid(str_list[0], quick=True) and
-            len(str_list[0]) != self.max_len):
+        valid, at_max_len = self.relevel_masks(str_list)
+        if valid.all() and not at_max_len.any():
             return
-        for i, pred_item in enumerate(pred_list):
-            self.relevel_prediction(pred_item[0], str_list[i])
+        self.relevel_rows(pred_list[:, 0], valid, at_max_len)
 
     def conditional_probs(self, astring):
         return self.conditional_probs_many([astring])[0][0].copy()
 
     def conditional_probs_many(self, astring_list):
-        if self.config.sequence_model == Sequence.MANY_TO_MANY:
+        if self.incremental_predictor is not None:
+            answer = self.incremental_predictor.predict(astring_list)
+        elif self.bucketed_predictor is not None:
+            answer = self.bucketed_predictor.predict(astring_list)
+        elif self.config.sequence_model == Sequence.MANY_TO_MANY:
             predict_strings, astring_list = self.ctable.encode_many_chunks(astring_list,
                                                                            self.config.max_len)
             answer = self.model.predict(predict_strings,
                                     verbose=0,
                                     batch_size=self.chunk_size_guesser)
         else:
-            answer = self.model.predict(self.ctable.encode_many(astring_list),
-                                    verbose=0,
-                                    batch_size=self.chunk_size_guesser)
+            return self.conditional_probs_encoded(
+                self.ctable.encode_batch(astring_list), astring_list)
+        return self.finish_probs(answer, astring_list)
+
+    def conditional_probs_encoded(self, x_vec, astring_list):
+        return self.finish_probs(
+            self.model.predict(x_vec, verbose=0,
+                               batch_size=self.chunk_size_guesser),
+            astring_list)
+
+    def finish_probs(self, answer, astring_list):
         # pylint: disable=no-member
         #
         # numpy does have the float64 datatype
@@ -1850,7 +2840,7 @@ class Guesser():
         if len(answer.shape) == 2:
             answer = np.expand_dims(answer, axis=1)
         if self.config.sequence_model == Sequence.MANY_TO_MANY:
-            assert answer.shape == (len(predict_strings),
+            assert answer.shape == (len(astring_list),
                                     self.config.context_length, self.ctable.vocab_size)
         else:
             assert answer.shape == (len(astring_list), 1, self.ctable.vocab_size)
@@ -1858,6 +2848,119 @@ class Guesser():
             self.relevel_prediction_many(answer, astring_list)
         return answer
 
+    def top_k_next_chars(self, prefixes, k=10, include_end=True):
+        """Returns the k most probable next characters of each prefix.
+
+        The answer has one list of (character, probability) tuples for each
+        prefix, in order of decreasing probability. PASSWORD_END as the
+        character means that the password ends after the prefix.
+        """
+        if len(prefixes) == 0:
+            return []
+        predictions = self.batch_prob(prefixes)[:, 0]
+        chars = self.chars_list
+        if self.should_make_guesses_rare_char_optimizer:
+            if self._next_char_expander is None:
+                self._next_char_expander = PasswordTemplateSerializer(
+                    self.config)
+            predictions = np.array([
+                self._next_char_expander.expand_conditional_probs(
+                    prediction, prefixes[i])
+                for i, prediction in enumerate(predictions)])
+            chars = self.char_bag
+        if not include_end:
+            predictions[:, chars.index(PASSWORD_END)] = -1
+        k = min(k, predictions.shape[1] - (0 if include_end else 1))
+        if k <= 0:
+            return [[] for _ in prefixes]
+        rows = np.arange(len(prefixes))[:, np.newaxis]
+        top = np.argpartition(-predictions, k - 1, axis=1)[:, :k]
+        top = top[rows, np.argsort(-predictions[rows, top], axis=1)]
+        return [[(chars[idx], predictions[i, idx]) for idx in row]
+                for i, row in enumerate(top)]
+
+    def make_collecting_serializer(self, threshold):
+        answer = CollectingSerializer()
+        collector = answer
+        if self.config.enforced_policy != 'basic':
+            answer = PasswordPolicyEnforcingSerializer(
+                BasePasswordPolicy.fromConfig(self.config), answer)
+        if self.should_make_guesses_rare_char_optimizer:
+            answer = PasswordTemplateSerializer(
+                self.config, answer, threshold)
+        return answer, collector
+
+    def top_n_completions(self, prefixes, n=10, beam_width=None,
+                          threshold=0):
+        """Returns the n most probable completions of each prefix.
+
+        Every prefix has a max-heap frontier of partial passwords. Each round
+        pops the most probable nodes of all unfinished prefixes, predicts them
+        with one batch_prob call and expands them with next_nodes. A prefix is
+        finished once it has n completions that are at least as probable as
+        its best remaining node, so the answer is exact. If beam_width is
+        given, each frontier keeps only its beam_width best nodes, which bounds
+        memory but makes the answer approximate. Nodes below threshold are
+        pruned.
+
+        The answer has one list of (password, probability) tuples for each
+        prefix, in order of decreasing probability. Probabilities are
+        conditioned on the prefix. When guessing with the rare character
+        optimization the prefixes are templates, so 'a' also completes to
+        passwords starting with 'A'.
+        """
+        if n <= 0:
+            return [[] for _ in prefixes]
+        frontiers = [[(-1, prefix)] for prefix in prefixes]
+        results = [[] for _ in prefixes]
+        serializers = [self.make_collecting_serializer(threshold)
+                       for _ in prefixes]
+        active = list(range(len(prefixes)))
+        saved = (self.output_serializer, self.lower_probability_threshold,
+                 self.generated)
+        self.lower_probability_threshold = threshold
+        try:
+            while len(active) > 0:
+                per_prefix = max(1, self.chunk_size_guesser // len(active))
+                batch = []
+                for idx in active:
+                    frontier = frontiers[idx]
+                    for _ in range(min(per_prefix, len(frontier))):
+                        neg_prob, astring = heapq.heappop(frontier)
+                        batch.append((idx, astring, -neg_prob))
+                predictions = self.batch_prob([node[1] for node in batch])
+                for i, (idx, astring, prob) in enumerate(batch):
+                    self.output_serializer = serializers[idx][0]
+                    for child, child_prob in self.next_nodes(
+                            astring, prob, predictions[i][0]):
+                        if child_prob > 0:
+                            heapq.heappush(frontiers[idx],
+                                           (-child_prob, child))
+                still_active = []
+                for idx in active:
+                    top = results[idx]
+                    collector = serializers[idx][1]
+                    for pwd, prob in collector.collected:
+                        if len(top) < n:
+                            heapq.heappush(top, (prob, pwd))
+                        elif prob > top[0][0]:
+                            heapq.heapreplace(top, (prob, pwd))
+                    collector.collected = []
+                    frontier = frontiers[idx]
+                    if beam_width is not None and len(frontier) > beam_width:
+                        frontier = heapq.nsmallest(beam_width, frontier)
+                        frontiers[idx] = frontier
+                    if len(frontier) == 0 or (
+                            len(top) == n and top[0][0] >= -frontier[0][0]):
+                        continue
+                    still_active.append(idx)
+                active = still_active
+        finally:
+            (self.output_serializer, self.lower_probability_threshold,
+             self.generated) = saved
+        return [[(pwd, prob) for prob, pwd in sorted(top, reverse=True)]
+                for top in results]
+
     def next_nodes(self, astring, prob, prediction):
         total_preds = prediction * prob
         if len(astring) + 1 > self.max_len:
@@ -1881,41 +2984,308 @@ class Guesser():
                 answer.append((chain_pass, chain_prob))
         return answer
 
+    def next_nodes_many(self, astrings, probs, predictions):
+        """Expands a batch of nodes at once.
+
+        predictions is the (batch, vocab) matrix of next character
+        probabilities for astrings. Passwords that end are given to the
+        output serializer. Returns the children as three arrays: the index of
+        the parent in astrings, the index of the character in chars_list and
+        the probability of the child.
+        """
+        total_preds = predictions * np.asarray(probs)[:, np.newaxis]
+        above_cutoff = total_preds >= self.lower_probability_threshold
+        end_rows = np.flatnonzero(above_cutoff[:, self.pwd_end_idx])
+        end_rows = end_rows[:self.remaining_guesses(len(end_rows))]
+        end_probs = total_preds[end_rows, self.pwd_end_idx]
+        if len(end_rows) > 0:
+            self.output_serializer.serialize_many(
+                [astrings[i] for i in end_rows], end_probs)
+            self.generated += len(end_rows)
+        above_cutoff[:, self.pwd_end_idx] = False
+        lengths = np.fromiter(map(len, astrings), dtype=np.int32,
+                              count=len(astrings))
+        above_cutoff[lengths + 1 > self.max_len] = False
+        parents, char_indices = np.nonzero(above_cutoff)
+        child_probs = total_preds[parents, char_indices]
+        if self.progress is not None:
+            self.progress.expanded(len(astrings), np.sum(probs),
+                                   np.sum(end_probs), np.sum(child_probs))
+        return parents, char_indices, child_probs
+
+    def start_progress(self):
+        if self.config.progress_file is not None:
+            self.progress = ProgressReporter(
+                open(self.config.progress_file, 'a'),
+                self.config.progress_interval, self.generated,
+                self.batch_stats.batches)
+
+    def report_progress(self, final=False):
+        if self.progress is not None:
+            self.progress.report(
+                self.generated, self.batch_stats.batches, final)
+
+    def remaining_guesses(self, amount):
+        """Returns how many of amount new guesses fit in the guess budget."""
+        if self.guess_budget is None:
+            return amount
+        return max(0, min(amount, self.guess_budget - self.generated))
+
+    def budget_exhausted(self):
+        return ((self.guess_budget is not None and
+                 self.generated >= self.guess_budget) or
+                (self.deadline is not None and time.time() >= self.deadline))
+
+    def sample_passwords(self, count, rng=np.random, start='', start_prob=1):
+        """Walks the guessing tree count times from start at random.
+
+        Each step predicts every unfinished walk in one batch and picks the
+        next characters in proportion to their probability. Prefixes at
+        max_len always end. Returns two arrays: the probability of each
+        sampled password, scaled by start_prob, and the probability that the
+        walk picked it.
+        """
+        prefixes = [self.starting_node(start)] * count
+        probs, sample_probs = np.full(count, float(start_prob)), np.ones(count)
+        answer_probs, answer_sample_probs = [], []
+        while len(prefixes) > 0:
+            predictions = self.batch_prob(prefixes)[:, 0]
+            sampling = predictions.copy()
+            lengths = np.fromiter(map(len, prefixes), dtype=np.int64,
+                                  count=len(prefixes))
+            at_max_len = lengths >= self.max_len
+            sampling[at_max_len] = 0
+            sampling[at_max_len, self.pwd_end_idx] = 1
+            cumulative = np.cumsum(sampling, axis=1)
+            totals = cumulative[:, -1]
+            picks = rng.random_sample(len(prefixes)) * totals
+            chosen = np.minimum((cumulative <= picks[:, np.newaxis]).sum(axis=1),
+                                len(self.chars_list) - 1)
+            rows = np.arange(len(prefixes))
+            probs = probs * predictions[rows, chosen]
+            sample_probs = sample_probs * (
+                sampling[rows, chosen] / np.where(totals > 0, totals, 1))
+            ended = (chosen == self.pwd_end_idx) & (probs > 0)
+            answer_probs.append(probs[ended])
+            answer_sample_probs.append(sample_probs[ended])
+            alive = np.flatnonzero(~ended & (probs > 0))
+            prefixes = [prefixes[i] + self.chars_list[chosen[i]]
+                        for i in alive.tolist()]
+            probs, sample_probs = probs[alive], sample_probs[alive]
+        return np.concatenate(answer_probs), np.concatenate(answer_sample_probs)
+
+    def estimate_threshold(self, target, count, rng=np.random, start='',
+                           start_prob=1):
+        """Estimates the probability above which there are target guesses
+        starting with start.
+
+        Uses the Monte Carlo estimate of Dell'Amico and Filippone: the number
+        of passwords at least as probable as p is the mean of 1 / q over the
+        sampled passwords at least as probable as p, where q is the chance of
+        sampling them.
+        """
+        probs, sample_probs = self.sample_passwords(
+            count, rng, start, start_prob)
+        if len(probs) == 0:
+            logging.warning('No password was sampled, keeping threshold %s',
+                            self.lower_probability_threshold)
+            return self.lower_probability_threshold
+        order = np.argsort(-probs, kind='stable')
+        estimates = np.cumsum(1 / sample_probs[order]) / count
+        idx = int(np.searchsorted(estimates, target))
+        if idx >= len(order):
+            logging.warning(('Only about %d guesses could be estimated from '
+                             '%d samples, using the least probable sample'),
+                            estimates[-1], count)
+            idx = len(order) - 1
+        return float(probs[order[idx]])
+
+    def tune_threshold(self, start='', start_prob=1):
+        target = self.config.target_guess_count * self.config.target_guess_margin
+        self.lower_probability_threshold = self.estimate_threshold(
+            target, self.config.threshold_pilot_samples, start=start,
+            start_prob=start_prob)
+        logging.info(('Using lower_probability_threshold %s for about %d '
+                      'guesses'), self.lower_probability_threshold, target)
+
+    def start_budget(self):
+        if self.config.guessing_time_budget is not None:
+            self.deadline = time.time() + self.config.guessing_time_budget
+
+    def make_child_nodes(self, astrings, parents, char_indices, probs):
+        chars = self.chars_list
+        return [(astrings[parent] + chars[char_index], prob)
+                for parent, char_index, prob in zip(
+                    parents.tolist(), char_indices.tolist(), probs.tolist())]
+
+    def expand_nodes(self, node_list, predictions):
+        astrings = [node[0] for node in node_list]
+        return self.make_child_nodes(astrings, *self.next_nodes_many(
+            astrings, [node[1] for node in node_list], predictions))
+
+    def prefetch_input(self):
+        # Encoding can only be done apart from prediction when the model is
+        # called directly on the encoded prefixes
+        return (self.config.prefetch_prediction_input and
+                self.incremental_predictor is None and
+                self.bucketed_predictor is None and
+                self.config.sequence_model == Sequence.MANY_TO_ONE)
+
+    def chunk_probs(self, chunks):
+        """Yields the predictions for each chunk of prefixes.
+
+        With prefetch_prediction_input, the next chunk is encoded on a
+        background thread while the model predicts the current one.
+        """
+        if not self.prefetch_input():
+            for chunk in chunks:
+                yield self.conditional_probs_many(chunk)
+            return
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            pending = executor.submit(self.ctable.encode_many, chunks[0])
+            for i, chunk in enumerate(chunks):
+                x_vec = pending.result()
+                if i + 1 < len(chunks):
+                    pending = executor.submit(
+                        self.ctable.encode_many, chunks[i + 1])
+                yield self.conditional_probs_encoded(x_vec, chunk)
+
     def batch_prob(self, prefixes):
-        if len(prefixes) > self.max_gpu_prediction_size:
-            if self.config.sequence_model == Sequence.MANY_TO_MANY:
-                answer = np.zeros(
-                    (0, self.config.context_length, len(self.chars_list)))
-            else:
-                answer = np.zeros((0, 1, len(self.chars_list)))
-            for chunk_num in range(
-                    math.ceil(len(prefixes) / self.max_gpu_prediction_size)):
-                answer = np.concatenate(
-                    (answer, self.conditional_probs_many(prefixes[
-                        self.max_gpu_prediction_size * chunk_num:
-                        self.max_gpu_prediction_size * (chunk_num + 1)])), 0)
-            return answer
-        return self.conditional_probs_many(prefixes)
+        self.batch_stats.add(len(prefixes))
+        if len(prefixes) <= self.max_gpu_prediction_size:
+            return self.conditional_probs_many(prefixes)
+        size = self.max_gpu_prediction_size
+        starts = range(0, len(prefixes), size)
+        chunk_answers = self.chunk_probs(
+            [prefixes[start:start + size] for start in starts])
+        if self.config.sequence_model == Sequence.MANY_TO_MANY:
+            # Each prefix can take several rows, so the size is not known
+            return np.concatenate(list(chunk_answers))
+        answer = np.empty((len(prefixes), 1, len(self.chars_list)))
+        for chunk_answer, start in zip(chunk_answers, starts):
+            answer[start:start + len(chunk_answer)] = chunk_answer
+        return answer
 
     def _extract_pwd_from_node(self, node_list):
         return map(lambda x: x[0], node_list)
 
+    def push_chunks(self, stack, ids):
+        for start in range(0, len(ids), self.chunk_size_guesser):
+            chunk = ids[start:start + self.chunk_size_guesser]
+            stack.append((chunk[0], chunk[-1] + 1))
+
+    def pop_batch(self, stack):
+        # Pool chunks from the top of the stack, splitting the last one, until
+        # the batch reaches batch_target nodes. The nodes are all above the
+        # rest of the stack, so the arena invariant still holds.
+        start, end = stack.pop()
+        ranges = [(start, end)]
+        size = end - start
+        while size < self.batch_target and len(stack) > 0:
+            start, end = stack.pop()
+            if end - start > self.batch_target - size:
+                split = end - (self.batch_target - size)
+                stack.append((start, split))
+                start = split
+            ranges.append((start, end))
+            size += end - start
+        if len(ranges) == 1:
+            return np.arange(start, end)
+        return np.concatenate(
+            [np.arange(start, end) for start, end in reversed(ranges)])
+
+    def expand_arena(self, arena, ids):
+        astrings = arena.strings(ids)
+        predictions = self.batch_prob(astrings)
+        parents, char_indices, probs = self.next_nodes_many(
+            astrings, arena.probs[ids], predictions[:, 0])
+        return arena.add_children(ids[parents], char_indices, probs)
+
+    def make_frontier_spiller(self, runs=None):
+        if self.config.max_frontier_nodes == 0:
+            return None
+        return pwd_frontier.FrontierSpiller(
+            self.config.guesser_intermediate_directory,
+            keep_consumed=self.config.guesser_checkpoint_file is not None,
+            runs=runs)
+
+    def spill_stack(self, arena, stack, spiller):
+        # Spill the chunks at the bottom of the stack until half of the
+        # allowed nodes are left and then drop them from the arena
+        on_stack = sum(end - start for start, end in stack)
+        while len(stack) > 1 and on_stack > self.config.max_frontier_nodes // 2:
+            start, end = stack.pop(0)
+            spiller.spill(arena.strings(np.arange(start, end)),
+                          arena.probs[start:end])
+            on_stack -= end - start
+        mapping = arena.compact(np.concatenate(
+            [np.arange(start, end) for start, end in stack] +
+            [np.zeros(0, dtype=np.int64)]))
+        stack[:] = [(mapping[start], mapping[end - 1] + 1)
+                    for start, end in stack]
+
+    def search_arena(self, arena, stack, spiller=None):
+        # Depth first search over chunks of node ids. Children are always
+        # added after every node on the stack, so when chunks are popped
+        # everything above them in the arena is finished and can be dropped.
+        while len(stack) > 0 and not self.budget_exhausted():
+            ids = self.pop_batch(stack)
+            arena.truncate(ids[-1] + 1)
+            self.push_chunks(stack, self.expand_arena(arena, ids))
+            self.report_progress()
+            if (spiller is not None and
+                    len(arena) > self.config.max_frontier_nodes):
+                self.spill_stack(arena, stack, spiller)
+            if (self.config.guesser_checkpoint_file is not None and
+                    time.time() - self.last_checkpoint >=
+                    self.config.guesser_checkpoint_interval):
+                self.save_checkpoint(arena, stack, spiller)
+
+    def save_checkpoint(self, arena, stack, spiller):
+        self.output_serializer.flush()
+        state = {
+            'generated' : self.generated,
+            'lower_probability_threshold' : self.lower_probability_threshold,
+            'serializer' : self.output_serializer.get_state(),
+            'output_offset' : self.ostream.tell(),
+            'spilled_runs' : spiller.runs if spiller is not None else None,
+            'progress' : (self.progress.get_state()
+                          if self.progress is not None else None)
+        }
+        pwd_frontier.save_checkpoint(
+            self.config.guesser_checkpoint_file, arena, stack, state)
+        if spiller is not None:
+            spiller.remove_consumed()
+        self.last_checkpoint = time.time()
+        logging.info('Saved checkpoint after %s guesses to %s',
+                     self.generated, self.config.guesser_checkpoint_file)
+
+    def search_tree(self, arena, stack, spiller):
+        while True:
+            self.search_arena(arena, stack, spiller)
+            if (spiller is None or len(spiller) == 0 or
+                    self.budget_exhausted()):
+                break
+            arena = pwd_frontier.NodeArena(self.chars_list)
+            self.push_chunks(stack, arena.add_roots(spiller.load()))
+        if spiller is not None:
+            spiller.cleanup()
+
     def super_node_recur(self, node_list):
         if len(node_list) == 0:
             return
-        pwds_list = list(self._extract_pwd_from_node(node_list))
-        predictions = self.batch_prob(pwds_list)
-        node_batch = []
-        for i, cur_node in enumerate(node_list):
-            astring, prob = cur_node
-            for next_node in self.next_nodes(astring, prob, predictions[i][0]):
-                node_batch.append(next_node)
-                if len(node_batch) == self.chunk_size_guesser:
-                    self.super_node_recur(node_batch)
-                    node_batch = []
-        if len(node_batch) > 0:
-            self.super_node_recur(node_batch)
-            node_batch = []
+        spiller = self.make_frontier_spiller()
+        arena = pwd_frontier.NodeArena(self.chars_list)
+        stack = []
+        self.push_chunks(stack, arena.add_roots(node_list))
+        try:
+            self.search_tree(arena, stack, spiller)
+        except BaseException:
+            # Keep spilled runs that the checkpoint needs
+            if (spiller is not None and
+                    self.config.guesser_checkpoint_file is None):
+                spiller.cleanup()
+            raise
 
     def _recur(self, astring='', prob=1):
         self.super_node_recur([(astring, prob)])
@@ -1926,17 +3296,63 @@ class Guesser():
     def guess(self, astring='', prob=1):
         self._recur(self.starting_node(astring), prob)
 
+    def resume_guessing(self):
+        """Continues guessing from guesser_checkpoint_file.
+
+        The output stream is truncated to where it was when the checkpoint was
+        saved, so the final output is the same as for an uninterrupted run.
+        """
+        fname = self.config.guesser_checkpoint_file
+        if fname is None or not os.path.exists(fname):
+            logging.warning('No checkpoint found, starting from the beginning')
+            return self.complete_guessing()
+        logging.info('Resuming guessing from %s', fname)
+        arena, stack, state = pwd_frontier.load_checkpoint(
+            fname, self.chars_list)
+        self.start_budget()
+        self.generated = state['generated']
+        self.lower_probability_threshold = state.get(
+            'lower_probability_threshold', self.lower_probability_threshold)
+        self.output_serializer.set_state(state['serializer'])
+        self.start_progress()
+        if self.progress is not None and state.get('progress') is not None:
+            self.progress.set_state(state['progress'])
+        self.ostream.seek(state['output_offset'])
+        self.ostream.truncate()
+        spiller = None
+        if state['spilled_runs'] is not None:
+            spiller = self.make_frontier_spiller(state['spilled_runs'])
+        self.search_tree(arena, stack, spiller)
+        return self.finish_guessing()
+
+    def finish_guessing(self):
+        self.batch_stats.log()
+        if self.progress is not None:
+            self.report_progress(final=True)
+            self.progress.ostream.close()
+            self.progress = None
+        self.output_serializer.finish()
+        if (self.config.guesser_checkpoint_file is not None and
+                os.path.exists(self.config.guesser_checkpoint_file)):
+            os.remove(self.config.guesser_checkpoint_file)
+        logging.info('Generated %s guesses', self.generated)
+        return self.generated
+
     def complete_guessing(self, start='', start_prob=1):
         # self.generated = 0 # clear generated for each guess
         # self.ostream = open(self.ostream.name, 'w') # clear contents for each guess
 
+        self.start_budget()
+        if self.config.target_guess_count is not None:
+            self.tune_threshold(start, start_prob)
+        self.start_progress()
+        if self.progress is not None:
+            self.progress.start(start_prob)
         logging.info('Enumerating guesses starting at %s, %s...',
                      start, start_prob)
         self.guess(start, start_prob)
         # self.ostream.flush()
-        self.output_serializer.finish()
-        logging.info('Generated %s guesses', self.generated)
-        return self.generated
+        return self.finish_guessing()
     
     def complete_guessing2(self):
         self.output_serializer.finish()
@@ -2028,6 +3444,294 @@ class Guesser():
         return _predictor
 
 
+class ParallelGuesser(Guesser):
+    """Enumerates disjoint prefix subtrees in separate worker processes.
+
+    The tree is first expanded in this process until prefixes reach
+    fork_length characters. Each of those prefixes roots a subtree that is
+    enumerated by a worker process which loads its own copy of the model. Each
+    worker writes its output to a file in guesser_intermediate_directory and
+    the output serializer's collect_answer and finish_collecting methods merge
+    those files into the real output.
+    """
+    def __init__(self, model, config, ostream=None, model_serializer=None):
+        super().__init__(model, config, ostream)
+        self.model_serializer = model_serializer
+        self.intm_dir = config.guesser_intermediate_directory
+        self.intermediate_files = []
+
+    def _intermediate_path(self, fname):
+        path = os.path.join(self.intm_dir, fname)
+        self.intermediate_files.append(path)
+        return path
+
+    def split_into_subtrees(self, astring, prob):
+        """Expand the tree breadth first until prefixes are fork_length long.
+
+        Returns the nodes at fork_length. Passwords that end before reaching
+        fork_length are given to the current output serializer.
+        """
+        frontier = [(astring, prob)]
+        while len(frontier) > 0 and len(frontier[0][0]) < self.config.fork_length:
+            predictions = self.batch_prob(
+                list(self._extract_pwd_from_node(frontier)))
+            frontier = self.expand_nodes(frontier, predictions[:, 0])
+        return frontier
+
+    def make_tasks(self, fork_points):
+        # Deal the subtrees out in order of decreasing probability so that
+        # each task receives a mix of large and small subtrees.
+        fork_points = sorted(fork_points, key=lambda x: x[1], reverse=True)
+        num_tasks = min(len(fork_points),
+                        self.config.cpu_limit * PARALLEL_TASKS_PER_CPU)
+        return [(self._intermediate_path(FNAME_PREFIX_PROCESS_OUT + str(i)),
+                 fork_points[i::num_tasks]) for i in range(num_tasks)]
+
+    def _model_files(self):
+        serializer = self.model_serializer
+        if (serializer is not None and serializer.archfile is not None and
+                serializer.weightfile is not None):
+            return serializer.archfile, serializer.weightfile
+
+        logging.info('Saving model for child processes')
+        archfile = self._intermediate_path(FNAME_SUBPROCESS_ARCH)
+        weightfile = self._intermediate_path(FNAME_SUBPROCESS_WEIGHT)
+        ModelSerializer(archfile, weightfile).save_model(self.model)
+        return archfile, weightfile
+
+    def _write_child_config(self):
+        config_fname = self._intermediate_path(
+            FNAME_PREFIX_SUBPROCESS_CONFIG + 'json')
+        with open(config_fname, 'w') as config_file:
+            json.dump(self.config.as_dict(), config_file)
+        return config_fname
+
+    def do_forking(self, tasks):
+        archfile, weightfile = self._model_files()
+        config_fname = self._write_child_config()
+        num_procs = min(len(tasks), self.config.cpu_limit)
+        logging.info('Enumerating %s tasks with %s processes',
+                     len(tasks), num_procs)
+        # Keras and tensorflow do not survive a fork, so each worker is
+        # started fresh and loads its own copy of the model. Each worker
+        # gets one thread so that the workers together use cpu_limit cores.
+        context = multiprocessing.get_context('spawn')
+        with blas_thread_environment(1):
+            pool = context.Pool(
+                num_procs, initializer=parallel_guesser_worker_init,
+                initargs=(config_fname, archfile, weightfile, self.intm_dir,
+                          logging.getLogger().getEffectiveLevel()))
+        try:
+            for ofname, generated in pool.imap_unordered(
+                    parallel_guesser_worker_task, tasks):
+                logging.info('Finished task %s with %s guesses',
+                             ofname, generated)
+                self.generated += generated
+        finally:
+            pool.close()
+            pool.join()
+
+    def collect_answers(self, fnames):
+        for fname in fnames:
+            with open(fname, 'r') as istream:
+                self.output_serializer.collect_answer(self.ostream, istream)
+        self.output_serializer.finish_collecting(self.ostream)
+
+    def cleanup(self):
+        if not self.config.cleanup_guesser_files:
+            return
+        for fname in self.intermediate_files:
+            if os.path.exists(fname):
+                os.remove(fname)
+        self.intermediate_files = []
+
+    def guess(self, astring='', prob=1):
+        os.makedirs(self.intm_dir, exist_ok=True)
+        real_serializer = self.output_serializer
+        parent_fname = self._intermediate_path(FNAME_PARENT_PROCESS_OUT)
+        with open(parent_fname, 'w') as parent_ostream:
+            self.output_serializer = self.make_serializer(
+                ostream=parent_ostream)
+            fork_points = self.split_into_subtrees(
+                self.starting_node(astring), prob)
+            self.output_serializer.finish()
+        self.output_serializer = real_serializer
+        logging.info('Forking on %s prefixes of length %s',
+                     len(fork_points), self.config.fork_length)
+        tasks = self.make_tasks(fork_points)
+        if len(tasks) > 0:
+            self.do_forking(tasks)
+        self.collect_answers([parent_fname] + [fname for fname, _ in tasks])
+        self.cleanup()
+
+    def complete_guessing(self, start='', start_prob=1):
+        logging.info('Enumerating guesses in parallel starting at %s, %s...',
+                     start, start_prob)
+        self.guess(start, start_prob)
+        logging.info('Generated %s guesses', self.generated)
+        return self.generated
+
+# Guesser for the current worker process in parallel guessing. Set by
+# parallel_guesser_worker_init.
+_parallel_worker_guesser = None
+
+def parallel_guesser_worker_init(config_fname, archfile, weightfile,
+                                 intm_dir, log_level):
+    # pylint: disable=global-statement
+    global _parallel_worker_guesser
+    logging.basicConfig(
+        filename=os.path.join(
+            intm_dir, FNAME_PREFIX_PROCESS_LOG + str(os.getpid())),
+        level=log_level, format='%(asctime)-15s %(levelname)s: %(message)s')
+    config = ModelDefaults.fromFile(config_fname)
+    limit_cpu_threads(1)
+    serializer = ModelSerializer(archfile, weightfile)
+    if config.inference_backend == 'numpy':
+        model = serializer.load_numpy_model()
+    else:
+        model = serializer.load_model()
+    _parallel_worker_guesser = Guesser(model, config)
+
+def parallel_guesser_worker_task(task):
+    ofname, nodes = task
+    guesser = _parallel_worker_guesser
+    guesser.generated = 0
+    logging.info('Enumerating %s subtrees into %s', len(nodes), ofname)
+    with open(ofname, 'w') as ostream:
+        guesser.ostream = ostream
+        guesser.output_serializer = guesser.make_serializer()
+        guesser.super_node_recur(nodes)
+        guesser.output_serializer.finish()
+    return ofname, guesser.generated
+
+
+class BestFirstGuesser(Guesser):
+    """Enumerates guesses in order of decreasing probability.
+
+    Open nodes are kept in a NodeArena and queued in ProbabilityBuckets. Each
+    step pops the chunk_size_guesser most probable nodes, predicts them in one
+    batch and queues their children. Finished passwords wait on a heap until
+    no open node can be more probable than them. Since children are never
+    more probable than their parents, nothing found later can beat them, so
+    the output is written already sorted. If best_first_guess_budget is set,
+    guessing stops after that many guesses, which are then the most probable
+    guesses above lower_probability_threshold.
+    """
+    def __init__(self, model, config, ostream=None):
+        super().__init__(model, config, ostream)
+        budgets = [budget for budget in [config.best_first_guess_budget,
+                                         config.target_guess_count]
+                   if budget is not None]
+        self.guess_budget = min(budgets) if budgets else None
+        self.collector = CollectingSerializer()
+        self.expander = self.collector
+        if self.should_make_guesses_rare_char_optimizer:
+            self.expander = PasswordTemplateSerializer(
+                self.config, self.collector)
+
+    def make_serializer(self, method=None, make_rare=None, ostream=None):
+        # Templates are already expanded by self.expander before sorting
+        if make_rare is None:
+            make_rare = False
+        return super().make_serializer(method, make_rare, ostream)
+
+    def remaining_guesses(self, amount):
+        return amount
+
+    def emit_pending(self, pending, bound):
+        while (len(pending) > 0 and -pending[0][0] >= bound and
+               not self.budget_exhausted()):
+            neg_prob, pwd = heapq.heappop(pending)
+            self.output_serializer.serialize(pwd, -neg_prob)
+            self.generated += 1
+
+    def expand(self, arena, ids):
+        astrings = arena.strings(ids)
+        predictions = self.batch_prob(astrings)
+        # next_nodes_many writes finished passwords to the output serializer
+        # and counts them, but they are only guesses once they are emitted
+        output_serializer, generated = self.output_serializer, self.generated
+        self.output_serializer = self.expander
+        try:
+            parents, char_indices, probs = self.next_nodes_many(
+                astrings, arena.probs[ids], predictions[:, 0])
+        finally:
+            self.output_serializer, self.generated = (
+                output_serializer, generated)
+        return arena.add_children(ids[parents], char_indices, probs)
+
+    def spill_frontier(self, arena, frontier, spiller):
+        # Spill the least probable nodes until half of the allowed nodes are
+        # left and then drop them from the arena
+        amount = len(frontier) - self.config.max_frontier_nodes // 2
+        while amount > 0:
+            ids = frontier.pop_least_probable(
+                min(amount, self.chunk_size_guesser))
+            spiller.spill(arena.strings(ids), arena.probs[ids])
+            amount -= len(ids)
+        frontier.remap(arena.compact(frontier.ids()))
+
+    def best_first_search(self, nodes):
+        arena = pwd_frontier.NodeArena(self.chars_list)
+        frontier = pwd_frontier.ProbabilityBuckets()
+        spiller = self.make_frontier_spiller()
+        ids = arena.add_roots(nodes)
+        frontier.push(ids, arena.probs[ids])
+        compacted_size = len(arena)
+        pending = []
+        try:
+            while ((len(frontier) > 0 or
+                    (spiller is not None and len(spiller) > 0)) and
+                   not self.budget_exhausted()):
+                if spiller is not None and len(spiller) > 0 and (
+                        spiller.max_prob() >= frontier.upper_bound()):
+                    ids = arena.add_roots(spiller.load())
+                    frontier.push(ids, arena.probs[ids])
+                child_ids = self.expand(arena, frontier.pop(
+                    max(self.chunk_size_guesser, self.batch_target)))
+                frontier.push(child_ids, arena.probs[child_ids])
+                for pwd, prob in self.collector.collected:
+                    heapq.heappush(pending, (-prob, pwd))
+                self.collector.collected = []
+                self.emit_pending(pending, max(
+                    frontier.upper_bound(),
+                    spiller.max_prob() if spiller is not None else 0))
+                self.report_progress()
+                if (spiller is not None and
+                        len(arena) > self.config.max_frontier_nodes):
+                    self.spill_frontier(arena, frontier, spiller)
+                    compacted_size = len(arena)
+                # Expanded nodes stay in the arena while they have open
+                # descendants. Drop the others once the arena has doubled.
+                if len(arena) > 2 * max(compacted_size,
+                                        self.chunk_size_guesser):
+                    frontier.remap(arena.compact(frontier.ids()))
+                    compacted_size = len(arena)
+        finally:
+            if spiller is not None:
+                spiller.cleanup()
+        self.emit_pending(pending, 0)
+
+    def guess(self, astring='', prob=1):
+        self.best_first_search([(self.starting_node(astring), prob)])
+
+class CollectingSerializer(GuessSerializer):
+    """Keeps guesses in memory instead of writing them to a stream."""
+    def __init__(self):
+        super().__init__(None)
+        self.collected = []
+
+    def serialize(self, password, prob):
+        if prob == 0:
+            return
+        if isinstance(password, tuple):
+            password = ''.join(password)
+        self.total_guessed += 1
+        self.collected.append((password, prob))
+
+    def finish(self):
+        pass
+
 class RandomWalkSerializer(GuessSerializer):
     def serialize(self, password, prob):
         self.total_guessed += 1
@@ -2050,6 +3754,7 @@ class RandomWalkGuesser(Guesser):
 
          # pylint: disable=I1101
          # generator has this field
+        import generator
         self.next_node_fn = generator.next_nodes_random_walk
         self.estimates = []
 
@@ -2329,7 +4034,10 @@ class GuesserBuilder():
         return self
 
     def add_file(self, ofname):
-        self.add_stream(open(ofname, 'w'))
+        if self.config.compress_guesses:
+            self.add_stream(gzip.open(ofname, 'wt'))
+        else:
+            self.add_stream(open(ofname, 'w'))
         self.ofile_path = ofname
         return self
 
@@ -2342,7 +4050,10 @@ class GuesserBuilder():
     def build(self):
         model_or_serializer = self.model
         if self.serializer is not None and self.model is None:
-            model_or_serializer = self.serializer.load_model()
+            if self.config.inference_backend == 'numpy':
+                model_or_serializer = self.serializer.load_numpy_model()
+            else:
+                model_or_serializer = self.serializer.load_model()
 
         if model_or_serializer is None:
             raise GuesserBuilderError('Cannot build without model')
@@ -2356,6 +4067,14 @@ class GuesserBuilder():
         if self.config.guesser_class in self.other_class_builders:
             class_builder = self.other_class_builders[self.config.guesser_class]
 
+        if self.config.best_first_guessing and class_builder == Guesser:
+            return BestFirstGuesser(model_or_serializer, self.config,
+                                    self.ostream)
+
+        if self.config.parallel_guessing and class_builder == Guesser:
+            return ParallelGuesser(model_or_serializer, self.config,
+                                   self.ostream, self.serializer)
+
         return class_builder(model_or_serializer, self.config, self.ostream)
 
 log_level_map = {
@@ -2367,12 +4086,15 @@ log_level_map = {
 
 serializer_type_list = {
     'human' : GuessSerializer,
+    'binary' : BinaryGuessSerializer,
+    'histogram' : ProbabilityHistogramSerializer,
     'calculator' : GuessNumberGenerator,
     'random_walk' : RandomWalkSerializer,
     'delamico_random_walk' : DelAmicoCalculator,
     'generate_random' : DelAmicoCalculator
 }
 
+@functools.lru_cache(maxsize=None)
 def get_version_string():
     p = subp.Popen(['git', 'log', '--pretty=format:%H', '-n', '1'],
                    cwd=os.path.dirname(os.path.realpath(__file__)),
@@ -2459,18 +4181,26 @@ def guess(args, config):
         sys.exit(1)
     if config.guessing_secondary_training:
         prepare_secondary_training(config)
-    guesser = (GuesserBuilder(config)
-               .add_serializer(
-                   ModelSerializer(
-                       archfile=args['arch_file'],
-                       weightfile=args['weight_file'],
-                       multi_gpu=args['multi_gpu']))
-               .add_file(args['enumerate_ofile'])
-               .build())
+    builder = GuesserBuilder(config).add_serializer(
+        ModelSerializer(
+            archfile=args['arch_file'],
+            weightfile=args['weight_file'],
+            multi_gpu=args['multi_gpu']))
+    # Without a checkpoint to resume from, guessing starts over and the old
+    # output is truncated
+    checkpoint = config.guesser_checkpoint_file
+    if (args.get('resume') and os.path.exists(args['enumerate_ofile']) and
+            checkpoint is not None and os.path.exists(checkpoint)):
+        builder.add_stream(open(args['enumerate_ofile'], 'r+'))
+    else:
+        builder.add_file(args['enumerate_ofile'])
+    guesser = builder.build()
     if args['calc_probability_only']:
         guesser.calculate_probs()
     elif args["calc_guess_number_from_cache"]:
         guesser.calculate_guess_numbers_from_cache()
+    elif args.get('resume'):
+        guesser.resume_guessing()
     else:
         guesser.complete_guessing()
 
@@ -2505,6 +4235,8 @@ def main(args):
         logging.critical('Configuration not valid %s', str(e))
         raise
     logging.info('Configuration: %s', json.dumps(config.as_dict(), indent=4))
+    if config.cpu_limit > 0:
+        limit_cpu_threads(config.cpu_limit)
 
     if args['pwd_file']:
         train(args, config)
@@ -2522,8 +4254,7 @@ def make_parser():
         enumeration. Either --pwd-file or --enumerate-ofile are required.
         --pwd-file will give a password file as training data.
         --enumerate-ofile will guess passwords based on an existing model.
-        Version """ +
-        get_version_string()))
+        Use --version to print the version."""))
     parser.add_argument('--pwd-file', help=('Input file name. '), nargs='+')
     parser.add_argument('--arch-file',
                         help='Output file for the model architecture. ')
@@ -2571,6 +4302,11 @@ def make_parser():
               'probability, guess number). This file may be created from one '
               'of the guessing methods, particularly with the '
               'probability_steps configuration option. '))
+    parser.add_argument('--resume', action='store_true',
+                        help=('Continue guessing from the checkpoint in the '
+                              'guesser_checkpoint_file config option. The '
+                              'enumerate-ofile output is kept up to the '
+                              'checkpoint. '))
     parser.add_argument('--train-secondary-only', action='store_true',
                         help='Only train on secondary data. ')
     parser.add_argument('--multi-gpu', default=1, type=int,
@@ -0,0 +1,425 @@
+# -*- coding: utf-8 -*-
+"""Binary format for enumerated guesses.
+
+The text output of the guesser is one 'password\\tprobability' line per
+guess. The binary format stores the same guesses in blocks that are
+compressed with zlib one at a time:
+
+    file   := header block* index footer
+    header := MAGIC, version (uint8), log_probs flag (uint8)
+    block  := zlib(probabilities, lengths, passwords)
+    index  := (offset, size, count) as three uint64 for every block
+    footer := index offset (uint64), number of blocks (uint64), END_MAGIC
+
+In a block, the probabilities are float64, or float32 log2 probabilities if
+the log_probs flag is set, the lengths are the uint16 number of utf-8 bytes
+of every password and the passwords are the utf-8 bytes one after another.
+Because of the index, a reader can go straight to the block that holds the
+n-th guess without reading the blocks before it.
+
+ExternalGuessSorter sorts guesses by probability with bounded memory. It
+writes sorted runs in the binary format and merges them at the end.
+"""
+import itertools
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+
+import numpy as np
+
+MAGIC = b'PWDGUESS'
+END_MAGIC = b'GUESSEND'
+VERSION = 1
+HEADER = struct.Struct('<8sBB')
+FOOTER = struct.Struct('<QQ8s')
+INDEX_DTYPE = np.dtype([('offset', '<u8'), ('size', '<u8'), ('count', '<u8')])
+DEFAULT_BLOCK_SIZE = 65536
+DEFAULT_RUN_SIZE = 1000000
+RUN_BLOCK_SIZE = 4096
+
+class BinaryGuessWriter():
+    """Writes guesses to a binary stream in the binary guess format.
+
+    Nothing is written until the first block is full or close is called.
+    close writes the index and the footer but does not close the stream.
+    """
+    def __init__(self, ostream, block_size=DEFAULT_BLOCK_SIZE,
+                 log_probs=False, compress_level=6):
+        self.ostream = ostream
+        self.block_size = block_size
+        self.log_probs = log_probs
+        self.compress_level = compress_level
+        self.passwords = []
+        self.probs = []
+        self.index = []
+        self.offset = 0
+        self.closed = False
+
+    def _write(self, data):
+        if self.offset == 0:
+            header = HEADER.pack(MAGIC, VERSION, int(self.log_probs))
+            self.ostream.write(header)
+            self.offset = len(header)
+        self.ostream.write(data)
+        self.offset += len(data)
+        return self.offset - len(data)
+
+    def write(self, passwords, probs):
+        self.passwords.extend(passwords)
+        self.probs.extend(probs)
+        while len(self.passwords) >= self.block_size:
+            self.write_block(self.passwords[:self.block_size],
+                             self.probs[:self.block_size])
+            del self.passwords[:self.block_size]
+            del self.probs[:self.block_size]
+
+    def write_block(self, passwords, probs):
+        encoded = [password.encode('utf-8') for password in passwords]
+        lengths = np.fromiter(map(len, encoded), dtype=np.int64,
+                              count=len(encoded))
+        if len(lengths) > 0 and lengths.max() > np.iinfo(np.uint16).max:
+            raise ValueError('Password too long for the binary guess format')
+        probs = np.asarray(probs, dtype=np.float64)
+        if self.log_probs:
+            probs = np.log2(probs).astype('<f4')
+        else:
+            probs = probs.astype('<f8')
+        payload = b''.join([probs.tobytes(), lengths.astype('<u2').tobytes()] +
+                           encoded)
+        self.write_compressed_block(
+            zlib.compress(payload, self.compress_level), len(passwords))
+
+    def write_compressed_block(self, data, count):
+        """Appends a block that is already compressed, e.g. from a reader.
+
+        The block must have been written with the same log_probs setting.
+        """
+        if count == 0:
+            return
+        self.index.append((self._write(data), len(data), count))
+
+    def close(self):
+        if self.closed:
+            return
+        if len(self.passwords) > 0:
+            self.write_block(self.passwords, self.probs)
+            self.passwords, self.probs = [], []
+        index_offset = self._write(
+            np.array(self.index, dtype=INDEX_DTYPE).tobytes())
+        self._write(FOOTER.pack(index_offset, len(self.index), END_MAGIC))
+        self.ostream.flush()
+        self.closed = True
+
+def is_binary_guess_file(fname):
+    with open(fname, 'rb') as ifile:
+        return ifile.read(len(MAGIC)) == MAGIC
+
+def is_binary_guess_stream(istream):
+    """Checks a text or binary stream without consuming any of it."""
+    istream = getattr(istream, 'buffer', istream)
+    if not hasattr(istream, 'peek'):
+        return False
+    return istream.peek(len(MAGIC))[:len(MAGIC)] == MAGIC
+
+class BinaryGuessReader():
+    """Reads a file in the binary guess format.
+
+    Files are memory mapped. Streams that cannot be mapped, like stdin, are
+    read into memory. Guess numbers start at 1.
+    """
+    def __init__(self, source):
+        self.mmap = None
+        if isinstance(source, str):
+            with open(source, 'rb') as ifile:
+                self.mmap = mmap.mmap(ifile.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+            self.data = self.mmap
+        else:
+            source = getattr(source, 'buffer', source)
+            try:
+                self.mmap = mmap.mmap(source.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+                self.data = self.mmap
+            except (AttributeError, OSError, ValueError):
+                self.data = source.read()
+        magic, version, log_probs = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError('Not a binary guess file')
+        if version != VERSION:
+            raise ValueError('Unsupported binary guess file version %d' %
+                             version)
+        self.log_probs = bool(log_probs)
+        index_offset, num_blocks, end_magic = FOOTER.unpack_from(
+            self.data, len(self.data) - FOOTER.size)
+        if end_magic != END_MAGIC:
+            raise ValueError('Binary guess file is truncated')
+        self.index = np.frombuffer(self.data, dtype=INDEX_DTYPE,
+                                   count=num_blocks,
+                                   offset=index_offset).copy()
+        self.ends = np.cumsum(self.index['count'].astype(np.int64))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+
+    def __len__(self):
+        return int(self.ends[-1]) if len(self.ends) > 0 else 0
+
+    def num_blocks(self):
+        return len(self.index)
+
+    def compressed_block(self, i):
+        """Returns the compressed bytes and the number of guesses of block i."""
+        offset, size, count = self.index[i].tolist()
+        return self.data[offset:offset + size], count
+
+    def block(self, i):
+        """Returns the passwords and the probabilities in block i."""
+        data, count = self.compressed_block(i)
+        payload = zlib.decompress(data)
+        prob_dtype = '<f4' if self.log_probs else '<f8'
+        probs = np.frombuffer(payload, dtype=prob_dtype, count=count)
+        position = probs.nbytes
+        lengths = np.frombuffer(payload, dtype='<u2', count=count,
+                                offset=position)
+        position += lengths.nbytes
+        text = payload[position:]
+        if text.isascii():
+            text = text.decode('ascii')
+        ends = np.cumsum(lengths, dtype=np.int64).tolist()
+        passwords = [text[start:end]
+                     for start, end in zip([0] + ends[:-1], ends)]
+        if not isinstance(text, str):
+            passwords = [password.decode('utf-8') for password in passwords]
+        if self.log_probs:
+            probs = np.exp2(probs.astype(np.float64))
+        else:
+            probs = probs.astype(np.float64)
+        return passwords, probs
+
+    def blocks(self, start=0):
+        for i in range(start, self.num_blocks()):
+            yield self.block(i)
+
+    def block_of(self, guess_number):
+        """Returns the block that holds the guess with guess_number."""
+        if guess_number < 1 or guess_number > len(self):
+            raise IndexError('Guess number out of range: %s' % guess_number)
+        return int(np.searchsorted(self.ends, guess_number))
+
+    def guess(self, guess_number):
+        """Returns the (password, probability) with guess_number."""
+        i = self.block_of(guess_number)
+        passwords, probs = self.block(i)
+        position = guess_number - 1 - (int(self.ends[i - 1]) if i > 0 else 0)
+        return passwords[position], float(probs[position])
+
+    def __iter__(self):
+        for passwords, probs in self.blocks():
+            yield from zip(passwords, probs.tolist())
+
+def read_guesses(source):
+    """Yields (password, probability) from a text or binary guess file.
+
+    source is a file name or an open stream. Text lines that have no
+    probability are given probability -1.
+    """
+    if isinstance(source, str):
+        if is_binary_guess_file(source):
+            with BinaryGuessReader(source) as reader:
+                yield from reader
+            return
+        with open(source, 'r') as istream:
+            yield from read_guesses(istream)
+        return
+    if is_binary_guess_stream(source):
+        with BinaryGuessReader(source) as reader:
+            yield from reader
+        return
+    for line in source:
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) < 2:
+            yield fields[0], -1
+        else:
+            yield fields[0], float(fields[1])
+
+class ExternalGuessSorter():
+    """Sorts guesses by descending probability with bounded memory.
+
+    Guesses are kept in memory until run_size of them have been added. Then
+    they are sorted and written to a run file in a new temporary directory
+    under directory. merge reads all of the runs at once and yields the
+    guesses in order. The order of guesses with the same probability is not
+    defined.
+    """
+    def __init__(self, directory=None, run_size=DEFAULT_RUN_SIZE):
+        self.parent_directory = directory
+        self.directory = None
+        self.run_size = run_size
+        self.passwords = []
+        self.probs = []
+        self.runs = []
+
+    def add(self, passwords, probs):
+        self.passwords.extend(passwords)
+        self.probs.extend(probs)
+        if len(self.passwords) >= self.run_size:
+            self.spill()
+
+    def _sorted(self):
+        probs = np.asarray(self.probs, dtype=np.float64)
+        order = np.argsort(-probs, kind='stable')
+        passwords = [self.passwords[i] for i in order.tolist()]
+        self.passwords, self.probs = [], []
+        return passwords, probs[order]
+
+    def _write_run(self, batches):
+        if self.directory is None:
+            if self.parent_directory is not None:
+                os.makedirs(self.parent_directory, exist_ok=True)
+            self.directory = tempfile.mkdtemp(
+                dir=self.parent_directory, prefix='guess_runs_')
+        fname = os.path.join(self.directory, 'run_%d.bin' % len(self.runs))
+        with open(fname, 'wb') as ostream:
+            writer = BinaryGuessWriter(ostream, RUN_BLOCK_SIZE,
+                                       compress_level=1)
+            for passwords, probs in batches:
+                writer.write(passwords, probs)
+            writer.close()
+        self.runs.append(fname)
+
+    def spill(self):
+        if len(self.passwords) > 0:
+            self._write_run([self._sorted()])
+
+    def add_sorted(self, guesses):
+        """Adds (password, probability) pairs that are already in descending
+        order of probability as one run."""
+        self.spill()
+        self._write_run(batched(guesses, RUN_BLOCK_SIZE))
+
+    def merge_batches(self):
+        """Yields (passwords, probabilities) batches of every guess, most
+        probable first."""
+        if len(self.runs) == 0:
+            passwords, probs = self._sorted()
+            if len(passwords) > 0:
+                yield passwords, probs
+            return
+        self.spill()
+        readers = [BinaryGuessReader(fname) for fname in self.runs]
+        try:
+            yield from merge_blocks([reader.blocks() for reader in readers])
+        finally:
+            for reader in readers:
+                reader.close()
+
+    def merge(self):
+        """Yields (password, probability) of every guess, most probable first.
+        """
+        for passwords, probs in self.merge_batches():
+            yield from zip(passwords, probs.tolist())
+
+    def cleanup(self):
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+        self.runs = []
+
+def batched(guesses, batch_size):
+    """Groups (password, probability) pairs into (passwords, probs) lists."""
+    guesses = iter(guesses)
+    while True:
+        batch = list(itertools.islice(guesses, batch_size))
+        if len(batch) == 0:
+            return
+        yield [pwd for pwd, _ in batch], [prob for _, prob in batch]
+
+def merge_blocks(runs):
+    """Merges runs of (passwords, probs) blocks in descending order.
+
+    Every unread guess of a run is at most as probable as the last guess of
+    its current block. So everything at least as probable as the largest of
+    those last guesses can be sorted and yielded as one batch, which always
+    uses up at least one whole block.
+    """
+    heads = []
+    for blocks in runs:
+        for passwords, probs in blocks:
+            if len(passwords) > 0:
+                heads.append([passwords, probs, blocks])
+                break
+    while len(heads) > 0:
+        threshold = max(probs[-1] for _, probs, _ in heads)
+        batch_passwords, batch_probs = [], []
+        for head in heads:
+            passwords, probs, _ = head
+            taken = int(np.searchsorted(-probs, -threshold, side='right'))
+            batch_passwords.extend(passwords[:taken])
+            batch_probs.append(probs[:taken])
+            head[0], head[1] = passwords[taken:], probs[taken:]
+        batch_probs = np.concatenate(batch_probs)
+        order = np.argsort(-batch_probs, kind='stable')
+        yield ([batch_passwords[i] for i in order.tolist()],
+               batch_probs[order])
+        live = []
+        for head in heads:
+            if len(head[0]) == 0:
+                head[0], head[1] = next(head[2], ([], None))
+            if len(head[0]) > 0:
+                live.append(head)
+        heads = live
+
+def write_sorted(sorter, ostream, binary=False,
+                 block_size=DEFAULT_BLOCK_SIZE, log_probs=False):
+    """Writes the merged guesses of sorter to ostream and removes the runs.
+
+    Text output is 'password\tprobability\tguess number' lines. In binary
+    output the guess number is the position of the guess in the file.
+    """
+    try:
+        if binary:
+            writer = BinaryGuessWriter(
+                getattr(ostream, 'buffer', ostream), block_size, log_probs)
+            for passwords, probs in sorter.merge_batches():
+                writer.write(passwords, probs.tolist())
+            writer.close()
+        else:
+            rank = 0
+            for passwords, probs in sorter.merge_batches():
+                ostream.write(''.join([
+                    '%s\t%s\t%d\n' % (pwd, prob, rank + i)
+                    for i, (pwd, prob) in enumerate(
+                        zip(passwords, probs.tolist()), 1)]))
+                rank += len(passwords)
+        ostream.flush()
+    finally:
+        sorter.cleanup()
+
+def sort_guess_file(ifname, ofname, run_size=DEFAULT_RUN_SIZE, directory=None,
+                    binary=False):
+    """Sorts a text or binary guess file into ofname, most probable first."""
+    sorter = ExternalGuessSorter(directory, run_size)
+    try:
+        if is_binary_guess_file(ifname):
+            with BinaryGuessReader(ifname) as reader:
+                for passwords, probs in reader.blocks():
+                    sorter.add(passwords, probs)
+        else:
+            for passwords, probs in batched(read_guesses(ifname),
+                                            RUN_BLOCK_SIZE):
+                sorter.add(passwords, probs)
+        with open(ofname, 'wb' if binary else 'w') as ostream:
+            write_sorted(sorter, ostream, binary)
+    finally:
+        sorter.cleanup()
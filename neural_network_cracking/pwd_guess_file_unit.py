@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+import pwd_guess_file
+
+GUESSES = [('password', .25), ('é', .125), ('', .0625), ('abc\tdef', 1e-9),
+           ('qwerty', 1e-300)]
+
+class BinaryGuessFileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.fname = os.path.join(self.directory.name, 'guesses.bin')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, guesses=GUESSES, **kwargs):
+        with open(self.fname, 'wb') as ostream:
+            writer = pwd_guess_file.BinaryGuessWriter(ostream, **kwargs)
+            for pwd, prob in guesses:
+                writer.write([pwd], [prob])
+            writer.close()
+            writer.close()
+
+    def test_round_trip(self):
+        self.write(block_size=2)
+        with pwd_guess_file.BinaryGuessReader(self.fname) as reader:
+            self.assertEqual(len(reader), 5)
+            self.assertEqual(reader.num_blocks(), 3)
+            self.assertEqual(list(reader), GUESSES)
+        self.assertTrue(pwd_guess_file.is_binary_guess_file(self.fname))
+
+    def test_log_probs(self):
+        self.write(log_probs=True)
+        with pwd_guess_file.BinaryGuessReader(self.fname) as reader:
+            passwords, probs = reader.block(0)
+        self.assertEqual(passwords, [pwd for pwd, _ in GUESSES])
+        np.testing.assert_allclose(probs, [prob for _, prob in GUESSES],
+                                   rtol=1e-4)
+
+    def test_seek(self):
+        self.write(block_size=2)
+        with pwd_guess_file.BinaryGuessReader(self.fname) as reader:
+            self.assertEqual(reader.block_of(1), 0)
+            self.assertEqual(reader.block_of(3), 1)
+            self.assertEqual(reader.block_of(5), 2)
+            self.assertEqual(reader.guess(4), GUESSES[3])
+            self.assertEqual(reader.guess(5), GUESSES[4])
+            with self.assertRaises(IndexError):
+                reader.guess(6)
+
+    def test_empty(self):
+        self.write([])
+        with pwd_guess_file.BinaryGuessReader(self.fname) as reader:
+            self.assertEqual(len(reader), 0)
+            self.assertEqual(list(reader), [])
+
+    def test_copy_blocks(self):
+        self.write(block_size=2)
+        ostream = io.BytesIO()
+        writer = pwd_guess_file.BinaryGuessWriter(ostream)
+        writer.write(['first'], [.5])
+        writer.write_block(writer.passwords, writer.probs)
+        writer.passwords, writer.probs = [], []
+        with pwd_guess_file.BinaryGuessReader(self.fname) as reader:
+            for i in range(reader.num_blocks()):
+                writer.write_compressed_block(*reader.compressed_block(i))
+        writer.close()
+        ostream.seek(0)
+        with pwd_guess_file.BinaryGuessReader(ostream) as reader:
+            self.assertEqual(list(reader), [('first', .5)] + GUESSES)
+
+    def test_truncated(self):
+        self.write()
+        with open(self.fname, 'rb') as ifile:
+            data = ifile.read()
+        with self.assertRaises(ValueError):
+            pwd_guess_file.BinaryGuessReader(io.BytesIO(data[:-1]))
+        with self.assertRaises(ValueError):
+            pwd_guess_file.BinaryGuessReader(io.BytesIO(b'x' * 100))
+
+    def test_read_guesses(self):
+        self.write()
+        self.assertEqual(list(pwd_guess_file.read_guesses(self.fname)),
+                         GUESSES)
+        with open(self.fname, 'r') as istream:
+            self.assertEqual(list(pwd_guess_file.read_guesses(istream)),
+                             GUESSES)
+        text_fname = os.path.join(self.directory.name, 'guesses.txt')
+        with open(text_fname, 'w') as ostream:
+            ostream.write('pass\t0.5\nword\n')
+        self.assertEqual(list(pwd_guess_file.read_guesses(text_fname)),
+                         [('pass', .5), ('word', -1)])
+        with open(text_fname, 'r') as istream:
+            self.assertFalse(pwd_guess_file.is_binary_guess_stream(istream))
+            self.assertEqual(istream.read(4), 'pass')
+
+class ExternalGuessSorterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        rng = np.random.RandomState(0)
+        probs = rng.choice([.5, .25, .125], size=500)
+        probs[::3] = rng.random_sample(len(probs[::3]))
+        self.guesses = [('pwd%d' % i, prob)
+                        for i, prob in enumerate(probs.tolist())]
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def check(self, sorter):
+        for i in range(0, len(self.guesses), 7):
+            batch = self.guesses[i:i + 7]
+            sorter.add([pwd for pwd, _ in batch], [prob for _, prob in batch])
+        answer = list(sorter.merge())
+        sorter.cleanup()
+        self.assertEqual([prob for _, prob in answer],
+                         sorted([prob for _, prob in self.guesses],
+                                reverse=True))
+        self.assertEqual(sorted(answer), sorted(self.guesses))
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def test_in_memory(self):
+        sorter = pwd_guess_file.ExternalGuessSorter(self.directory.name)
+        self.check(sorter)
+        self.assertEqual(sorter.directory, None)
+
+    def test_spilled_runs(self):
+        self.check(pwd_guess_file.ExternalGuessSorter(
+            self.directory.name, run_size=50))
+
+    def test_add_sorted(self):
+        sorter = pwd_guess_file.ExternalGuessSorter(self.directory.name)
+        sorter.add(['c', 'a'], [.1, .5])
+        sorter.add_sorted([('b', .4), ('d', .05)])
+        sorter.add_sorted([])
+        self.assertEqual(len(sorter.runs), 3)
+        self.assertEqual(list(sorter.merge()),
+                         [('a', .5), ('b', .4), ('c', .1), ('d', .05)])
+        sorter.cleanup()
+
+    def test_merge_blocks(self):
+        runs = [[(['a', 'b'], np.array([.5, .3])), (['c'], np.array([.1]))],
+                [([], np.zeros(0)), (['d', 'e'], np.array([.4, .3]))],
+                []]
+        batches = list(pwd_guess_file.merge_blocks(
+            [iter(run) for run in runs]))
+        self.assertEqual(batches[0][0], ['a', 'd', 'b', 'e'])
+        self.assertEqual(
+            [pwd for passwords, _ in batches for pwd in passwords],
+            ['a', 'd', 'b', 'e', 'c'])
+
+    def test_sort_guess_file(self):
+        ifname = os.path.join(self.directory.name, 'guesses.txt')
+        ofname = os.path.join(self.directory.name, 'sorted.txt')
+        with open(ifname, 'w') as ostream:
+            ostream.write('b\t0.25\na\t0.5\nc\t1e-05\n')
+        pwd_guess_file.sort_guess_file(ifname, ofname, run_size=2,
+                                       directory=self.directory.name)
+        with open(ofname, 'r') as sorted_file:
+            self.assertEqual(sorted_file.read(),
+                             'a\t0.5\t1\nb\t0.25\t2\nc\t1e-05\t3\n')
+        pwd_guess_file.sort_guess_file(ofname, ifname, binary=True)
+        with pwd_guess_file.BinaryGuessReader(ifname) as reader:
+            self.assertEqual(reader.guess(2), ('b', .25))
+        self.assertEqual(sorted(os.listdir(self.directory.name)),
+                         ['guesses.txt', 'sorted.txt'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,6 +11,7 @@ import tempfile
 import shutil
 import os.path
 import gzip
+import subprocess
 import io
 import json
 import numpy as np
@@ -42,6 +43,75 @@ def parse_args():
     ns, args = parser.parse_known_args(namespace=unittest)
     return ns, sys.argv[:1] + args
 
+class CpuLimitTest(unittest.TestCase):
+    def setUp(self):
+        self.environ = os.environ.copy()
+        self.cpu_threads = pwd_guess._cpu_threads
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        pwd_guess._cpu_threads = self.cpu_threads
+
+    def test_limit_cpu_threads(self):
+        pwd_guess.limit_cpu_threads(3)
+        self.assertEqual(pwd_guess._cpu_threads, 3)
+        for name in pwd_guess.BLAS_THREAD_VARIABLES:
+            self.assertEqual(os.environ[name], '3')
+
+    def test_limit_cpu_threads_without_threadpoolctl(self):
+        with unittest.mock.patch.dict(sys.modules, {'threadpoolctl' : None}):
+            with self.assertLogs(level = 'WARNING') as logs:
+                pwd_guess.limit_cpu_threads(2)
+        self.assertIn('threadpoolctl is not installed', logs.output[0])
+        self.assertEqual(os.environ['OMP_NUM_THREADS'], '2')
+
+    def test_blas_thread_environment(self):
+        os.environ['OMP_NUM_THREADS'] = '4'
+        os.environ.pop('MKL_NUM_THREADS', None)
+        with pwd_guess.blas_thread_environment(1):
+            self.assertEqual(os.environ['OMP_NUM_THREADS'], '1')
+            self.assertEqual(os.environ['MKL_NUM_THREADS'], '1')
+        self.assertEqual(os.environ['OMP_NUM_THREADS'], '4')
+        self.assertNotIn('MKL_NUM_THREADS', os.environ)
+
+    def test_other_backend(self):
+        mock_keras = Mock()
+        mock_keras.backend.backend = MagicMock(return_value = 'theano')
+        pwd_guess.limit_tensorflow_threads(mock_keras, 2)
+        self.assertFalse(mock_keras.backend.set_session.called)
+
+class StartupTest(unittest.TestCase):
+    heavy_modules = ['keras', 'tensorflow', 'sklearn', 'pylru', 'generator',
+                     'h5py']
+
+    def time_startup(self, module):
+        code = ('import json, sys, time\n'
+                'start = time.time()\n'
+                'import %s\n'
+                'import pwd_guess\n'
+                'pwd_guess.make_parser()\n'
+                'print(json.dumps([time.time() - start, sorted(sys.modules)]))'
+                % module)
+        output = subprocess.check_output(
+            [sys.executable, '-c', code],
+            cwd=os.path.dirname(os.path.abspath(pwd_guess.__file__)))
+        elapsed, modules = json.loads(output.decode('utf8'))
+        logging.info('Starting %s took %.3f seconds', module, elapsed)
+        return elapsed, modules
+
+    def test_pwd_guess(self):
+        elapsed, modules = self.time_startup('pwd_guess')
+        self.assertEqual(
+            [name for name in self.heavy_modules if name in modules], [])
+        self.assertLess(elapsed, 2)
+
+    def test_markov_model(self):
+        elapsed, modules = self.time_startup('markov_model')
+        self.assertEqual(
+            [name for name in self.heavy_modules if name in modules], [])
+        self.assertLess(elapsed, 2)
+
 if __name__ == '__main__':
     args, argv = parse_args()   # run this first before defining tests
     sys.argv[:] = argv       # create cleans argv for main()
@@ -105,6 +175,37 @@ class CharacterTableTest(unittest.TestCase):
                                                         [0, 0, 0, 1], [0, 1, 1, 1]]))
         self.assertListEqual(strings, ['abca', 'cabc', 'aaab', 'abbb'] )
 
+    def test_encode_many_matches_encode(self):
+        rng = random.Random(0)
+        strings = [''.join(rng.choice('abc\n') for _ in range(rng.randint(0, 7)))
+                   for _ in range(50)]
+        for embedding, padding in itertools.product([False, True], repeat=2):
+            ctable = pwd_guess.CharacterTable(
+                'abc\n', 5, embedding=embedding, padding_character=padding)
+            np.testing.assert_array_equal(
+                ctable.encode_many(strings),
+                [ctable.encode(ctable.pad_to_len(astring))
+                 for astring in strings])
+
+    def test_index_inputs(self):
+        ctable = pwd_guess.CharacterTable('abc', 3, index_inputs=True)
+        np.testing.assert_array_equal(
+            ctable.encode_many(['ab', 'c', 'bcab']), [[1, 2, 0], [3, 0, 0], [3, 1, 2]])
+        self.assertEqual(ctable.encode_many(['ab'], y_vec=True).shape,
+                         (1, 3, 3))
+
+    def test_encode_batch(self):
+        ctable = pwd_guess.CharacterTable('ab', 2)
+        first = ctable.encode_batch(['ab', 'ba', 'a'])
+        second = ctable.encode_batch(['b'])
+        self.assertTrue(np.shares_memory(first, second))
+        np.testing.assert_array_equal(second, ctable.encode_many(['b']))
+
+    def test_unknown_character(self):
+        ctable = pwd_guess.CharacterTable('ab', 3)
+        with self.assertRaises(KeyError):
+            ctable.encode_many(['ab', 'a\u1234'])
+
 class OptimizingTableTest(unittest.TestCase):
     def test_table(self):
         ctable = pwd_guess.OptimizingCharacterTable('abcd', 2, 'ab', False)
@@ -157,6 +258,13 @@ class OptimizingTableTest(unittest.TestCase):
         self.assertEqual(ctable.get_char_index('B'), 2)
         self.assertEqual(ctable.get_char_index('D'), 4)
 
+    def test_encode_many(self):
+        ctable = pwd_guess.OptimizingCharacterTable(
+            'abcdABCD:', 3, ':', True, embedding=True)
+        np.testing.assert_array_equal(
+            ctable.encode_many(['dC', 'A:b', ':']),
+            [[4, 3, 0], [1, 0, 2], [0, 0, 0]])
+
     def test_table_upper_and_rare(self):
         ctable = pwd_guess.OptimizingCharacterTable('abcdABCD:', 2, ':A', True)
         self.assertEqual(ctable.rare_characters, ':')
@@ -299,6 +407,23 @@ class TrainerTest(unittest.TestCase):
         self.assertTupleEqual(x_vec.shape, (5, t.config.max_len, len(t.config.char_bag)))
         self.assertTupleEqual(y_vec.shape, (5, len(t.config.char_bag)))
 
+    def test_output_as_np_many_one_index_inputs(self):
+        config = pwd_guess.ModelDefaults(max_len=5, generations=20)
+        config.sequence_model = pwd_guess.Sequence.MANY_TO_ONE
+        config.index_inputs = True
+        pre = pwd_guess.Preprocessor(config)
+        pre.begin([('pass', 1)])
+
+        t = pwd_guess.Trainer(pre, config=config)
+        x_vec, y_vec, weight_vec = t.next_train_set_as_np()
+        self.assertTupleEqual(x_vec.shape, (5, t.config.max_len))
+        self.assertEqual(x_vec.dtype, np.int8)
+        self.assertTupleEqual(y_vec.shape, (5, 1))
+        self.assertEqual(t.loss_function(), 'sparse_categorical_crossentropy')
+        with self.assertRaises(pwd_guess.ConfigurationException):
+            pwd_guess.ModelDefaults(
+                index_inputs = True, embedding_layer = True).validate()
+
     def test_output_as_np_many_one_embedding(self):
         config = pwd_guess.ModelDefaults(max_len=5, generations=20)
         config.sequence_model = pwd_guess.Sequence.MANY_TO_ONE
@@ -492,6 +617,16 @@ class ModelDefaultsTest(unittest.TestCase):
         self.assertEqual(10, args.context_length)
         self.assertEqual('normal', args.freq_format)
 
+    def test_override_from_commandline_none_default(self):
+        args = pwd_guess.ModelDefaults()
+        args.override_from_commandline(
+            'target_guess_count=1000;guessing_time_budget=1.5;'
+            'progress_file=progress.jsonl;target_guess_margin=1.5')
+        self.assertEqual(1000, args.target_guess_count)
+        self.assertEqual(1.5, args.guessing_time_budget)
+        self.assertEqual('progress.jsonl', args.progress_file)
+        self.assertEqual(1.5, args.target_guess_margin)
+
     def test_concurrent_mod(self):
         with tempfile.NamedTemporaryFile(dir=TMPDIR) as tfile:
             m = pwd_guess.ModelDefaults(intermediate_fname=tfile.name)
@@ -731,6 +866,15 @@ class PwdListTest(unittest.TestCase):
                 ('word9', 0.2), ('ppppp', 0.2)])
 
 class FiltererTest(unittest.TestCase):
+    def test_pwd_is_valid_many(self):
+        f = pwd_guess.Filterer(pwd_guess.ModelDefaults(
+            char_bag = 'ab\n', min_len = 2, max_len = 4))
+        pwds = ['', 'a', 'ab', 'abab', 'ababa', 'ac', 'a£', 'ab\n', '\nab',
+                ('a', 'bb'), ('ab', 'ab', 'a')]
+        self.assertEqual(list(f.pwd_is_valid_many(pwds)),
+                         [f.pwd_is_valid(pwd, quick=True) for pwd in pwds])
+        self.assertEqual(len(f.pwd_is_valid_many([])), 0)
+
     def test_pwd_is_valid(self):
         f = pwd_guess.Filterer(pwd_guess.ModelDefaults())
         # Normal characters are good
@@ -995,6 +1139,169 @@ aaa	0.0625
         np.testing.assert_array_equal(
             [1.0, 0.0, 0.0], guesser.conditional_probs('aaa'))
 
+    def test_top_k_next_chars(self):
+        config = pwd_guess.ModelDefaults(
+            min_len = 1, max_len = 3, char_bag = 'ab\n',
+            relevel_not_matching_passwords = False)
+        guesser, ostream = self.make(config, [0.5, 0.2, 0.3])
+        answer = guesser.top_k_next_chars(['', 'ab'], 2)
+        self.assertEqual(len(answer), 2)
+        for row in answer:
+            self.assertEqual([char for char, _ in row], ['\n', 'b'])
+            np.testing.assert_array_almost_equal(
+                [prob for _, prob in row], [.5, .3])
+        answer = guesser.top_k_next_chars(['a'], 5, include_end = False)
+        self.assertEqual([char for char, _ in answer[0]], ['b', 'a'])
+        self.assertEqual(guesser.top_k_next_chars([], 2), [])
+
+    def test_guesser_spill_frontier(self):
+        with tempfile.TemporaryDirectory(dir=TMPDIR) as intm_dir:
+            config = pwd_guess.ModelDefaults(
+                min_len = 1, max_len = 6, char_bag = 'ab\n',
+                lower_probability_threshold = 10**-4, chunk_size_guesser = 3,
+                relevel_not_matching_passwords = False)
+            guesser, ostream = self.make(config, [0.5, 0.2, 0.3])
+            guesser.guess()
+            config.adict.update(max_frontier_nodes = 6,
+                                guesser_intermediate_directory = intm_dir)
+            spilling_guesser, spilling_ostream = self.make(
+                config, [0.5, 0.2, 0.3])
+            spilling_guesser.guess()
+            self.assertEqual(os.listdir(intm_dir), [])
+        self.assertEqual(sorted(ostream.getvalue().splitlines()),
+                         sorted(spilling_ostream.getvalue().splitlines()))
+
+    def test_resume(self):
+        with tempfile.TemporaryDirectory(dir=TMPDIR) as intm_dir:
+            config = pwd_guess.ModelDefaults(
+                min_len = 1, max_len = 6, char_bag = 'ab\n',
+                lower_probability_threshold = 10**-4, chunk_size_guesser = 3,
+                guesser_checkpoint_file = os.path.join(intm_dir, 'checkpoint'),
+                guesser_checkpoint_interval = 0)
+            ofname = os.path.join(intm_dir, 'guesses.txt')
+            with open(ofname, 'w') as ostream:
+                guesser = pwd_guess.Guesser(
+                    self.mock_model(config, [0.5, 0.2, 0.3]), config, ostream)
+                guesser.complete_guessing()
+            with open(ofname, 'r') as expected:
+                expected = expected.read()
+            self.assertFalse(os.path.exists(config.guesser_checkpoint_file))
+            predictions = []
+            def crashing_predict(str_list, **kwargs):
+                if len(predictions) == 5:
+                    raise KeyboardInterrupt()
+                predictions.append(str_list)
+                return [[[0.5, 0.2, 0.3]] for _ in str_list]
+            with open(ofname, 'w') as ostream:
+                model = Mock()
+                model.predict = crashing_predict
+                guesser = pwd_guess.Guesser(model, config, ostream)
+                with self.assertRaises(KeyboardInterrupt):
+                    guesser.complete_guessing()
+            self.assertTrue(os.path.exists(config.guesser_checkpoint_file))
+            with open(ofname, 'r+') as ostream:
+                guesser = pwd_guess.Guesser(
+                    self.mock_model(config, [0.5, 0.2, 0.3]), config, ostream)
+                guesser.resume_guessing()
+            with open(ofname, 'r') as found:
+                self.assertEqual(found.read(), expected)
+            self.assertFalse(os.path.exists(config.guesser_checkpoint_file))
+
+    def test_resume_without_checkpoint(self):
+        with tempfile.TemporaryDirectory(dir=TMPDIR) as intm_dir:
+            config = pwd_guess.ModelDefaults(
+                min_len = 1, max_len = 3, char_bag = 'ab\n',
+                lower_probability_threshold = 10**-4,
+                guesser_checkpoint_file = os.path.join(intm_dir, 'checkpoint'))
+            guesser, expected = self.make(config, [0.5, 0.2, 0.3])
+            guesser.complete_guessing()
+            ofname = os.path.join(intm_dir, 'guesses.txt')
+            with open(ofname, 'w') as ostream:
+                ostream.write('stale\t0.5\n' * 1000)
+            args = {'arch_file' : 'arch.json', 'weight_file' : 'weights.h5',
+                    'multi_gpu' : 1, 'enumerate_ofile' : ofname,
+                    'resume' : True, 'calc_probability_only' : False,
+                    'calc_guess_number_from_cache' : False}
+            with unittest.mock.patch.object(
+                    pwd_guess.ModelSerializer, 'load_model',
+                    return_value = self.mock_model(config, [0.5, 0.2, 0.3])):
+                pwd_guess.guess(args, config)
+            with open(ofname, 'r') as found:
+                self.assertEqual(found.read(), expected.getvalue())
+
+    def test_pool_prediction_batches(self):
+        config = pwd_guess.ModelDefaults(
+            min_len = 1, max_len = 6, char_bag = 'ab\n',
+            lower_probability_threshold = 10**-4, chunk_size_guesser = 2,
+            max_gpu_prediction_size = 8,
+            relevel_not_matching_passwords = False)
+        guesser, ostream = self.make(config, [0.5, 0.2, 0.3])
+        guesser.guess()
+        config.adict['pool_prediction_batches'] = True
+        pooled_guesser, pooled_ostream = self.make(config, [0.5, 0.2, 0.3])
+        pooled_guesser.guess()
+        self.assertEqual(sorted(ostream.getvalue().splitlines()),
+                         sorted(pooled_ostream.getvalue().splitlines()))
+        self.assertEqual(pooled_guesser.batch_stats.rows,
+                         guesser.batch_stats.rows)
+        self.assertLess(pooled_guesser.batch_stats.batches,
+                        guesser.batch_stats.batches)
+        self.assertGreater(pooled_guesser.batch_stats.mean_fill(),
+                           guesser.batch_stats.mean_fill())
+
+    def test_next_nodes_many(self):
+        config = pwd_guess.ModelDefaults(
+            min_len = 1, max_len = 2, char_bag = 'ab\n',
+            lower_probability_threshold = 0.1)
+        guesser, ostream = self.make(config, [0.5, 0.2, 0.3])
+        parents, char_indices, probs = guesser.next_nodes_many(
+            ['a', 'ab', 'b'], [1, 1, .3],
+            np.array([[.5, .2, .3], [.6, .2, .2], [.5, .2, .3]]))
+        self.assertEqual(list(parents), [0, 0])
+        self.assertEqual([guesser.chars_list[i] for i in char_indices],
+                         ['a', 'b'])
+        np.testing.assert_array_almost_equal(probs, [.2, .3])
+        self.assertEqual(guesser.generated, 3)
+        self.assertEqual(ostream.getvalue(), 'a\t0.5\nab\t0.6\nb\t0.15\n')
+
+    def test_top_n_completions(self):
+        config = pwd_guess.ModelDefaults(
+            min_len = 1, max_len = 4, char_bag = 'ab\n',
+            lower_probability_threshold = 10**-4, chunk_size_guesser = 3)
+        guesser, ostream = self.make(config, [0.5, 0.2, 0.3])
+        guesser.guess()
+        expected = sorted(
+            csv.reader(io.StringIO(ostream.getvalue()), delimiter = '\t',
+                       quotechar = None),
+            key = lambda row: float(row[1]), reverse = True)
+        answer = guesser.top_n_completions(['', 'b'], 5, threshold = 10**-4)
+        self.assertEqual(len(answer), 2)
+        np.testing.assert_array_almost_equal(
+            [prob for _, prob in answer[0]],
+            [float(prob) for _, prob in expected[:5]])
+        self.assertEqual(answer[0][0], ('b', .3))
+        self.assertEqual([pwd for pwd, _ in answer[1]][:2], ['b', 'bb'])
+        self.assertAlmostEqual(answer[1][1][1], .15)
+        self.assertEqual(guesser.generated, len(expected))
+
+    def test_top_n_completions_beam(self):
+        config = pwd_guess.ModelDefaults(
+            min_len = 1, max_len = 6, char_bag = 'ab\n',
+            relevel_not_matching_passwords = False)
+        guesser, _ = self.make(config, [0.5, 0.2, 0.3])
+        answer = guesser.top_n_completions([''], 3, beam_width = 1)
+        self.assertEqual([pwd for pwd, _ in answer[0]], ['', 'b', 'bb'])
+        np.testing.assert_array_almost_equal(
+            [prob for _, prob in answer[0]], [.5, .15, .045])
+
+    def test_top_n_completions_empty(self):
+        config = pwd_guess.ModelDefaults(
+            min_len = 1, max_len = 4, char_bag = 'ab\n')
+        guesser, _ = self.make(config, [0.5, 0.2, 0.3])
+        self.assertEqual(guesser.top_n_completions(['', 'a'], 0), [[], []])
+        self.assertEqual(guesser.top_n_completions(['a'], -1), [[]])
+        self.assertEqual(guesser.top_n_completions([], 5), [])
+
     def test_relevel_tri_alpha_calculator(self):
         distribution = [0.5, 0.2, 0.3]
         def smart_mock_predict(str_list, **kwargs):
@@ -1065,6 +1372,110 @@ aa	0.125
 aaa	0.0625
 """, fp.read().decode('utf8'))
 
+    def test_incremental_inference(self):
+        config = pwd_guess.ModelDefaults(
+            min_len = 3, max_len = 5, char_bag = 'ab\n',
+            lower_probability_threshold = 10**-3)
+        rng = np.random.RandomState(0)
+        model = pwd_guess.pwd_inference.NumpyModel([
+            ('LSTM', {'return_sequences' : True},
+             [rng.randn(3, 16), rng.randn(4, 16), rng.randn(16)]),
+            ('Flatten', {}, []),
+            ('Dense', {'activation' : 'softmax'},
+             [rng.randn(20, 3), rng.randn(3)])], dtype=np.float64)
+        ostream = io.StringIO()
+        pwd_guess.Guesser(model, config, ostream).complete_guessing()
+        config.incremental_inference = True
+        incremental_ostream = io.StringIO()
+        guesser = pwd_guess.Guesser(model, config, incremental_ostream)
+        self.assertNotEqual(guesser.incremental_predictor, None)
+        guesser.complete_guessing()
+        expected = sorted(csv.reader(io.StringIO(
+            ostream.getvalue()), delimiter = '\t', quotechar = None))
+        actual = sorted(csv.reader(io.StringIO(
+            incremental_ostream.getvalue()), delimiter = '\t',
+                                   quotechar = None))
+        self.assertEqual(len(expected), len(actual))
+        for expected_row, actual_row in zip(expected, actual):
+            self.assertEqual(expected_row[0], actual_row[0])
+            self.assertAlmostEqual(float(expected_row[1]), float(actual_row[1]))
+
+    def test_relevel_prediction_many(self):
+        config = pwd_guess.ModelDefaults(
+            min_len = 2, max_len = 3, char_bag = 'ab\n')
+        guesser, _ = self.make(config, [0.5, 0.2, 0.3])
+        preds = np.array([[[.5, .2, .3]], [[.5, .2, .3]], [[.5, .2, .3]],
+                          [[.5, .2, .3]]])
+        guesser.relevel_prediction_many(preds, ['ab', 'a', 'abb', 'bbb'])
+        np.testing.assert_array_almost_equal(
+            preds[:, 0], [[.5, .2, .3], [0, .4, .6], [1, 0, 0], [1, 0, 0]])
+        single = np.array([.5, .2, .3])
+        guesser.relevel_prediction(single, 'b')
+        np.testing.assert_array_almost_equal(single, [0, .4, .6])
+
+    def test_batch_prob_chunks(self):
+        rng = np.random.RandomState(0)
+        model = pwd_guess.pwd_inference.NumpyModel([
+            ('Flatten', {}, []),
+            ('Dense', {'activation' : 'softmax'},
+             [rng.randn(15, 3), rng.randn(3)])], dtype=np.float64)
+        config = pwd_guess.ModelDefaults(
+            min_len = 3, max_len = 5, char_bag = 'ab\n',
+            max_gpu_prediction_size = 3)
+        prefixes = ['', 'a', 'ab', 'ba', 'bbb', 'abab', 'aaaaa', 'b']
+        expected = pwd_guess.Guesser(model, config).conditional_probs_many(
+            prefixes)
+        guesser = pwd_guess.Guesser(model, config)
+        np.testing.assert_array_almost_equal(
+            guesser.batch_prob(prefixes), expected)
+        self.assertEqual(guesser.batch_stats.batches, 3)
+        config.prefetch_prediction_input = True
+        guesser = pwd_guess.Guesser(model, config)
+        self.assertTrue(guesser.prefetch_input())
+        np.testing.assert_array_almost_equal(
+            guesser.batch_prob(prefixes), expected)
+
+    def test_compiled_prediction(self):
+        config = pwd_guess.ModelDefaults(
+            min_len = 3, max_len = 5, char_bag = 'ab\n',
+            lower_probability_threshold = 10**-3, chunk_size_guesser = 64)
+        rng = np.random.RandomState(0)
+        model = pwd_guess.pwd_inference.NumpyModel([
+            ('Flatten', {}, []),
+            ('Dense', {'activation' : 'softmax'},
+             [rng.randn(15, 3), rng.randn(3)])], dtype=np.float64)
+        ostream = io.StringIO()
+        pwd_guess.Guesser(model, config, ostream).complete_guessing()
+        config.compiled_prediction = True
+        compiled_ostream = io.StringIO()
+        guesser = pwd_guess.Guesser(model, config, compiled_ostream)
+        self.assertEqual(guesser.bucketed_predictor.buckets, [32, 64])
+        guesser.complete_guessing()
+        self.assertEqual(ostream.getvalue(), compiled_ostream.getvalue())
+
+    def test_index_inputs(self):
+        rng = np.random.RandomState(0)
+        model = pwd_guess.pwd_inference.NumpyModel([
+            ('LSTM', {'return_sequences' : True},
+             [rng.randn(3, 16), rng.randn(4, 16), rng.randn(16)]),
+            ('Flatten', {}, []),
+            ('Dense', {'activation' : 'softmax'},
+             [rng.randn(20, 3), rng.randn(3)])], dtype=np.float64)
+        def run(**kwargs):
+            config = pwd_guess.ModelDefaults(
+                min_len = 3, max_len = 5, char_bag = 'ab\n',
+                lower_probability_threshold = 10**-3, **kwargs)
+            ostream = io.StringIO()
+            pwd_guess.Guesser(model, config, ostream).complete_guessing()
+            return sorted(
+                (pwd, round(float(prob), 12)) for pwd, prob in csv.reader(
+                    io.StringIO(ostream.getvalue()), delimiter = '\t',
+                    quotechar = None))
+        expected = run()
+        self.assertEqual(run(index_inputs = True), expected)
+        self.assertEqual(
+            run(index_inputs = True, incremental_inference = True), expected)
+
     def test_read_guess_number_cache(self):
         ifile = io.StringIO(
             """_\t0.01\t15\t\n_\t0.09\t0\t\n_\t0.03\t1\t\n_\t0.02\t7\t\n""")
@@ -1171,7 +1582,351 @@ class GuesserBuilderTest(unittest.TestCase):
         builder.add_serializer(mock_serializer).add_stream(mock_stream)
         guesser = builder.build()
         self.assertNotEqual(guesser, None)
-        self.assertEqual(type(guesser), pwd_guess.Guesser)
+        self.assertEqual(type(guesser), pwd_guess.ParallelGuesser)
+        self.assertEqual(guesser.model_serializer, mock_serializer)
+
+    def test_numpy_backend(self):
+        builder = pwd_guess.GuesserBuilder(
+            pwd_guess.ModelDefaults(inference_backend = 'numpy'))
+        mock_serializer, mock_stream, mock_model = Mock(), Mock(), Mock()
+        mock_serializer.load_numpy_model = MagicMock(return_value = mock_model)
+        builder.add_serializer(mock_serializer).add_stream(mock_stream)
+        guesser = builder.build()
+        self.assertEqual(guesser.model, mock_model)
+        self.assertFalse(mock_serializer.load_model.called)
+        with self.assertRaises(pwd_guess.ConfigurationException):
+            pwd_guess.ModelDefaults(inference_backend = 'torch').validate()
+
+class ParallelGuesserTest(unittest.TestCase):
+    def setUp(self):
+        self.intm_dir = tempfile.mkdtemp(dir=TMPDIR)
+
+    def tearDown(self):
+        shutil.rmtree(self.intm_dir)
+
+    def make_config(self, **kwargs):
+        config = pwd_guess.ModelDefaults(
+            min_len = 3, max_len = 5, char_bag = 'ab\n',
+            lower_probability_threshold = 10**-3,
+            parallel_guessing = True, fork_length = 2, cpu_limit = 2,
+            guesser_intermediate_directory = self.intm_dir)
+        config.adict.update(kwargs)
+        return config
+
+    def make_model(self):
+        mock_model = Mock()
+        mock_model.predict = mock_predict_smart_parallel_skewed
+        return mock_model
+
+    def run_in_process(self, guesser, config):
+        # Run the worker tasks in this process instead of a process pool
+        def do_forking(tasks):
+            pwd_guess._parallel_worker_guesser = pwd_guess.Guesser(
+                self.make_model(), config)
+            for task in tasks:
+                _, generated = pwd_guess.parallel_guesser_worker_task(task)
+                guesser.generated += generated
+        guesser.do_forking = do_forking
+
+    def test_builder(self):
+        guesser = (pwd_guess.GuesserBuilder(self.make_config())
+                   .add_model(self.make_model()).add_stream(io.StringIO())
+                   .build())
+        self.assertEqual(type(guesser), pwd_guess.ParallelGuesser)
+
+    def test_split_into_subtrees(self):
+        config = self.make_config(relevel_not_matching_passwords = False)
+        ostream = io.StringIO()
+        guesser = pwd_guess.ParallelGuesser(self.make_model(), config, ostream)
+        fork_points = guesser.split_into_subtrees('', 1)
+        self.assertEqual(
+            sorted([pwd for pwd, _ in fork_points]), ['aa', 'ab', 'ba', 'bb'])
+        probs = dict(fork_points)
+        self.assertAlmostEqual(probs['aa'], .01)
+        self.assertAlmostEqual(probs['bb'], .16)
+        self.assertEqual(guesser.generated, 3)
+
+    def test_make_tasks(self):
+        guesser = pwd_guess.ParallelGuesser(
+            self.make_model(), self.make_config(cpu_limit = 1), io.StringIO())
+        fork_points = [(str(i), i / 10) for i in range(10)]
+        tasks = guesser.make_tasks(fork_points)
+        self.assertEqual(len(tasks), pwd_guess.PARALLEL_TASKS_PER_CPU)
+        self.assertEqual(
+            sorted(node for _, nodes in tasks for node in nodes),
+            sorted(fork_points))
+        self.assertEqual(tasks[0][1][0], ('9', .9))
+        self.assertEqual(len(set(fname for fname, _ in tasks)), len(tasks))
+
+    def test_guess_same_as_serial(self):
+        config = self.make_config()
+        serial_stream = io.StringIO()
+        pwd_guess.Guesser(
+            self.make_model(), config, serial_stream).complete_guessing()
+        ostream = io.StringIO()
+        guesser = pwd_guess.ParallelGuesser(self.make_model(), config, ostream)
+        self.run_in_process(guesser, config)
+        generated = guesser.complete_guessing()
+        self.assertEqual(sorted(ostream.getvalue().splitlines()),
+                         sorted(serial_stream.getvalue().splitlines()))
+        self.assertEqual(generated, len(ostream.getvalue().splitlines()))
+        self.assertEqual(os.listdir(self.intm_dir), [])
+
+    def test_guess_calculator(self):
+        with tempfile.NamedTemporaryFile(mode = 'w', dir=TMPDIR) as pwd_file:
+            pwd_file.write('aaa\nbbbb\nabab\n')
+            pwd_file.flush()
+            config = self.make_config(
+                guess_serialization_method = 'calculator',
+                password_test_fname = pwd_file.name)
+            serial_stream = io.StringIO()
+            serial_stream.close = Mock()
+            pwd_guess.Guesser(
+                self.make_model(), config, serial_stream).complete_guessing()
+            ostream = io.StringIO()
+            guesser = pwd_guess.ParallelGuesser(
+                self.make_model(), config, ostream)
+            self.run_in_process(guesser, config)
+            guesser.complete_guessing()
+        self.assertEqual(ostream.getvalue(), serial_stream.getvalue())
+
+class PredictionBatchStatsTest(unittest.TestCase):
+    def test_add(self):
+        stats = pwd_guess.PredictionBatchStats(10)
+        stats.add(0)
+        stats.add(3)
+        stats.add(25)
+        self.assertEqual(stats.batches, 4)
+        self.assertEqual(stats.rows, 28)
+        self.assertEqual(stats.histogram, [0, 0, 0, 1, 0, 1, 0, 0, 0, 2])
+        self.assertAlmostEqual(stats.mean_fill(), .7)
+
+class BucketedPredictorTest(unittest.TestCase):
+    def test_predict(self):
+        ctable = pwd_guess.CharacterTable('ab\n', 3)
+        inputs = []
+        def predict_fn(x_vec):
+            inputs.append(x_vec)
+            return x_vec.sum(axis=1)
+        predictor = pwd_guess.BucketedPredictor(
+            predict_fn, ctable, [4, 2], dtype=np.float32)
+        predictor.warmup()
+        self.assertEqual([len(x_vec) for x_vec in inputs], [2, 4])
+        strings = ['a', 'ab', 'bba', 'b', 'aa', '']
+        np.testing.assert_array_equal(
+            predictor.predict(strings), ctable.encode_many(strings).sum(axis=1))
+        self.assertEqual([len(x_vec) for x_vec in inputs[2:]], [4, 2])
+        self.assertIs(inputs[2], inputs[1])
+        self.assertEqual(predictor.predict([]).shape, (0, 3))
+
+class BestFirstGuesserTest(unittest.TestCase):
+    def make_config(self, **kwargs):
+        config = pwd_guess.ModelDefaults(
+            min_len = 3, max_len = 6, char_bag = 'ab\n',
+            lower_probability_threshold = 10**-4, chunk_size_guesser = 4)
+        config.adict.update(kwargs)
+        return config
+
+    def run_guesser(self, config):
+        mock_model = Mock()
+        mock_model.predict = mock_predict_smart_parallel_skewed
+        ostream = io.StringIO()
+        guesser = pwd_guess.GuesserBuilder(config).add_model(
+            mock_model).add_stream(ostream).build()
+        guesser.complete_guessing()
+        return guesser, list(csv.reader(io.StringIO(
+            ostream.getvalue()), delimiter = '\t', quotechar = None))
+
+    def test_builder(self):
+        guesser, _ = self.run_guesser(
+            self.make_config(best_first_guessing = True))
+        self.assertEqual(type(guesser), pwd_guess.BestFirstGuesser)
+
+    def test_sorted_output(self):
+        _, expected = self.run_guesser(self.make_config())
+        guesser, found = self.run_guesser(
+            self.make_config(best_first_guessing = True))
+        self.assertEqual(guesser.generated, len(expected))
+        self.assertEqual(sorted(found), sorted(expected))
+        probs = [float(prob) for _, prob in found]
+        self.assertEqual(probs, sorted(probs, reverse = True))
+
+    def test_budget(self):
+        _, expected = self.run_guesser(self.make_config())
+        guesser, found = self.run_guesser(self.make_config(
+            best_first_guessing = True, best_first_guess_budget = 5))
+        self.assertEqual(guesser.generated, 5)
+        expected_probs = sorted(
+            [float(prob) for _, prob in expected], reverse = True)
+        np.testing.assert_array_almost_equal(
+            [float(prob) for _, prob in found], expected_probs[:5])
+
+    def test_rare_character_optimization(self):
+        with tempfile.NamedTemporaryFile(dir=TMPDIR) as intermediatef:
+            def make_config(**kwargs):
+                config = self.make_config(
+                    char_bag = 'abAB\n', max_len = 5,
+                    uppercase_character_optimization = True,
+                    rare_character_optimization_guessing = True,
+                    relevel_not_matching_passwords = True,
+                    intermediate_fname = intermediatef.name, **kwargs)
+                config.set_intermediate_info('rare_character_bag', [])
+                freqs = {'a' : .4, 'b' : .4, 'A' : .1, 'B' : .1}
+                for name in ['character_frequencies',
+                             'beginning_character_frequencies',
+                             'end_character_frequencies']:
+                    config.set_intermediate_info(name, freqs)
+                return config
+            _, expected = self.run_guesser(make_config())
+            _, found = self.run_guesser(make_config(best_first_guessing = True))
+        self.assertEqual(len(found), len(expected))
+        self.assertEqual(sorted(pwd for pwd, _ in found),
+                         sorted(pwd for pwd, _ in expected))
+        expected_probs = dict(expected)
+        for pwd, prob in found:
+            self.assertAlmostEqual(float(prob), float(expected_probs[pwd]))
+        probs = [float(prob) for _, prob in found]
+        self.assertEqual(probs, sorted(probs, reverse = True))
+
+    def test_spill_frontier(self):
+        _, expected = self.run_guesser(self.make_config())
+        with tempfile.TemporaryDirectory(dir=TMPDIR) as intm_dir:
+            guesser, found = self.run_guesser(self.make_config(
+                best_first_guessing = True, max_frontier_nodes = 8,
+                guesser_intermediate_directory = intm_dir))
+            self.assertEqual(os.listdir(intm_dir), [])
+        self.assertEqual(sorted(found), sorted(expected))
+        probs = [float(prob) for _, prob in found]
+        self.assertEqual(probs, sorted(probs, reverse = True))
+
+    def test_config(self):
+        with self.assertRaises(pwd_guess.ConfigurationException):
+            self.make_config(
+                best_first_guessing = True, parallel_guessing = True).validate()
+        with self.assertRaises(pwd_guess.ConfigurationException):
+            self.make_config(max_frontier_nodes = 5).validate()
+
+class GuessBudgetTest(unittest.TestCase):
+    make_config = BestFirstGuesserTest.make_config
+    run_guesser = BestFirstGuesserTest.run_guesser
+
+    def test_sample_passwords(self):
+        config = self.make_config()
+        mock_model = Mock()
+        mock_model.predict = mock_predict_smart_parallel_skewed
+        guesser = pwd_guess.Guesser(mock_model, config, io.StringIO())
+        probs, sample_probs = guesser.sample_passwords(
+            200, np.random.RandomState(0))
+        self.assertEqual(len(probs), 200)
+        self.assertTrue(np.all(probs <= sample_probs))
+        self.assertTrue(np.all(probs > 0))
+
+    def test_target_guess_count(self):
+        _, expected = self.run_guesser(self.make_config())
+        target = len(expected) // 4
+        guesser, found = self.run_guesser(self.make_config(
+            target_guess_count = target, threshold_pilot_samples = 2000))
+        self.assertEqual(guesser.generated, target)
+        self.assertEqual(len(found), target)
+        self.assertGreater(guesser.lower_probability_threshold, 10**-4)
+
+    def test_target_guess_count_prefix(self):
+        mock_model = Mock()
+        mock_model.predict = mock_predict_smart_parallel_skewed
+        def guess_prefix(**kwargs):
+            guesser = pwd_guess.Guesser(
+                mock_model, self.make_config(**kwargs), io.StringIO())
+            guesser.complete_guessing('b', .25)
+            return guesser
+        target = guess_prefix().generated // 2
+        guesser = guess_prefix(target_guess_count = target,
+                               threshold_pilot_samples = 2000)
+        self.assertEqual(guesser.generated, target)
+        probs, _ = guesser.sample_passwords(
+            10, np.random.RandomState(0), 'b', .25)
+        self.assertTrue(np.all(probs <= .25))
+
+    def test_best_first_target(self):
+        guesser, found = self.run_guesser(self.make_config(
+            best_first_guessing = True, best_first_guess_budget = 10,
+            target_guess_count = 5))
+        self.assertEqual(guesser.generated, 5)
+        self.assertEqual(len(found), 5)
+
+    def test_time_budget(self):
+        guesser, found = self.run_guesser(self.make_config(
+            guessing_time_budget = 10**-9))
+        self.assertEqual(guesser.generated, 0)
+        self.assertEqual(found, [])
+
+    def test_config(self):
+        for kwargs in [{'target_guess_count' : 0},
+                       {'guessing_time_budget' : -1},
+                       {'target_guess_count' : 5, 'target_guess_margin' : .5},
+                       {'target_guess_count' : 5, 'parallel_guessing' : True},
+                       {'target_guess_count' : 5,
+                        'guess_serialization_method' : 'random_walk'}]:
+            with self.assertRaises(pwd_guess.ConfigurationException):
+                self.make_config(**kwargs).validate()
+
+class ProgressReporterTest(unittest.TestCase):
+    make_config = BestFirstGuesserTest.make_config
+
+    def test_mass(self):
+        ostream = io.StringIO()
+        reporter = pwd_guess.ProgressReporter(ostream, 3600)
+        reporter.start(1)
+        reporter.expanded(1, 1, .25, .5)
+        reporter.report(4, 1)
+        self.assertEqual(ostream.getvalue(), '')
+        self.assertEqual(reporter.frontier_mass(), .5)
+        reporter.start_time -= 10
+        self.assertAlmostEqual(reporter.eta(reporter.start_time + 10), 10)
+        reporter.report(4, 1, final=True)
+        line = json.loads(ostream.getvalue())
+        self.assertEqual(line['nodes'], 1)
+        self.assertEqual(line['emitted_mass'], .25)
+        self.assertEqual(line['pruned_mass'], .25)
+        self.assertEqual(line['done_fraction'], .5)
+        self.assertTrue(line['final'])
+
+    def test_guessing(self):
+        config = self.make_config(progress_interval = 0)
+        mock_model = Mock()
+        mock_model.predict = mock_predict_smart_parallel_skewed
+        with tempfile.TemporaryDirectory(dir=TMPDIR) as directory:
+            config.progress_file = os.path.join(directory, 'progress.jsonl')
+            ostream = io.StringIO()
+            guesser = pwd_guess.Guesser(mock_model, config, ostream)
+            guesser.complete_guessing()
+            with open(config.progress_file, 'r') as progress:
+                lines = [json.loads(line) for line in progress]
+        self.assertGreater(len(lines), 1)
+        self.assertTrue(lines[-1]['final'])
+        self.assertEqual(lines[-1]['guesses'], guesser.generated)
+        self.assertAlmostEqual(lines[-1]['frontier_mass'], 0)
+        self.assertAlmostEqual(lines[-1]['emitted_mass'], sum(
+            float(prob) for _, prob in csv.reader(
+                io.StringIO(ostream.getvalue()), delimiter = '\t',
+                quotechar = None)))
+        fractions = [line['done_fraction'] for line in lines]
+        self.assertEqual(fractions, sorted(fractions))
+
+    def test_guessing_twice(self):
+        config = self.make_config(progress_interval = 3600)
+        mock_model = Mock()
+        mock_model.predict = mock_predict_smart_parallel_skewed
+        with tempfile.TemporaryDirectory(dir=TMPDIR) as directory:
+            config.progress_file = os.path.join(directory, 'progress.jsonl')
+            guesser = pwd_guess.Guesser(mock_model, config, io.StringIO())
+            first = guesser.complete_guessing()
+            second = guesser.complete_guessing()
+            with open(config.progress_file, 'r') as progress:
+                lines = [json.loads(line) for line in progress]
+        self.assertEqual([line['final'] for line in lines], [True, True])
+        self.assertEqual([line['guesses'] for line in lines], [first, second])
+        self.assertEqual(lines[0]['nodes'], lines[1]['nodes'])
+        self.assertAlmostEqual(lines[1]['done_fraction'], 1)
 
 class PreprocessingStepTest(unittest.TestCase):
     base_config = {
@@ -1348,6 +2103,247 @@ class ProbabilityCalculatorTest(unittest.TestCase):
                 [('aa', 1), ('bB', 1)])),
                              set([('aa', .09), ('bB', 0.04000000000000001)]))
 
+class AsyncGuessSerializerTest(unittest.TestCase):
+    guesses = [('pass', .025), (('w', 'o', 'rd'), .25), ('zero', 0),
+               ('gmail', np.float64(.04)), ('aaa', 1e-7)]
+
+    def serialize(self, serializer):
+        serializer.serialize(*self.guesses[0])
+        serializer.serialize_many(
+            [pwd for pwd, _ in self.guesses[1:]],
+            [prob for _, prob in self.guesses[1:]])
+        serializer.finish()
+
+    def test_same_output(self):
+        expected, ostream = io.StringIO(), io.StringIO()
+        self.serialize(pwd_guess.GuessSerializer(expected))
+        serializer = pwd_guess.AsyncGuessSerializer(
+            ostream, batch_size=2, queue_size=1)
+        self.serialize(serializer)
+        self.assertEqual(ostream.getvalue(), expected.getvalue())
+        self.assertEqual(serializer.get_total_guessed(), 4)
+        self.assertEqual(serializer.thread, None)
+
+    def test_flush(self):
+        ostream = io.StringIO()
+        serializer = pwd_guess.AsyncGuessSerializer(ostream, batch_size=100)
+        serializer.serialize('pass', .5)
+        self.assertEqual(ostream.getvalue(), '')
+        serializer.flush()
+        self.assertEqual(ostream.getvalue(), 'pass\t0.5\n')
+        serializer.serialize('word', .25)
+        serializer.finish()
+        self.assertEqual(ostream.getvalue(), 'pass\t0.5\nword\t0.25\n')
+
+    def test_collect_answer(self):
+        ostream = io.StringIO()
+        serializer = pwd_guess.AsyncGuessSerializer(ostream)
+        serializer.collect_answer(ostream, io.StringIO('pass\t0.5\n'))
+        serializer.finish_collecting(ostream)
+        self.assertEqual(ostream.getvalue(), 'pass\t0.5\n')
+
+    def test_write_error(self):
+        ostream = Mock()
+        ostream.write = MagicMock(side_effect=IOError('disk full'))
+        serializer = pwd_guess.AsyncGuessSerializer(ostream, batch_size=1)
+        serializer.serialize('pass', .5)
+        with self.assertRaises(IOError):
+            serializer.finish()
+
+    def test_make_serializer(self):
+        config = pwd_guess.ModelDefaults(
+            async_guess_writer = True, guess_writer_batch_size = 3)
+        config.validate()
+        guesser = pwd_guess.Guesser(Mock(), config, io.StringIO())
+        self.assertEqual(type(guesser.output_serializer),
+                         pwd_guess.AsyncGuessSerializer)
+        self.assertEqual(guesser.output_serializer.batch_size, 3)
+        config.guess_serialization_method = 'calculator'
+        with self.assertRaises(pwd_guess.ConfigurationException):
+            config.validate()
+
+    def test_compress_guesses(self):
+        config = pwd_guess.ModelDefaults(
+            async_guess_writer = True, compress_guesses = True)
+        with tempfile.TemporaryDirectory(dir=TMPDIR) as directory:
+            fname = os.path.join(directory, 'guesses.gz')
+            builder = pwd_guess.GuesserBuilder(config).add_model(Mock())
+            guesser = builder.add_file(fname).build()
+            self.serialize(guesser.output_serializer)
+            guesser.ostream.close()
+            with gzip.open(fname, 'rt') as guesses:
+                self.assertEqual(guesses.read(), (
+                    'pass\t0.025\nword\t0.25\ngmail\t0.04\naaa\t1e-07\n'))
+        config.guesser_checkpoint_file = 'checkpoint'
+        with self.assertRaises(pwd_guess.ConfigurationException):
+            config.validate()
+
+class BinaryGuessSerializerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(dir=TMPDIR)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self, fname):
+        with pwd_guess.pwd_guess_file.BinaryGuessReader(fname) as reader:
+            return list(reader)
+
+    def test_serialize(self):
+        fname = os.path.join(self.directory, 'guesses')
+        config = pwd_guess.ModelDefaults(
+            guess_serialization_method = 'binary', binary_guess_block_size = 2)
+        guesser = pwd_guess.GuesserBuilder(config).add_model(Mock()).add_file(
+            fname).build()
+        serializer = guesser.output_serializer
+        self.assertEqual(type(serializer), pwd_guess.BinaryGuessSerializer)
+        serializer.serialize('pass', .5)
+        serializer.serialize_many(
+            [('w', 'o', 'rd'), 'zero', 'gmail'], np.array([.25, 0, .04]))
+        serializer.finish()
+        self.assertEqual(serializer.get_total_guessed(), 3)
+        self.assertEqual(self.read(fname),
+                         [('pass', .5), ('word', .25), ('gmail', .04)])
+        config.guesser_checkpoint_file = 'checkpoint'
+        with self.assertRaises(pwd_guess.ConfigurationException):
+            config.validate()
+
+    def test_collect_answer(self):
+        fnames = [os.path.join(self.directory, name)
+                  for name in ['child1', 'child2', 'parent']]
+        for fname, guesses in zip(fnames, [[('a', .5), ('b', .25)], []]):
+            with open(fname, 'w') as ostream:
+                serializer = pwd_guess.BinaryGuessSerializer(ostream, 1)
+                for pwd, prob in guesses:
+                    serializer.serialize(pwd, prob)
+                serializer.finish()
+        with open(fnames[2], 'w') as ostream:
+            serializer = pwd_guess.BinaryGuessSerializer(ostream)
+            for fname in fnames[:2] + fnames[:1]:
+                with open(fname, 'r') as istream:
+                    serializer.collect_answer(ostream, istream)
+            serializer.finish_collecting(ostream)
+        self.assertEqual(self.read(fnames[2]), [
+            ('a', .5), ('b', .25), ('a', .5), ('b', .25)])
+
+class SortingGuessSerializerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(dir=TMPDIR)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_guessing(self):
+        model = Mock()
+        model.predict = MagicMock(side_effect=lambda x_vec, **kwargs: np.tile(
+            [[[.1, .5, .4]]], (len(x_vec), 1, 1)))
+        config = pwd_guess.ModelDefaults(
+            char_bag = 'ab\n', min_len = 0, max_len = 3,
+            lower_probability_threshold = 0, chunk_size_guesser = 4,
+            relevel_not_matching_passwords = False,
+            sort_guesses = True, sort_guesses_run_size = 3,
+            guesser_intermediate_directory = self.directory)
+        config.validate()
+        ostream = io.StringIO()
+        guesser = pwd_guess.Guesser(model, config, ostream)
+        self.assertEqual(type(guesser.output_serializer),
+                         pwd_guess.SortingGuessSerializer)
+        guesser.complete_guessing()
+        rows = [line.split('\t') for line in ostream.getvalue().splitlines()]
+        self.assertEqual(len(rows), 15)
+        probs = [float(row[1]) for row in rows]
+        self.assertEqual(probs, sorted(probs, reverse=True))
+        self.assertEqual([int(row[2]) for row in rows], list(range(1, 16)))
+        self.assertEqual(rows[0][:2], ['', '0.1'])
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_collect_answer(self):
+        ostream = io.StringIO()
+        serializer = pwd_guess.SortingGuessSerializer(ostream, self.directory)
+        serializer.serialize('c', .1)
+        serializer.collect_answer(
+            ostream, io.StringIO('a\t0.5\t1\nd\t0.05\t2\n'))
+        serializer.finish_collecting(ostream)
+        serializer.finish()
+        self.assertEqual(ostream.getvalue(),
+                         'a\t0.5\t1\nc\t0.1\t2\nd\t0.05\t3\n')
+
+    def test_config(self):
+        config = pwd_guess.ModelDefaults(
+            sort_guesses = True, guess_serialization_method = 'calculator')
+        with self.assertRaises(pwd_guess.ConfigurationException):
+            config.validate()
+        config.guess_serialization_method = 'human'
+        config.async_guess_writer = True
+        with self.assertRaises(pwd_guess.ConfigurationException):
+            config.validate()
+
+class ProbabilityHistogramSerializerTest(unittest.TestCase):
+    probs = [.5, .25, .25, .1, .01, 1e-5, 1e-5, 1e-9]
+
+    def make(self, ostream, probs=None):
+        serializer = pwd_guess.ProbabilityHistogramSerializer(
+            ostream, [1e-4, .3, .25], buckets_per_bit=4)
+        probs = self.probs if probs is None else probs
+        serializer.serialize_many(['pwd'] * len(probs), np.array(probs))
+        serializer.serialize('zero', 0)
+        return serializer
+
+    def test_counts(self):
+        ostream = io.StringIO()
+        serializer = self.make(ostream)
+        self.assertEqual(serializer.get_total_guessed(), 8)
+        serializer.finish()
+        probs, guess_numbers = pwd_guess.Guesser.read_guess_number_cache(
+            io.StringIO(ostream.getvalue()))
+        self.assertEqual(probs, sorted(probs))
+        table = dict(zip(probs, guess_numbers))
+        self.assertEqual(table[.3], 1)
+        self.assertEqual(table[.25], 1)
+        self.assertEqual(table[1e-4], 5)
+        self.assertEqual(table[2 ** -.25], 0)
+        self.assertEqual(table[.5], 0)
+        self.assertEqual(table[2 ** -1.25], 1)
+        self.assertEqual(guess_numbers[0], 8)
+        for prob, guess_number in table.items():
+            self.assertEqual(guess_number,
+                             sum(1 for p in self.probs if p > prob))
+
+    def test_state(self):
+        serializer = self.make(io.StringIO())
+        ostream = io.StringIO()
+        copy = self.make(ostream, [])
+        copy.set_state(serializer.get_state())
+        copy.finish()
+        expected = io.StringIO()
+        serializer.ostream = expected
+        serializer.finish()
+        self.assertEqual(ostream.getvalue(), expected.getvalue())
+
+    def test_collect_answer(self):
+        outputs = []
+        for probs in [self.probs[:3], self.probs[3:]]:
+            outputs.append(io.StringIO())
+            self.make(outputs[-1], probs).finish()
+        expected = io.StringIO()
+        self.make(expected).finish()
+        ostream = io.StringIO()
+        serializer = self.make(io.StringIO(), [])
+        for output in outputs:
+            serializer.collect_answer(ostream, io.StringIO(output.getvalue()))
+        serializer.finish_collecting(ostream)
+        self.assertEqual(ostream.getvalue(), expected.getvalue())
+
+    def test_make_serializer(self):
+        config = pwd_guess.ModelDefaults(
+            guess_serialization_method = 'histogram',
+            probability_steps = [.1, .01])
+        config.validate()
+        guesser = pwd_guess.Guesser(Mock(), config, io.StringIO())
+        self.assertEqual(type(guesser.output_serializer),
+                         pwd_guess.ProbabilityHistogramSerializer)
+        self.assertEqual(list(guesser.output_serializer.steps), [.01, .1])
+
 class GuessNumberGeneratorTest(unittest.TestCase):
     def setUp(self):
         self.ostream = tempfile.NamedTemporaryFile(
@@ -1371,6 +2367,23 @@ class GuessNumberGeneratorTest(unittest.TestCase):
                 'Total count: 6\nword\t0.25\t1\ngmail\t0.04\t3\npass\t0.025\t4\n',
                 guesses.read())
 
+    def test_state(self):
+        probs = [('pass', .025), ('word', .25), ('gmail', .04)]
+        gng = pwd_guess.GuessNumberGenerator(self.ostream, probs)
+        gng.serialize('asdf', .3)
+        gng.serialize('word', .25)
+        gng.serialize('gmail', .04)
+        resumed = pwd_guess.GuessNumberGenerator(self.ostream, probs)
+        resumed.set_state(json.loads(json.dumps(gng.get_state())))
+        resumed.serialize('pass', .025)
+        resumed.serialize('jjjj', .2)
+        resumed.serialize('jjjjj', .00001)
+        resumed.finish()
+        with open(self.ostream.name, 'r') as guesses:
+            self.assertEqual(
+                'Total count: 6\nword\t0.25\t1\ngmail\t0.04\t3\npass\t0.025\t4\n',
+                guesses.read())
+
     def test_guessing_real(self):
         probs = [('    ', 1.26799704013e-05), ('william', 2.12144662517e-05),
                  ('forever', 0.00013370734607), ('8daddy', 1.00234253381e-05)]
@@ -0,0 +1,562 @@
+# -*- coding: utf-8 -*-
+"""Numpy implementations of the forward pass of the password models.
+
+The layers here mirror the keras layers that Trainer._return_model builds.
+They are created from (class_name, config, weights) layer specs so that they
+can be made either from a loaded keras model or directly from saved files.
+"""
+import collections
+import json
+
+import numpy as np
+
+
+def hard_sigmoid(x):
+    return np.clip(0.2 * x + 0.5, 0, 1)
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+def softmax(x):
+    exps = np.exp(x - np.max(x, axis=-1, keepdims=True))
+    return exps / np.sum(exps, axis=-1, keepdims=True)
+
+def relu(x):
+    return np.maximum(x, 0)
+
+def linear(x):
+    return x
+
+ACTIVATIONS = {
+    'hard_sigmoid' : hard_sigmoid,
+    'sigmoid' : sigmoid,
+    'tanh' : np.tanh,
+    'softmax' : softmax,
+    'relu' : relu,
+    'linear' : linear,
+}
+
+def get_activation(name):
+    if name is None:
+        return linear
+    if name not in ACTIVATIONS:
+        raise ValueError('Unsupported activation: %s' % name)
+    return ACTIVATIONS[name]
+
+
+class InferenceLayer():
+    def __init__(self, config, weights, dtype=np.float32):
+        self.config = config
+        self.dtype = dtype
+
+    def forward(self, x):
+        raise NotImplementedError()
+
+
+class PassThroughLayer(InferenceLayer):
+    def forward(self, x):
+        return x
+
+
+class ActivationLayer(InferenceLayer):
+    def __init__(self, config, weights, dtype=np.float32):
+        super().__init__(config, weights, dtype)
+        self.activation = get_activation(config['activation'])
+
+    def forward(self, x):
+        return self.activation(x)
+
+
+class FlattenLayer(InferenceLayer):
+    def forward(self, x):
+        return x.reshape((x.shape[0], -1))
+
+
+class EmbeddingLayer(InferenceLayer):
+    def __init__(self, config, weights, dtype=np.float32):
+        super().__init__(config, weights, dtype)
+        self.embeddings = np.asarray(weights[0], dtype=dtype)
+
+    def forward(self, x):
+        return self.embeddings[np.asarray(x, dtype=np.intp)]
+
+
+class DenseLayer(InferenceLayer):
+    def __init__(self, config, weights, dtype=np.float32):
+        super().__init__(config, weights, dtype)
+        self.kernel = np.asarray(weights[0], dtype=dtype)
+        if config.get('use_bias', True):
+            self.bias = np.asarray(weights[1], dtype=dtype)
+        else:
+            self.bias = np.zeros((self.kernel.shape[1],), dtype=dtype)
+        self.activation = get_activation(config.get('activation'))
+
+    def forward(self, x):
+        return self.activation(np.dot(x, self.kernel) + self.bias)
+
+
+class RecurrentLayer(InferenceLayer):
+    """Base class for recurrent layers.
+
+    The step function works on inputs that were already multiplied by the
+    kernel and had the input bias added (see project_input). This lets the
+    first layer of a model replace the projection by a table lookup.
+    """
+    num_states = 1
+
+    def __init__(self, config, weights, dtype=np.float32):
+        super().__init__(config, weights, dtype)
+        self.kernel = np.asarray(weights[0], dtype=dtype)
+        self.recurrent_kernel = np.asarray(weights[1], dtype=dtype)
+        self.units = self.recurrent_kernel.shape[0]
+        self.activation = get_activation(config.get('activation', 'tanh'))
+        self.recurrent_activation = get_activation(
+            config.get('recurrent_activation', 'hard_sigmoid'))
+        self.go_backwards = config.get('go_backwards', False)
+        self.return_sequences = config.get('return_sequences', False)
+
+    def project_input(self, x):
+        raise NotImplementedError()
+
+    def step(self, projected_x, states):
+        raise NotImplementedError()
+
+    def initial_states(self, num):
+        return [np.zeros((num, self.units), dtype=self.dtype)
+                for _ in range(self.num_states)]
+
+    def forward(self, x):
+        if self.go_backwards:
+            x = x[:, ::-1]
+        projected = self.project_input(x)
+        states = self.initial_states(x.shape[0])
+        outputs = np.empty(
+            (x.shape[0], x.shape[1], self.units), dtype=self.dtype)
+        for i in range(x.shape[1]):
+            outputs[:, i], states = self.step(projected[:, i], states)
+        if self.return_sequences:
+            return outputs
+        return outputs[:, -1]
+
+
+class LSTMLayer(RecurrentLayer):
+    num_states = 2
+
+    def __init__(self, config, weights, dtype=np.float32):
+        super().__init__(config, weights, dtype)
+        if config.get('use_bias', True):
+            self.bias = np.asarray(weights[2], dtype=dtype)
+        else:
+            self.bias = np.zeros((4 * self.units,), dtype=dtype)
+
+    def project_input(self, x):
+        return np.dot(x, self.kernel) + self.bias
+
+    def step(self, projected_x, states):
+        h_tm1, c_tm1 = states
+        units = self.units
+        z = projected_x + np.dot(h_tm1, self.recurrent_kernel)
+        i = self.recurrent_activation(z[:, :units])
+        f = self.recurrent_activation(z[:, units:2 * units])
+        c = f * c_tm1 + i * self.activation(z[:, 2 * units:3 * units])
+        o = self.recurrent_activation(z[:, 3 * units:])
+        h = o * self.activation(c)
+        return h, [h, c]
+
+
+class GRULayer(RecurrentLayer):
+    def __init__(self, config, weights, dtype=np.float32):
+        super().__init__(config, weights, dtype)
+        units = self.units
+        if config.get('use_bias', True):
+            bias = np.asarray(weights[2], dtype=dtype)
+        else:
+            bias = np.zeros((3 * units,), dtype=dtype)
+        self.reset_after = config.get('reset_after', False)
+        if self.reset_after:
+            if bias.ndim == 1:
+                bias = np.stack([bias, np.zeros_like(bias)])
+            self.bias, self.recurrent_bias = bias[0], bias[1]
+        else:
+            self.bias = bias
+            self.recurrent_bias = np.zeros((3 * units,), dtype=dtype)
+
+    def project_input(self, x):
+        return np.dot(x, self.kernel) + self.bias
+
+    def step(self, projected_x, states):
+        h_tm1 = states[0]
+        units = self.units
+        if self.reset_after:
+            inner = (np.dot(h_tm1, self.recurrent_kernel) +
+                     self.recurrent_bias)
+            z = self.recurrent_activation(
+                projected_x[:, :units] + inner[:, :units])
+            r = self.recurrent_activation(
+                projected_x[:, units:2 * units] + inner[:, units:2 * units])
+            hh = self.activation(
+                projected_x[:, 2 * units:] + r * inner[:, 2 * units:])
+        else:
+            inner = np.dot(h_tm1, self.recurrent_kernel[:, :2 * units])
+            z = self.recurrent_activation(
+                projected_x[:, :units] + inner[:, :units])
+            r = self.recurrent_activation(
+                projected_x[:, units:2 * units] + inner[:, units:])
+            hh = self.activation(
+                projected_x[:, 2 * units:] +
+                np.dot(r * h_tm1, self.recurrent_kernel[:, 2 * units:]))
+        h = z * h_tm1 + (1 - z) * hh
+        return h, [h]
+
+
+class TimeDistributedLayer(InferenceLayer):
+    def __init__(self, config, weights, dtype=np.float32):
+        super().__init__(config, weights, dtype)
+        inner = config['layer']
+        self.layer = make_layer(
+            inner['class_name'], inner['config'], weights, dtype)
+
+    def forward(self, x):
+        flat = self.layer.forward(x.reshape((-1, x.shape[-1])))
+        return flat.reshape(x.shape[:-1] + flat.shape[-1:])
+
+
+LAYER_CLASSES = {
+    'Embedding' : EmbeddingLayer,
+    'LSTM' : LSTMLayer,
+    'GRU' : GRULayer,
+    'Dense' : DenseLayer,
+    'Flatten' : FlattenLayer,
+    'Dropout' : PassThroughLayer,
+    'InputLayer' : PassThroughLayer,
+    'Activation' : ActivationLayer,
+    'TimeDistributed' : TimeDistributedLayer,
+}
+
+def make_layer(class_name, config, weights, dtype=np.float32):
+    if class_name not in LAYER_CLASSES:
+        raise ValueError('Unsupported layer for numpy inference: %s' %
+                         class_name)
+    return LAYER_CLASSES[class_name](config, weights, dtype)
+
+PRECISIONS = ['float32', 'float16', 'int8']
+
+# Number of leading weights of each layer that are kernels rather than biases
+KERNEL_COUNTS = {
+    'Embedding' : 1,
+    'LSTM' : 2,
+    'GRU' : 2,
+    'Dense' : 1,
+    'TimeDistributed' : 1,
+}
+
+def quantize_weight(weight, precision):
+    """Rounds a kernel to the given precision.
+
+    float16 rounds every weight to the nearest half precision float, like
+    utils/weight_compression.py. int8 stores every column as integers in
+    [-127, 127] times one scale for the column, like the fixed point coding in
+    utils/quantize_json.py. The answer is converted back to floats so that the
+    layers can use it unchanged. This only measures the error that storing the
+    weights at lower precision would add. numpy has no fast float16 or int8
+    matrix products, so it does not make inference faster.
+    """
+    weight = np.asarray(weight, dtype=np.float64)
+    if precision == 'float32':
+        return weight
+    if precision == 'float16':
+        return weight.astype(np.float16).astype(np.float64)
+    if precision == 'int8':
+        scale = np.max(np.abs(weight), axis=0) / 127
+        scale[scale == 0] = 1
+        return np.round(weight / scale).astype(np.int8) * scale
+    raise ValueError('Unsupported precision: %s' % precision)
+
+def quantize_specs(layer_specs, precision):
+    return [(class_name, config,
+             [quantize_weight(weight, precision)
+              if i < KERNEL_COUNTS.get(class_name, 0) else weight
+              for i, weight in enumerate(weights)])
+            for class_name, config, weights in layer_specs]
+
+def calibration_report(reference, probs):
+    """Summarizes the error of probs against the reference probabilities.
+
+    The log errors are in bits, which is what matters for guess numbers.
+    """
+    reference = np.asarray(reference, dtype=np.float64).ravel()
+    probs = np.asarray(probs, dtype=np.float64).ravel()
+    tiny = np.finfo(np.float64).tiny
+    abs_error = np.abs(probs - reference)
+    log_error = np.abs(np.log2(np.maximum(probs, tiny)) -
+                       np.log2(np.maximum(reference, tiny)))
+    return collections.OrderedDict([
+        ('count', len(reference)),
+        ('max_abs_error', float(np.max(abs_error, initial=0))),
+        ('mean_abs_error', float(np.mean(abs_error)) if len(abs_error) else 0),
+        ('max_log2_error', float(np.max(log_error, initial=0))),
+        ('mean_log2_error', float(np.mean(log_error)) if len(log_error) else 0),
+    ])
+
+def _decode(name):
+    return name.decode('utf-8') if isinstance(name, bytes) else name
+
+def read_layer_configs(archfile):
+    """Returns the (class_name, config) of every layer in a keras json file.
+    """
+    with open(archfile, 'r') as arch:
+        config = json.load(arch)['config']
+    # Keras before 2.2 stores the list of layers directly as the config
+    if isinstance(config, dict):
+        config = config['layers']
+    return [(layer['class_name'], layer['config']) for layer in config]
+
+def read_layer_weights(weightfile):
+    """Returns a dict from layer name to the list of weights of that layer in
+    a file written by the keras save_weights method."""
+    import h5py
+    answer = {}
+    with h5py.File(weightfile, 'r') as weights:
+        if 'model_weights' in weights:
+            weights = weights['model_weights']
+        for layer_name in weights.attrs['layer_names']:
+            group = weights[_decode(layer_name)]
+            answer[_decode(layer_name)] = [
+                np.asarray(group[_decode(weight_name)])
+                for weight_name in group.attrs['weight_names']]
+    return answer
+
+
+class NumpyModel():
+    """A sequential model whose forward pass runs in numpy.
+
+    predict has the same signature as the keras predict method so that this
+    can be used in place of a keras model by the Guesser. precision is one of
+    PRECISIONS and sets how finely the kernels are rounded, which
+    utils/calibrate_precision.py uses to report the error of reduced precision
+    weights.
+    """
+    def __init__(self, layer_specs, dtype=np.float32, precision='float32'):
+        if precision != 'float32':
+            layer_specs = quantize_specs(layer_specs, precision)
+        self.layer_specs = layer_specs
+        self.precision = precision
+        self.layers = [make_layer(class_name, config, weights, dtype)
+                       for class_name, config, weights in layer_specs]
+        self.dtype = dtype
+
+    @staticmethod
+    def layer_specs_from_keras(model):
+        specs = []
+        for layer in model.layers:
+            # A model used as a layer, like the wrapper made for index inputs
+            if hasattr(layer, 'layers'):
+                specs += NumpyModel.layer_specs_from_keras(layer)
+            else:
+                specs.append((layer.__class__.__name__, layer.get_config(),
+                              layer.get_weights()))
+        return specs
+
+    @staticmethod
+    def layer_specs_from_files(archfile, weightfile):
+        weights = read_layer_weights(weightfile)
+        return [(class_name, config, weights.get(config['name'], []))
+                for class_name, config in read_layer_configs(archfile)]
+
+    @classmethod
+    def fromKerasModel(cls, model, dtype=np.float32, precision='float32'):
+        return cls(cls.layer_specs_from_keras(model), dtype, precision)
+
+    @classmethod
+    def fromFiles(cls, archfile, weightfile, dtype=np.float32,
+                  precision='float32'):
+        """Loads the files written by ModelSerializer.save_model without
+        importing keras."""
+        return cls(cls.layer_specs_from_files(archfile, weightfile), dtype,
+                   precision)
+
+    def forward(self, x):
+        if not isinstance(self.layers[0], EmbeddingLayer):
+            x = np.asarray(x, dtype=self.dtype)
+        for layer in self.layers:
+            x = layer.forward(x)
+        return x
+
+    def predict(self, x, batch_size=None, verbose=0):
+        # pylint: disable=unused-argument
+        if batch_size is None or len(x) <= batch_size:
+            return self.forward(x)
+        return np.concatenate([self.forward(x[i:i + batch_size])
+                               for i in range(0, len(x), batch_size)])
+
+
+class IncrementalPredictor():
+    """Predicts the next character by advancing cached recurrent states.
+
+    Supports many to one models made of an optional embedding layer,
+    recurrent layers running forwards, a flatten layer and dense layers. The
+    recurrent states and the partial result of the first dense layer are
+    cached for each prefix. A child prefix is computed by advancing the
+    states of its parent by one timestep. The flatten layer makes the output
+    depend on the padding after the prefix, so the padded positions are
+    still run from the cached state, but the prefix itself is never
+    recomputed.
+    """
+    def __init__(self, model, char_indices, context_length, pad_index=-1,
+                 cache_size=100000):
+        self.char_indices = char_indices
+        self.context_length = context_length
+        self.pad_index = pad_index
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._init_layers(model)
+
+    def _init_layers(self, model):
+        layers = [layer for layer in model.layers
+                  if not isinstance(layer, PassThroughLayer)]
+        self.embedding = None
+        if isinstance(layers[0], EmbeddingLayer):
+            self.embedding = layers.pop(0)
+        self.recurrent = []
+        while layers and isinstance(layers[0], RecurrentLayer):
+            self.recurrent.append(layers.pop(0))
+        if (not self.recurrent or not layers or
+                not isinstance(layers[0], FlattenLayer) or
+                not all(isinstance(layer, (DenseLayer, ActivationLayer))
+                        for layer in layers[1:]) or
+                not isinstance(layers[1], DenseLayer)):
+            raise ValueError(
+                'Incremental inference requires embedding, recurrent, '
+                'flatten and dense layers')
+        for layer in self.recurrent:
+            if layer.go_backwards:
+                raise ValueError(
+                    'Incremental inference requires forward recurrent layers')
+        first_dense = layers[1]
+        top_units = self.recurrent[-1].units
+        self.dense_by_position = first_dense.kernel.reshape(
+            (self.context_length, top_units, -1))
+        self.dense_bias = first_dense.bias
+        self.dense_activation = first_dense.activation
+        self.head = layers[2:]
+        # Lookup table from a character index to the projected input of the
+        # first recurrent layer. The last row is used for an all zero input.
+        first = self.recurrent[0]
+        if self.embedding is not None:
+            table = np.dot(self.embedding.embeddings, first.kernel)
+        else:
+            table = first.kernel.copy()
+        table = np.concatenate([table, np.zeros((1, table.shape[1]),
+                                                dtype=table.dtype)])
+        self.input_table = table + first.bias
+        # Offsets of each state in the flattened state vector
+        self.state_slices = []
+        offset = 0
+        for layer in self.recurrent:
+            for _ in range(layer.num_states):
+                self.state_slices.append(slice(offset, offset + layer.units))
+                offset += layer.units
+        self.acc_slice = slice(offset, offset + self.dense_bias.shape[0])
+        self.state_size = self.acc_slice.stop
+
+    def _step(self, states, char_idx, positions):
+        """Advance states of all rows by one character.
+
+        Returns the new states. Rows may be at different positions.
+        """
+        projected = self.input_table[char_idx]
+        new_states = np.empty_like(states)
+        layer_input = None
+        state_idx = 0
+        for i, layer in enumerate(self.recurrent):
+            if i > 0:
+                projected = layer.project_input(layer_input)
+            layer_states = [states[:, self.state_slices[state_idx + j]]
+                            for j in range(layer.num_states)]
+            layer_input, layer_states = layer.step(projected, layer_states)
+            for j, state in enumerate(layer_states):
+                new_states[:, self.state_slices[state_idx + j]] = state
+            state_idx += layer.num_states
+        acc = states[:, self.acc_slice].copy()
+        for position in np.unique(positions):
+            rows = positions == position
+            acc[rows] += np.dot(layer_input[rows],
+                                self.dense_by_position[position])
+        new_states[:, self.acc_slice] = acc
+        return new_states
+
+    def _run(self, states, positions, chars, end_positions):
+        """Advance each row from its position until its end position.
+
+        chars[i, j] is the character index of row i at position j. Returns the
+        new states.
+        """
+        for position in range(int(np.min(positions, initial=self.context_length)),
+                              self.context_length):
+            rows = np.nonzero((positions <= position) &
+                              (end_positions > position))[0]
+            if len(rows) == 0:
+                continue
+            states[rows] = self._step(
+                states[rows], chars[rows, position],
+                np.full(len(rows), position))
+        return states
+
+    def _output(self, states):
+        hidden = self.dense_activation(states[:, self.acc_slice] +
+                                       self.dense_bias)
+        for layer in self.head:
+            hidden = layer.forward(hidden)
+        return hidden
+
+    def _indices(self, astring):
+        return [self.char_indices[c] for c in astring]
+
+    def _cache_get(self, astring):
+        states = self.cache.get(astring)
+        if states is not None:
+            self.cache.move_to_end(astring)
+        return states
+
+    def _cache_put(self, astring, states):
+        self.cache[astring] = states
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def predict(self, astring_list):
+        num = len(astring_list)
+        width = self.context_length
+        states = np.zeros((num, self.state_size), dtype=self.input_table.dtype)
+        positions = np.zeros(num, dtype=np.intp)
+        lengths = np.zeros(num, dtype=np.intp)
+        chars = np.full((num, width), len(self.input_table) - 1,
+                        dtype=np.intp)
+        for i, astring in enumerate(astring_list):
+            if len(astring) > width:
+                astring = astring[len(astring) - width:]
+            else:
+                cached = self._cache_get(astring)
+                if cached is None and len(astring) > 0:
+                    cached = self._cache_get(astring[:-1])
+                    if cached is not None:
+                        positions[i] = len(astring) - 1
+                else:
+                    positions[i] = len(astring)
+                if cached is not None:
+                    states[i] = cached
+                    self.cache_hits += 1
+                else:
+                    self.cache_misses += 1
+            lengths[i] = len(astring)
+            chars[i, :len(astring)] = self._indices(astring)
+        if self.pad_index != -1:
+            for i in range(num):
+                chars[i, lengths[i]:] = self.pad_index
+        states = self._run(states, positions, chars, lengths)
+        for i, astring in enumerate(astring_list):
+            if len(astring) < width:
+                self._cache_put(astring, states[i].copy())
+        return self._output(self._run(states, lengths, chars,
+                                      np.full(num, width)))
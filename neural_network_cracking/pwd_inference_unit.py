@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+import pwd_inference
+
+CHARS = '\nabc'
+CHAR_INDICES = dict((c, i) for i, c in enumerate(CHARS))
+CONTEXT_LENGTH = 5
+HIDDEN_SIZE = 6
+
+def random_specs(model_type='LSTM', embedding=False, dense_layers=0,
+                 reset_after=False, seed=0):
+    rng = np.random.RandomState(seed)
+    vocab = len(CHARS)
+    specs = []
+    input_size = vocab
+    if embedding:
+        specs.append(('Embedding', {}, [rng.randn(vocab, 3)]))
+        input_size = 3
+    gates = 4 if model_type == 'LSTM' else 3
+    for _ in range(2):
+        config = {'return_sequences' : True, 'activation' : 'tanh',
+                  'recurrent_activation' : 'hard_sigmoid'}
+        weights = [rng.randn(input_size, gates * HIDDEN_SIZE) * .5,
+                   rng.randn(HIDDEN_SIZE, gates * HIDDEN_SIZE) * .5,
+                   rng.randn(gates * HIDDEN_SIZE) * .5]
+        if reset_after:
+            config['reset_after'] = True
+            weights[2] = rng.randn(2, gates * HIDDEN_SIZE) * .5
+        specs.append((model_type, config, weights))
+        specs.append(('Dropout', {}, []))
+        input_size = HIDDEN_SIZE
+    specs.append(('Flatten', {}, []))
+    input_size = CONTEXT_LENGTH * HIDDEN_SIZE
+    for _ in range(dense_layers):
+        specs.append(('Dense', {'activation' : 'linear'},
+                      [rng.randn(input_size, 7) * .3, rng.randn(7)]))
+        input_size = 7
+    specs.append(('Dense', {'activation' : 'softmax'},
+                  [rng.randn(input_size, vocab) * .3, rng.randn(vocab)]))
+    return specs
+
+def save_specs(specs, directory, nested=True):
+    """Writes specs the way the keras to_json and save_weights methods do."""
+    import h5py
+    archfile = os.path.join(directory, 'arch.json')
+    weightfile = os.path.join(directory, 'weights.h5')
+    names = ['layer_%d' % i for i in range(len(specs))]
+    layers = [{'class_name' : class_name, 'config' : dict(config, name=name)}
+              for name, (class_name, config, _) in zip(names, specs)]
+    if nested:
+        layers = {'name' : 'sequential_1', 'layers' : layers}
+    with open(archfile, 'w') as arch:
+        json.dump({'class_name' : 'Sequential', 'config' : layers}, arch)
+    with h5py.File(weightfile, 'w') as h5file:
+        h5file.attrs['layer_names'] = [name.encode('utf-8') for name in names]
+        for name, (_, _, weights) in zip(names, specs):
+            group = h5file.create_group(name)
+            weight_names = ['%s/w_%d:0' % (name, i)
+                            for i in range(len(weights))]
+            group.attrs['weight_names'] = [
+                wname.encode('utf-8') for wname in weight_names]
+            for wname, weight in zip(weight_names, weights):
+                group.create_dataset(wname, data=weight)
+    return archfile, weightfile
+
+def encode(strings, embedding=False, padding=False):
+    if embedding:
+        x_vec = np.zeros((len(strings), CONTEXT_LENGTH), dtype=np.int8)
+    else:
+        x_vec = np.zeros((len(strings), CONTEXT_LENGTH, len(CHARS)))
+    for i, astring in enumerate(strings):
+        astring = astring[-CONTEXT_LENGTH:]
+        if padding:
+            astring += '\n' * (CONTEXT_LENGTH - len(astring))
+        for j, char in enumerate(astring):
+            if embedding:
+                x_vec[i, j] = CHAR_INDICES[char]
+            else:
+                x_vec[i, j, CHAR_INDICES[char]] = 1
+    return x_vec
+
+class NumpyModelTest(unittest.TestCase):
+    def test_dense(self):
+        model = pwd_inference.NumpyModel([
+            ('Dense', {'activation' : 'softmax'},
+             [np.array([[1, 0], [0, 1]]), np.array([0, 0])])])
+        np.testing.assert_array_almost_equal(
+            model.predict(np.array([[0, 0], [np.log(3), 0]])),
+            [[.5, .5], [.75, .25]])
+
+    def test_lstm_one_step(self):
+        kernel = np.array([[1, 2, 3, 4]])
+        recurrent_kernel = np.zeros((1, 4))
+        layer = pwd_inference.LSTMLayer(
+            {'activation' : 'tanh', 'recurrent_activation' : 'sigmoid'},
+            [kernel, recurrent_kernel, np.zeros(4)], dtype=np.float64)
+        answer = layer.forward(np.ones((1, 1, 1)))
+        sig = pwd_inference.sigmoid
+        np.testing.assert_array_almost_equal(
+            answer, [[sig(4) * np.tanh(sig(1) * np.tanh(3))]])
+
+    def test_time_distributed(self):
+        layer = pwd_inference.TimeDistributedLayer(
+            {'layer' : {'class_name' : 'Dense',
+                        'config' : {'activation' : 'linear'}}},
+            [np.ones((3, 2)), np.zeros(2)])
+        self.assertEqual(layer.forward(np.ones((4, 5, 3))).shape, (4, 5, 2))
+
+    def test_batch_size(self):
+        model = pwd_inference.NumpyModel(random_specs(), dtype=np.float64)
+        x_vec = encode(['a', 'ab', 'abc', 'cba', 'b'])
+        np.testing.assert_array_almost_equal(
+            model.predict(x_vec), model.predict(x_vec, batch_size=2))
+
+    def test_unsupported(self):
+        with self.assertRaises(ValueError):
+            pwd_inference.NumpyModel([('Conv1D', {}, [])])
+
+    def check_files(self, nested):
+        specs = random_specs('GRU', dense_layers=1)
+        x_vec = encode(['a', 'ab', 'abc', 'cba', 'b'])
+        with tempfile.TemporaryDirectory() as directory:
+            archfile, weightfile = save_specs(specs, directory, nested)
+            loaded = pwd_inference.NumpyModel.fromFiles(
+                archfile, weightfile, dtype=np.float64)
+        np.testing.assert_array_almost_equal(
+            loaded.predict(x_vec),
+            pwd_inference.NumpyModel(specs, dtype=np.float64).predict(x_vec))
+
+    def test_from_files(self):
+        self.check_files(nested=True)
+
+    def test_from_files_layer_list(self):
+        self.check_files(nested=False)
+
+class QuantizeTest(unittest.TestCase):
+    def test_quantize_weight(self):
+        weight = np.array([[.5, -1, 0], [-.25, .3, 0]])
+        np.testing.assert_array_equal(
+            pwd_inference.quantize_weight(weight, 'float32'), weight)
+        np.testing.assert_array_almost_equal(
+            pwd_inference.quantize_weight(weight, 'float16'), weight, 3)
+        int8 = pwd_inference.quantize_weight(weight, 'int8')
+        self.assertTrue(np.all(
+            np.abs(int8 - weight) <= np.array([.5, 1, 1]) / 254 + 1e-12))
+        self.assertEqual(list(int8[:, 2]), [0, 0])
+        with self.assertRaises(ValueError):
+            pwd_inference.quantize_weight(weight, 'int4')
+
+    def test_biases_kept(self):
+        specs = random_specs('GRU', reset_after=True)
+        quantized = pwd_inference.quantize_specs(specs, 'int8')
+        np.testing.assert_array_equal(quantized[0][2][2], specs[0][2][2])
+        self.assertFalse(np.array_equal(quantized[0][2][0], specs[0][2][0]))
+
+    def test_model(self):
+        specs = random_specs('LSTM', dense_layers=1)
+        x_vec = encode(['a', 'ab', 'abc', 'cba', 'b'])
+        reference = pwd_inference.NumpyModel(specs).predict(x_vec)
+        for precision in ['float16', 'int8']:
+            model = pwd_inference.NumpyModel(specs, precision=precision)
+            np.testing.assert_array_almost_equal(
+                model.predict(x_vec), reference, 2)
+
+    def test_calibration_report(self):
+        report = pwd_inference.calibration_report([.5, .25], [.5, .5])
+        self.assertEqual(report['count'], 2)
+        self.assertEqual(report['max_abs_error'], .25)
+        self.assertEqual(report['mean_abs_error'], .125)
+        self.assertEqual(report['max_log2_error'], 1)
+        self.assertEqual(report['mean_log2_error'], .5)
+
+class IncrementalPredictorTest(unittest.TestCase):
+    batches = [['', 'a', 'b'], ['ab', 'bb', 'c'], ['abc', 'bba', 'a'],
+               ['abca'], ['abcab', 'abcabc', 'aa']]
+
+    def check(self, specs, embedding=False, padding=False, cache_size=1000):
+        model = pwd_inference.NumpyModel(specs, dtype=np.float64)
+        if padding:
+            pad_index = CHAR_INDICES['\n']
+        elif embedding:
+            pad_index = 0
+        else:
+            pad_index = -1
+        predictor = pwd_inference.IncrementalPredictor(
+            model, CHAR_INDICES, CONTEXT_LENGTH, pad_index, cache_size)
+        for batch in self.batches:
+            np.testing.assert_array_almost_equal(
+                predictor.predict(batch),
+                model.predict(encode(batch, embedding, padding)))
+        return predictor
+
+    def test_lstm(self):
+        predictor = self.check(random_specs('LSTM'))
+        self.assertEqual(predictor.cache_misses, 3)
+
+    def test_gru(self):
+        self.check(random_specs('GRU', dense_layers=1))
+
+    def test_gru_reset_after(self):
+        self.check(random_specs('GRU', reset_after=True))
+
+    def test_embedding(self):
+        self.check(random_specs('LSTM', embedding=True), embedding=True)
+
+    def test_padding(self):
+        self.check(random_specs('LSTM', dense_layers=1), padding=True)
+
+    def test_small_cache(self):
+        predictor = self.check(random_specs('LSTM'), cache_size=2)
+        self.assertEqual(len(predictor.cache), 2)
+
+    def test_unsupported(self):
+        specs = random_specs('LSTM')
+        specs[0][1]['go_backwards'] = True
+        with self.assertRaises(ValueError):
+            pwd_inference.IncrementalPredictor(
+                pwd_inference.NumpyModel(specs), CHAR_INDICES, CONTEXT_LENGTH)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,6 +6,10 @@ import os
 import csv
 import collections
 
+root_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.join(root_dir,".."))
+import pwd_guess_file
+
 class Strategy(object):
     NOT_CRACKED = -1
 
@@ -121,14 +125,21 @@ strat_map = {
     'monty' : MontyStrat
 }
 
-def read_probability_file(ifname):
+def read_probability_rows(ifname):
+    if pwd_guess_file.is_binary_guess_file(ifname):
+        with pwd_guess_file.BinaryGuessReader(ifname) as reader:
+            yield from reader
+        return
     with open(ifname, 'r') as ifile:
-        prev_prob = 1
         for row in csv.reader(ifile, delimiter = '\t', quotechar = None):
-            prob = float(row[1])
-            assert prob <= prev_prob, 'Out of order probability'
-            yield (row[0], prob)
-            prev_prob = prob
+            yield (row[0], float(row[1]))
+
+def read_probability_file(ifname):
+    prev_prob = 1
+    for pwd, prob in read_probability_rows(ifname):
+        assert prob <= prev_prob, 'Out of order probability'
+        yield (pwd, prob)
+        prev_prob = prob
 
 def read_password_file(ifname):
     with open(ifname, 'r') as ifile:
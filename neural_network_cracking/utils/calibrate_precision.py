@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""Reports how far reduced precision models are from the float32 model.
+
+For every password in the test file, the next character probabilities of all
+of its prefixes and the probability of the whole password are computed with
+the float32 numpy model and with the model at each reduced precision.
+"""
+
+import sys
+import argparse
+import json
+import logging
+import os
+
+import numpy as np
+
+root_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.join(root_dir,".."))
+import pwd_guess
+import pwd_inference
+
+def password_probs(guesser, passwords):
+    prefixes = [pwd[:j] for pwd in passwords for j in range(len(pwd) + 1)]
+    predictions = guesser.batch_prob(prefixes)[:, 0]
+    # The calculator spreads the probability of a rare or uppercase character
+    # class over its members like the guesser does
+    calculator = pwd_guess.ProbabilityCalculator(guesser)
+    pwd_probs = [prob for _, prob in calculator.calc_probabilities(
+        [(pwd, 1) for pwd in passwords])]
+    return predictions, np.array(pwd_probs)
+
+def read_passwords(fname, config):
+    with open(fname, 'r') as pwd_file:
+        passwords = [line.rstrip('\n') for line in pwd_file]
+    allowed = set(config.char_bag)
+    return [pwd for pwd in passwords
+            if pwd != '' and all(char in allowed for char in pwd)]
+
+def main(args):
+    logging.basicConfig(level=logging.INFO)
+    with open(args.config, 'r') as config_args:
+        config = pwd_guess.ModelDefaults(json.load(config_args)['config'])
+    assert config.sequence_model == pwd_guess.Sequence.MANY_TO_ONE, (
+        'Only many to one models are supported')
+    passwords = read_passwords(args.test_file, config)
+    logging.info('Calibrating on %d passwords', len(passwords))
+    specs = pwd_inference.NumpyModel.layer_specs_from_files(
+        args.arch_file, args.weight_file)
+    def probs_at(precision):
+        model = pwd_inference.NumpyModel(specs, precision=precision)
+        return password_probs(pwd_guess.Guesser(model, config, None), passwords)
+
+    reference_chars, reference_pwds = probs_at('float32')
+    report = {}
+    for precision in args.precisions:
+        char_probs, pwd_probs = probs_at(precision)
+        report[precision] = {
+            'next_char' : pwd_inference.calibration_report(
+                reference_chars, char_probs),
+            'password' : pwd_inference.calibration_report(
+                reference_pwds, pwd_probs),
+        }
+    json.dump(report, args.ofile, indent=2)
+    args.ofile.write('\n')
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description=(
+        'Compare reduced precision numpy inference against float32'))
+    parser.add_argument('config', help='Model configuration file. ')
+    parser.add_argument('arch_file', help='Model architecture file. ')
+    parser.add_argument('weight_file', help='Model weight file. ')
+    parser.add_argument('test_file', help='Test passwords, one per line. ')
+    parser.add_argument('-p', '--precisions', nargs='+',
+                        default=['float16', 'int8'],
+                        choices=pwd_inference.PRECISIONS)
+    parser.add_argument('-o', '--ofile', type=argparse.FileType('w'),
+                        help='Output file. Default is stdout. ',
+                        default=sys.stdout)
+    main(parser.parse_args())
@@ -1,9 +1,30 @@
 #!/usr/bin/env python3
 import argparse
 import os.path
+import sys
 from collections import Counter
 import math
 
+root_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.join(root_dir,".."))
+import pwd_guess_file
+
+def guess_number_rows(inp_file, test_pwds):
+    """Yields the password, probability and guess number columns of the test
+    passwords in a binary guess file."""
+    remaining = set(test_pwds)
+    guess_number = 0
+    with pwd_guess_file.BinaryGuessReader(inp_file) as reader:
+        for passwords, probs in reader.blocks():
+            for i, pwd in enumerate(passwords):
+                if pwd in remaining:
+                    remaining.discard(pwd)
+                    yield [pwd, repr(float(probs[i])),
+                           str(guess_number + i + 1)]
+            guess_number += len(passwords)
+            if len(remaining) == 0:
+                break
+
 def create_output(args):
     prob = "0x0.1p-1"
     max_guess = 0
@@ -13,9 +34,12 @@ def create_output(args):
         counts = Counter(deduplicated)
     probs = []
     guess_list = []
-    with open(args.inp_file, "r") as inp, open(os.path.join(args.op_dir, "lookupresults."+args.condition), "w") as out:
-        for line in inp:
-            cols = line.split('\t')
+    if pwd_guess_file.is_binary_guess_file(args.inp_file):
+        rows = guess_number_rows(args.inp_file, deduplicated)
+    else:
+        rows = (line.split('\t') for line in open(args.inp_file, "r"))
+    with open(os.path.join(args.op_dir, "lookupresults."+args.condition), "w") as out:
+        for cols in rows:
             op_cols=[]
             op_cols.append(args.user)
             op_cols.append(args.condition)
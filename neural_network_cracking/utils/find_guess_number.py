@@ -1,16 +1,30 @@
 import sys
 import argparse
+import os
+
+root_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.join(root_dir,".."))
+import pwd_guess_file
+
+def read_guesses(ifile):
+    if pwd_guess_file.is_binary_guess_stream(ifile):
+        with pwd_guess_file.BinaryGuessReader(ifile) as reader:
+            yield from reader
+        return
+    for line in ifile:
+        lines = line.strip('\n')
+        try:
+            # Sorted output has the guess number as a third column
+            pwd, prob = lines.split('\t')[:2]
+        except ValueError:
+            pwd, prob = lines, -1
+        yield pwd, prob
 
 def main(args):
     pwds = set([line.strip('\n') for line in args.pfile])
     seen = set()
     ctr = 0
-    for ctr, line in enumerate(args.ifile):
-        lines = line.strip('\n')
-        try:
-            pwd, prob = lines.split('\t')
-        except ValueError as e:
-            pwd, prob = lines, -1
+    for ctr, (pwd, prob) in enumerate(read_guesses(args.ifile)):
         ctr += 1
         if pwd in seen:
             ctr -= 1
@@ -23,7 +37,8 @@ if __name__=='__main__':
     parser = argparse.ArgumentParser(description='')
     parser.add_argument('-i', '--ifile',
                         type = argparse.FileType('r'),
-                        help = 'Input file. Default is stdin. ',
+                        help = ('Input file, text or binary guess format. '
+                                'Default is stdin. '),
                         default = sys.stdin)
     parser.add_argument('pfile',
                         type = argparse.FileType('r'),
@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+"""Sorts a guess file by descending probability.
+
+Replaces sort -gr -k2 on guesser output. The input is text or binary guess
+output. Text output has the guess number as a third column.
+"""
+
+import argparse
+import os
+import sys
+
+root_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.join(root_dir,".."))
+import pwd_guess_file
+
+def main(args):
+    pwd_guess_file.sort_guess_file(
+        args.ifile, args.ofile, args.run_size, args.tmp_dir, args.binary)
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description=(
+        'Sort enumerated guesses by descending probability'))
+    parser.add_argument('ifile', help='Guess file, text or binary. ')
+    parser.add_argument('ofile', help='Sorted output file. ')
+    parser.add_argument('-r', '--run-size', type=int,
+                        default=pwd_guess_file.DEFAULT_RUN_SIZE,
+                        help='Guesses to sort in memory at a time. ')
+    parser.add_argument('-t', '--tmp-dir', default=None,
+                        help='Directory for sorted runs. ')
+    parser.add_argument('-b', '--binary', action='store_true',
+                        help='Write the binary guess format. ')
+    main(parser.parse_args())